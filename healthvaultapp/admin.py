@@ -0,0 +1,69 @@
+from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+
+from . import utils
+from .models import HealthVaultUser
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator which, on PostgreSQL, uses the planner's row estimate as the
+    count of an unfiltered table with more than ``estimate_threshold`` rows,
+    rather than scanning the whole table with ``COUNT(*)``.
+    """
+    estimate_threshold = 10000
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = self._estimate_count()
+        if self._count is None:
+            return super(EstimatedCountPaginator, self)._get_count()
+        return self._count
+    count = property(_get_count)
+
+    def _estimate_count(self):
+        queryset = self.object_list
+        query = getattr(queryset, 'query', None)
+        if query is None or query.where:
+            return None
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        cursor = connection.cursor()
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+        if row is None or row[0] < self.estimate_threshold:
+            return None
+        return int(row[0])
+
+
+class HealthVaultUserAdmin(admin.ModelAdmin):
+    list_display = ('user', 'record_id', 'token_expires', 'token_failures')
+    list_select_related = True
+    search_fields = ('=record_id', '=user__username')
+    raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+    actions = ['revoke', 'resolve_record_ids', 'request_sync']
+
+    def revoke(self, request, queryset):
+        revoked, failed = utils.revoke_users(queryset)
+        self.message_user(request,
+                'Revoked {0} HealthVault users.'.format(revoked))
+    revoke.short_description = 'Revoke HealthVault credentials'
+
+    def resolve_record_ids(self, request, queryset):
+        updated, failed = utils.resolve_record_ids(queryset)
+        self.message_user(request, 'Updated {0} HealthVault records; '
+                '{1} could not be resolved.'.format(updated, failed))
+    resolve_record_ids.short_description = 'Re-resolve HealthVault records'
+
+    def request_sync(self, request, queryset):
+        requested = utils.request_sync(queryset)
+        self.message_user(request,
+                'Requested a sync of {0} HealthVault users.'.format(requested))
+    request_sync.short_description = 'Resync HealthVault data'
+
+
+admin.site.register(HealthVaultUser, HealthVaultUserAdmin)
@@ -0,0 +1,223 @@
+import base64
+import datetime
+import json
+import xml.etree.ElementTree as ET
+import zlib
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import HealthVaultArchiveChunk, HealthVaultThing
+from .utils import chunks, get_setting
+
+
+# Django 1.6 replaced commit_on_success with atomic.
+atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+
+# Fields of the entries of a chunk's index.
+THING_ID, DATATYPE, BLOCK_START, BLOCK_LENGTH, OFFSET, LENGTH = range(6)
+
+
+def archive_things(record_id, things):
+    """
+    Stores the raw XML of ``things`` from the record ``record_id`` for audit,
+    as :py:class:`~healthvaultapp.models.HealthVaultThing` rows. Returns the
+    number of things archived.
+
+    :param things: ``thing`` elements, such as from
+        :py:func:`~healthvaultapp.things.get_things` with a
+        :py:class:`~healthvaultapp.things.Projection` which isn't parsed, or
+        strings of their XML.
+    """
+    now = timezone.now()
+    rows = []
+    for thing in things:
+        if isinstance(thing, basestring):
+            xml, thing = thing, ET.fromstring(thing)
+        else:
+            xml = ET.tostring(thing)
+        rows.append(HealthVaultThing(record_id=record_id,
+                thing_id=thing.findtext('thing-id'),
+                datatype=thing.findtext('type-id'), created=now, xml=xml))
+    HealthVaultThing.objects.bulk_create(rows)
+    return len(rows)
+
+
+def get_archived_thing(record_id, thing_id):
+    """
+    Returns the raw XML of the most recently archived copy of the thing
+    ``thing_id`` in the record ``record_id``, or ``None`` if it wasn't
+    archived. Only the chunks whose index holds the thing are read, and
+    only the block of the chunk which holds it is fetched and decompressed.
+    """
+    rows = HealthVaultThing.objects.filter(record_id=record_id,
+            thing_id=thing_id).order_by('-created', '-pk')
+    for xml in rows.values_list('xml', flat=True)[:1]:
+        return xml
+
+    # Entries of the index start with the thing ID.
+    indexes = HealthVaultArchiveChunk.objects.filter(record_id=record_id,
+            index__contains='[' + json.dumps(thing_id) + ',') \
+            .order_by('-month').values_list('pk', 'index')
+    for pk, index in indexes:
+        for entry in reversed(json.loads(index)):
+            if entry[THING_ID] == thing_id:
+                block = zlib.decompress(_read_data(pk, entry[BLOCK_START],
+                        entry[BLOCK_LENGTH]))
+                return block[entry[OFFSET]:entry[OFFSET] + entry[LENGTH]] \
+                        .decode('utf-8')
+    return None
+
+
+def iter_archived_things(datatype=None, batch_size=1000):
+    """
+    Iterates over ``(record_id, xml)`` for every archived thing, or those of
+    ``datatype``, in compacted chunks and then in rows. Rows are read
+    ``batch_size`` at a time and chunks one at a time, so the archive is
+    never loaded whole. Every archived copy of a thing is included.
+    """
+    chunks = HealthVaultArchiveChunk.objects.order_by('record_id', 'month')
+    for pk, record_id, index in chunks.values_list('pk', 'record_id',
+            'index'):
+        entries = [entry for entry in json.loads(index)
+                if datatype is None or entry[DATATYPE] == datatype]
+        if not entries:
+            continue
+        data = base64.b64decode(HealthVaultArchiveChunk.objects.filter(pk=pk)
+                .values_list('data', flat=True)[0])
+        block, start = None, None
+        for entry in entries:
+            if entry[BLOCK_START] != start:
+                start = entry[BLOCK_START]
+                block = zlib.decompress(data[start:start +
+                        entry[BLOCK_LENGTH]])
+            yield record_id, block[entry[OFFSET]:entry[OFFSET] +
+                    entry[LENGTH]].decode('utf-8')
+
+    rows = HealthVaultThing.objects.order_by('pk')
+    if datatype is not None:
+        rows = rows.filter(datatype=datatype)
+    last = 0
+    while True:
+        batch = list(rows.filter(pk__gt=last).values_list('pk', 'record_id',
+                'xml')[:batch_size])
+        for last, record_id, xml in batch:
+            yield record_id, xml
+        if len(batch) < batch_size:
+            break
+
+
+def _read_data(pk, start, length):
+    """Returns ``length`` bytes from ``start`` of the data of the chunk
+    ``pk``, fetching only the base64 characters which encode them."""
+    # Every 3 bytes are encoded as 4 characters.
+    first = start // 3
+    last = (start + length + 2) // 3
+    encoded = HealthVaultArchiveChunk.objects.filter(pk=pk).extra(
+            select={'part': 'substr(data, %s, %s)'},
+            select_params=(first * 4 + 1, (last - first) * 4)) \
+            .values_list('part', flat=True)[0]
+    decoded = base64.b64decode(encoded)
+    return decoded[start - first * 3:start - first * 3 + length]
+
+
+def compact(days=None, retention_days=None, now=None):
+    """
+    Rolls the things archived more than ``days`` ago into a compressed
+    :py:class:`~healthvaultapp.models.HealthVaultArchiveChunk` for each
+    record and month, and deletes archived things which are past the
+    ``retention_days`` window.
+
+    Things are compressed with zlib in blocks of
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_ARCHIVE_BLOCK_SIZE`
+    bytes. Each record and month is compacted in its own transaction, so
+    compaction can be interrupted and run again.
+
+    :param days: Defaults to
+        :py:data:`~healthvaultapp.defaults.HEALTHVAULT_ARCHIVE_COMPACT_DAYS`.
+    :param retention_days: Defaults to
+        :py:data:`~healthvaultapp.defaults.HEALTHVAULT_ARCHIVE_RETENTION_DAYS`.
+    :returns: A ``(compacted, expired)`` tuple counting the things which
+        were compacted and deleted.
+    """
+    now = now or timezone.now()
+    if days is None:
+        days = get_setting('HEALTHVAULT_ARCHIVE_COMPACT_DAYS')
+    if retention_days is None:
+        retention_days = get_setting('HEALTHVAULT_ARCHIVE_RETENTION_DAYS')
+
+    compacted = 0
+    rows = HealthVaultThing.objects.filter(
+            created__lt=now - datetime.timedelta(days=days))
+    record_ids = list(rows.order_by().values_list('record_id', flat=True)
+            .distinct())
+    for record_id in record_ids:
+        # Rows are read one record and compacted one month at a time, to
+        # bound memory use.
+        group, month = [], None
+        for row in rows.filter(record_id=record_id).order_by('created', 'pk') \
+                .iterator():
+            if group and _month(row.created) != month:
+                compacted += _compact_month(record_id, month, group)
+                group = []
+            month = _month(row.created)
+            group.append(row)
+        if group:
+            compacted += _compact_month(record_id, month, group)
+
+    expired = 0
+    if retention_days is not None:
+        limit = now - datetime.timedelta(days=retention_days)
+        rows = HealthVaultThing.objects.filter(created__lt=limit)
+        expired += rows.count()
+        rows.delete()
+        # Chunks are deleted once all of their month is past the window.
+        old = HealthVaultArchiveChunk.objects.filter(month__lt=_month(limit))
+        expired += sum(old.values_list('count', flat=True))
+        old.delete()
+    return compacted, expired
+
+
+def _month(created):
+    return datetime.date(created.year, created.month, 1)
+
+
+def _compact_month(record_id, month, rows):
+    block_size = get_setting('HEALTHVAULT_ARCHIVE_BLOCK_SIZE')
+    with atomic():
+        chunk, created = HealthVaultArchiveChunk.objects.select_for_update() \
+                .get_or_create(record_id=record_id, month=month)
+        data = base64.b64decode(chunk.data)
+        index = json.loads(chunk.index)
+        # Blocks are compressed independently, so new blocks are appended
+        # to the chunk without recompressing it.
+        for block in _blocks(rows, block_size):
+            compressed = zlib.compress(''.join(xml for row, xml in block), 9)
+            offset = 0
+            for row, xml in block:
+                index.append([row.thing_id, row.datatype, len(data),
+                        len(compressed), offset, len(xml)])
+                offset += len(xml)
+            data += compressed
+        chunk.data = base64.b64encode(data)
+        chunk.index = json.dumps(index, separators=(',', ':'))
+        chunk.count = len(index)
+        chunk.save()
+        for pks in chunks([row.pk for row in rows], 500):
+            HealthVaultThing.objects.filter(pk__in=pks).delete()
+    return len(rows)
+
+
+def _blocks(rows, block_size):
+    """Yields lists of ``(row, xml)`` of up to ``block_size`` bytes of XML,
+    or single rows which are larger."""
+    block, size = [], 0
+    for row in rows:
+        xml = row.xml.encode('utf-8')
+        if block and size + len(xml) > block_size:
+            yield block
+            block, size = [], 0
+        block.append((row, xml))
+        size += len(xml)
+    if block:
+        yield block
@@ -0,0 +1,701 @@
+import base64
+from collections import deque
+import hashlib
+import hmac
+import httplib
+import logging
+import os
+import Queue
+import select
+import socket
+import sys
+import threading
+import time
+from urllib import urlencode
+from urlparse import parse_qsl, urlsplit
+import xml.etree.ElementTree as ET
+
+from healthvaultlib.exceptions import (_get_exception_class_for,
+        HealthVaultException, HealthVaultHTTPException)
+from healthvaultlib.healthvault import (_msg_time, HEALTHVAULT_VERSION,
+        HealthVaultConn as BaseHealthVaultConn)
+
+from . import timing
+
+
+logger = logging.getLogger(__name__)
+
+
+# The platform path to which all HealthVault requests are posted.
+PLATFORM_PATH = '/platform/wildcat.ashx'
+
+GETPERSONINFO_INFO = '{urn:com.microsoft.wc.methods.response.GetPersonInfo}info'
+
+# Read-only HealthVault methods, which are safe to send more than once.
+IDEMPOTENT_METHODS = frozenset([
+    'GetAlternateIds',
+    'GetPersonInfo',
+    'GetThings',
+])
+
+# Persistent connections, keyed by server. Pools are only valid in the process
+# that created them, so they are discarded if we find ourselves in a child
+# process after a fork.
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+# What this process has seen of the platform server's health. Only transport
+# failures count, since an error status in a response means the server is
+# reachable.
+_status = {
+    'last_handshake': None,
+    'handshake_seconds': None,
+    'last_success': None,
+    'last_error': None,
+    'last_error_message': None,
+    'consecutive_failures': 0,
+}
+_status_lock = threading.Lock()
+
+
+def parse_server(server):
+    """Returns the ``(scheme, host, port)`` at which to reach ``server``.
+
+    ``server`` is normally a bare host name, such as
+    "platform.healthvault-ppe.com", which is reached over HTTPS on port 443.
+    An explicit URL such as "http://localhost:8000" may be given instead,
+    which allows pointing the application at a local stand-in server.
+    """
+    if '://' not in server:
+        return 'https', server, 443
+    parts = urlsplit(server)
+    scheme = parts.scheme.lower()
+    if scheme not in ('http', 'https'):
+        raise ValueError('Unsupported HealthVault server scheme: '
+                '{0}'.format(scheme))
+    default_port = 443 if scheme == 'https' else 80
+    return scheme, parts.hostname, parts.port or default_port
+
+
+class ConnectionPool(object):
+    """A pool of persistent HTTP(S) connections to a single server.
+
+    Idle connections are kept for reuse, up to ``size`` of them. Connections
+    which have been idle for longer than ``idle_timeout`` seconds are closed
+    rather than reused. If ``health_check`` is ``True``, an idle connection is
+    also discarded if its socket shows that the server has closed it.
+
+    The ``stats`` dictionary counts connections that were ``created``,
+    ``reused`` and ``discarded``.
+    """
+
+    def __init__(self, server, size=10, idle_timeout=30, health_check=True):
+        self.scheme, self.host, self.port = parse_server(server)
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.stats = {'created': 0, 'reused': 0, 'discarded': 0}
+        self._idle = []  # (connection, time it was released) pairs.
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """Returns a new, unpooled connection to the server."""
+        if self.scheme == 'https':
+            conn = httplib.HTTPSConnection(self.host, self.port)
+        else:
+            conn = httplib.HTTPConnection(self.host, self.port)
+        with self._lock:
+            self.stats['created'] += 1
+        return conn
+
+    def get(self):
+        """Returns a ``(connection, reused)`` pair.
+
+        The most recently released idle connection which passes the health
+        checks is reused; otherwise a new connection is created.
+        """
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                conn, released = self._idle.pop()
+                if (now - released > self.idle_timeout or
+                        not self._is_healthy(conn)):
+                    self.stats['discarded'] += 1
+                    conn.close()
+                    continue
+                self.stats['reused'] += 1
+                return conn, True
+        return self.connect(), False
+
+    def put(self, conn):
+        """Returns a connection to the pool after a complete response."""
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                return
+            self.stats['discarded'] += 1
+        conn.close()
+
+    def discard(self, conn):
+        """Closes a connection that can't be reused."""
+        with self._lock:
+            self.stats['discarded'] += 1
+        conn.close()
+
+    def clear(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, released in idle:
+            conn.close()
+
+    def idle_count(self):
+        return len(self._idle)
+
+    def _is_healthy(self, conn):
+        if conn.sock is None:
+            return False
+        if not self.health_check:
+            return True
+        # An idle connection should have nothing to read. If its socket is
+        # readable, the server has closed it (or sent something unexpected).
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+
+def get_pool(server):
+    """Returns this process's :py:class:`ConnectionPool` for ``server``.
+
+    The pool is configured using the
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_CONNECTION_POOL_SIZE`,
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_CONNECTION_IDLE_TIMEOUT`
+    and :py:data:`~healthvaultapp.defaults.HEALTHVAULT_CONNECTION_HEALTH_CHECK`
+    settings.
+    """
+    from .utils import get_setting
+
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # Sockets inherited from a parent process must not be shared.
+            _pools.clear()
+            _pools_pid = os.getpid()
+        pool = _pools.get(server)
+        if pool is None:
+            pool = _pools[server] = ConnectionPool(server)
+    pool.size = get_setting('HEALTHVAULT_CONNECTION_POOL_SIZE')
+    pool.idle_timeout = get_setting('HEALTHVAULT_CONNECTION_IDLE_TIMEOUT')
+    pool.health_check = get_setting('HEALTHVAULT_CONNECTION_HEALTH_CHECK')
+    return pool
+
+
+def pool_stats():
+    """Returns connection counters summed over all of this process's pools.
+
+    The returned dictionary has ``created``, ``reused``, ``discarded`` and
+    ``idle`` keys.
+    """
+    stats = {'created': 0, 'reused': 0, 'discarded': 0, 'idle': 0}
+    with _pools_lock:
+        pools = _pools.values() if _pools_pid == os.getpid() else []
+    for pool in pools:
+        for key, value in pool.stats.items():
+            stats[key] += value
+        stats['idle'] += pool.idle_count()
+    return stats
+
+
+def close_pools():
+    """Closes and forgets all of this process's pooled connections."""
+    with _pools_lock:
+        pools = _pools.values()
+        _pools.clear()
+    for pool in pools:
+        pool.clear()
+
+
+def connection_status():
+    """Returns what this process has seen of the platform server's health.
+
+    The returned dictionary has the time (in seconds since the epoch) and
+    duration of the ``last_handshake`` (``handshake_seconds``), the times of
+    the ``last_success`` and ``last_error``, the ``last_error_message``, and
+    the number of ``consecutive_failures``.
+    """
+    with _status_lock:
+        return dict(_status)
+
+
+class Hedger(object):
+    """Decides when to hedge requests, by sending a second copy of a request
+    which is slower than most recent requests of the same method.
+
+    The delay before hedging is the ``percentile`` of the last ``window``
+    latencies of the method, but at least ``min_delay`` seconds. No more
+    than ``max_ratio`` of all requests are hedged.
+
+    The ``stats`` dictionary counts ``requests``, the requests which were
+    ``hedged``, and the ``hedge_wins`` where the second copy answered first.
+    """
+    min_samples = 20
+
+    def __init__(self, percentile=95, min_delay=0.05, max_ratio=0.05,
+            window=200):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.window = window
+        self.stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def record(self, method, seconds):
+        with self._lock:
+            latencies = self._latencies.get(method)
+            if latencies is None:
+                latencies = self._latencies[method] = deque(
+                        maxlen=self.window)
+            latencies.append(seconds)
+
+    def delay(self, method):
+        """Returns how long to wait for a response before hedging, or
+        ``None`` if there aren't enough samples yet.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(method, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        index = int(len(latencies) * self.percentile / 100.0)
+        return max(latencies[min(index, len(latencies) - 1)], self.min_delay)
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def allow(self):
+        """Returns ``True``, and counts the hedge, if the cap on extra load
+        allows hedging another request.
+        """
+        with self._lock:
+            if self.stats['hedged'] >= self.max_ratio * self.stats['requests']:
+                return False
+            self.stats['hedged'] += 1
+            return True
+
+
+_hedger = Hedger()
+
+
+def get_hedger():
+    """Returns this process's :py:class:`Hedger`, configured using the
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_HEDGE_PERCENTILE`,
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_HEDGE_MIN_DELAY` and
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_HEDGE_MAX_RATIO` settings.
+    """
+    from .utils import get_setting
+
+    _hedger.percentile = get_setting('HEALTHVAULT_HEDGE_PERCENTILE')
+    _hedger.min_delay = get_setting('HEALTHVAULT_HEDGE_MIN_DELAY')
+    _hedger.max_ratio = get_setting('HEALTHVAULT_HEDGE_MAX_RATIO')
+    return _hedger
+
+
+def hedge_stats():
+    """Returns the counters of this process's :py:class:`Hedger`."""
+    with _hedger._lock:
+        return dict(_hedger.stats)
+
+
+class SingleFlight(object):
+    """Runs a function only once for concurrent calls with the same key.
+
+    While a call is in flight, other calls with its key wait for it and
+    share its result, or have its exception raised. Results are shared
+    between threads, and must not be modified.
+
+    The ``stats`` dictionary counts the ``calls`` which ran the function,
+    and the calls which ``shared`` another's result.
+    """
+
+    def __init__(self):
+        self.stats = {'calls': 0, 'shared': 0}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+                self.stats['calls'] += 1
+            else:
+                self.stats['shared'] += 1
+
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error'][0], call['error'][1], call['error'][2]
+            return call['result']
+
+        try:
+            call['result'] = func(*args, **kwargs)
+        except:
+            call['error'] = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result']
+
+
+_singleflight = SingleFlight()
+
+
+def singleflight_stats():
+    """Returns the counters of this process's :py:class:`SingleFlight`."""
+    with _singleflight._lock:
+        return dict(_singleflight.stats)
+
+
+def _add_actionqs(url, actionqs):
+    """Adds ``actionqs`` to the ``targetqs`` of a HealthVault shell URL."""
+    if actionqs is None:
+        return url
+    base, query = url.split('?', 1)
+    params = parse_qsl(query)
+    params = [(key, value + '&' + urlencode({'actionqs': actionqs})
+            if key == 'targetqs' else value) for key, value in params]
+    return base + '?' + urlencode(params)
+
+
+def parse_response(body):
+    """Parses the body of a response from HealthVault.
+
+    :returns: The root :py:class:`~xml.etree.ElementTree.Element`.
+    :raises: :py:exc:`~healthvaultlib.exceptions.HealthVaultException` (or a
+        subclass) if the response's status is non-zero.
+    """
+    tree = ET.fromstring(body)
+    code = tree.find('status/code')
+    if code is None:
+        raise HealthVaultException('Response from HealthVault without a '
+                'status.')
+    status = int(code.text)
+    if status != 0:
+        msg = tree.find('status/error/message').text
+        logger.error('HealthVault error. status={0}, message={1}'.format(
+                status, msg))
+        exc_class = _get_exception_class_for(status)
+        raise exc_class('Non-success status from HealthVault API.  '
+                'Status={0}, message={1}'.format(status, msg), code=status)
+    return tree
+
+
+def _get_method(payload):
+    start = payload.find('<method>')
+    if start == -1:
+        return None
+    start += len('<method>')
+    return payload[start:payload.find('</method>', start)]
+
+
+class HealthVaultConn(BaseHealthVaultConn):
+    """A :py:class:`~healthvaultlib.healthvault.HealthVaultConn` which sends
+    its requests over persistent connections shared by the whole process.
+
+    It also records the ``person_id`` of the person who authorized us when
+    it looks up their record, and can access a record offline: given an
+    ``offline_person_id`` instead of a ``wctoken``, requests are
+    authenticated with the application's credentials on behalf of that
+    person. The application must be granted offline access in its
+    HealthVault configuration.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.offline_person_id = kwargs.pop('offline_person_id', None)
+        self.person_id = self.offline_person_id
+        super(HealthVaultConn, self).__init__(*args, **kwargs)
+
+    def _get_auth_token(self):
+        start = time.time()
+        with timing.timed_exclusive(timing.SIGNING):
+            token = super(HealthVaultConn, self)._get_auth_token()
+        with _status_lock:
+            _status['last_handshake'] = time.time()
+            _status['handshake_seconds'] = time.time() - start
+        return token
+
+    def _send_request(self, payload):
+        """Sends ``payload`` to HealthVault, returning
+        ``(response, body, tree)`` like the base implementation.
+        """
+        if getattr(self, '_building', False):
+            return payload
+        try:
+            with timing.timed(timing.NETWORK):
+                response, body = self._hedged_exchange(payload)
+        except (HealthVaultHTTPException, httplib.HTTPException,
+                socket.error) as e:
+            with _status_lock:
+                _status['last_error'] = time.time()
+                _status['last_error_message'] = unicode(e)
+                _status['consecutive_failures'] += 1
+            raise
+        with _status_lock:
+            _status['last_success'] = time.time()
+            _status['consecutive_failures'] = 0
+
+        with timing.timed(timing.PARSING):
+            tree = parse_response(body)
+        return (response, body, tree)
+
+    def _build_and_send_request(self, method_name, info, method_version=1,
+            use_record_id=True, use_target_person_id=False,
+            use_wctoken=True):
+        """Like the base implementation, but authenticates as
+        ``offline_person_id``, if set, in place of the ``wctoken``.
+
+        If :py:data:`~healthvaultapp.defaults.HEALTHVAULT_SINGLE_FLIGHT` is
+        ``True``, concurrent identical idempotent requests for a record
+        share one request, and its result, through :py:class:`SingleFlight`.
+        """
+        from .utils import get_setting
+
+        args = (method_name, info, method_version, use_record_id,
+                use_target_person_id, use_wctoken)
+        if (method_name not in IDEMPOTENT_METHODS or
+                getattr(self, '_building', False) or
+                not get_setting('HEALTHVAULT_SINGLE_FLIGHT')):
+            return self._sign_and_send(*args)
+        # Requests are identical if they would get the same response: for
+        # the same record, on behalf of the same user.
+        key = (self.server, self.record_id if use_record_id else None,
+                self.person_id if use_target_person_id else None,
+                (self.offline_person_id or self.wctoken) if use_wctoken
+                else None, method_name, method_version, info)
+        return _singleflight.do(key, self._sign_and_send, *args)
+
+    def _sign_and_send(self, method_name, info, method_version,
+            use_record_id, use_target_person_id, use_wctoken):
+        # Time spent in _send_request is recorded as network and parsing.
+        with timing.timed_exclusive(timing.SIGNING):
+            if not use_wctoken or self.offline_person_id is None:
+                return super(HealthVaultConn, self)._build_and_send_request(
+                        method_name, info, method_version, use_record_id,
+                        use_target_person_id, use_wctoken)
+            payload = self._build_offline_request(method_name, info,
+                    method_version, use_record_id, use_target_person_id)
+        return self._send_request(payload)
+
+    def _build_offline_request(self, method_name, info, method_version,
+            use_record_id, use_target_person_id):
+        """Returns the signed payload of a request authenticated as
+        ``offline_person_id``.
+
+        The base implementation can only authenticate with the ``wctoken``,
+        so this builds the request as python-healthvault 0.1's
+        ``_build_and_send_request`` does, the version required in
+        ``requirements/base.txt``, with ``<offline-person-info>`` in place
+        of ``<user-auth-token>``. Check it against the library when that
+        requirement changes.
+        """
+        header = ('<header><method>' + method_name + '</method>'
+                '<method-version>' + str(method_version) + '</method-version>')
+        if use_target_person_id:
+            if self.person_id is None:
+                raise ValueError('person ID is not available but '
+                        'use_target_person_id is True')
+            header += ('<target-person-id>' + self.person_id +
+                    '</target-person-id>')
+        if use_record_id:
+            if self.record_id is None:
+                raise ValueError('record ID is not available but '
+                        'use_record_id is True')
+            header += '<record-id>' + self.record_id + '</record-id>'
+        infodigest = base64.encodestring(hashlib.sha1(info).digest())
+        header += ('<auth-session><auth-token>' + self.auth_token +
+                '</auth-token><offline-person-info><offline-person-id>' +
+                self.offline_person_id + '</offline-person-id>'
+                '</offline-person-info></auth-session>'
+                '<language>en</language><country>US</country>'
+                '<msg-time>' + _msg_time() + '</msg-time>'
+                '<msg-ttl>36000</msg-ttl>'
+                '<version>' + HEALTHVAULT_VERSION + '</version>'
+                '<info-hash><hash-data algName="SHA1">' +
+                infodigest.strip() + '</hash-data></info-hash>'
+                '</header>')
+
+        digest = hmac.new(self.sharedsec, header, hashlib.sha1).digest()
+        return ('<wc-request:request xmlns:wc-request='
+                '"urn:com.microsoft.wc.request"><auth>'
+                '<hmac-data algName="HMACSHA1">' +
+                base64.encodestring(digest).strip() +
+                '</hmac-data></auth>' + header + info +
+                '</wc-request:request>')
+
+    def _get_record_id(self):
+        """Like the base implementation, but also sets ``person_id``."""
+        if self.record_id:
+            return self.record_id
+        response, body, tree = self._build_and_send_request('GetPersonInfo',
+                '<info/>', use_record_id=False)
+        person_info = tree.find(GETPERSONINFO_INFO + '/person-info')
+        record_id = None
+        if person_info is not None:
+            self.person_id = person_info.findtext('person-id')
+            record_id = person_info.findtext('selected-record-id')
+        if record_id is None:
+            logger.error('No record ID in response.  response={0}'.format(
+                    body))
+            raise HealthVaultException('selected record ID not found in HV '
+                    'response ({0})'.format(body))
+        return record_id
+
+    def build_request(self, method_name, info, **kwargs):
+        """Returns the signed payload of a request to HealthVault, without
+        sending it. Takes the same arguments as ``_build_and_send_request``.
+        """
+        self._building = True
+        try:
+            return self._build_and_send_request(method_name, info, **kwargs)
+        finally:
+            self._building = False
+
+    def _hedged_exchange(self, payload):
+        """Calls :py:meth:`_exchange`, hedging the request if
+        :py:data:`~healthvaultapp.defaults.HEALTHVAULT_HEDGE` is ``True`` and
+        it is idempotent.
+        """
+        from .utils import get_setting
+
+        method = _get_method(payload)
+        if (method not in IDEMPOTENT_METHODS or
+                not get_setting('HEALTHVAULT_HEDGE')):
+            return self._exchange(payload)
+
+        hedger = get_hedger()
+        hedger.count('requests')
+        delay = hedger.delay(method)
+        if delay is None:
+            start = time.time()
+            result = self._exchange(payload)
+            hedger.record(method, time.time() - start)
+            return result
+
+        results = Queue.Queue()
+
+        def attempt(number):
+            start = time.time()
+            try:
+                result = self._exchange(payload)
+            except Exception:
+                results.put((number, False, sys.exc_info()))
+            else:
+                hedger.record(method, time.time() - start)
+                results.put((number, True, result))
+
+        self._start_attempt(attempt, 0)
+        outstanding = 1
+        try:
+            number, ok, value = results.get(timeout=delay)
+        except Queue.Empty:
+            if hedger.allow():
+                self._start_attempt(attempt, 1)
+                outstanding += 1
+            number, ok, value = results.get()
+        outstanding -= 1
+        # A failed attempt only fails the request if no other is outstanding.
+        if not ok and outstanding:
+            number, ok, value = results.get()
+        if not ok:
+            raise value[0], value[1], value[2]
+        if number == 1:
+            hedger.count('hedge_wins')
+        return value
+
+    def _start_attempt(self, attempt, number):
+        thread = threading.Thread(target=attempt, args=(number,))
+        thread.daemon = True
+        thread.start()
+
+    def _exchange(self, payload):
+        """Posts ``payload`` over a pooled connection, returning the
+        ``(response, body)`` of a successful HTTP response.
+        """
+        pool = get_pool(self.server)
+        conn, reused = pool.get()
+        sent = False
+        try:
+            conn.request('POST', PLATFORM_PATH, payload,
+                    {'Content-Type': 'text/xml'})
+            sent = True
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            pool.discard(conn)
+            # The server may close an idle connection at any time, so retry
+            # once on a fresh connection, unless the server may have acted on
+            # a request which isn't safe to repeat.
+            if not reused or (sent and
+                    _get_method(payload) not in IDEMPOTENT_METHODS):
+                raise
+            logger.debug('Retrying HealthVault request on a new connection.')
+            conn = pool.connect()
+            try:
+                response = self._post(conn, payload)
+            except (httplib.HTTPException, socket.error):
+                pool.discard(conn)
+                raise
+
+        try:
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            pool.discard(conn)
+            raise
+        if response.will_close:
+            pool.discard(conn)
+        else:
+            pool.put(conn)
+
+        if response.status != 200:
+            msg = 'Non-success HTTP response status from HealthVault.  ' \
+                    'Status={0}, message={1}'.format(response.status,
+                    response.reason)
+            logger.error(msg)
+            raise HealthVaultHTTPException(msg, code=response.status)
+        return response, body
+
+    def _post(self, conn, payload):
+        conn.request('POST', PLATFORM_PATH, payload,
+                {'Content-Type': 'text/xml'})
+        return conn.getresponse()
+
+    def authorization_url(self, callback_url=None, record_id=None,
+            actionqs=None):
+        """Like the base implementation, but HealthVault passes ``actionqs``,
+        if given, back to the ActionURL in the ``actionqs`` GET parameter.
+        """
+        url = super(HealthVaultConn, self).authorization_url(callback_url,
+                record_id)
+        return _add_actionqs(url, actionqs)
+
+    def deauthorization_url(self, callback_url=None, actionqs=None):
+        """Like the base implementation, but HealthVault passes ``actionqs``,
+        if given, back to the ActionURL in the ``actionqs`` GET parameter.
+        """
+        url = super(HealthVaultConn, self).deauthorization_url(callback_url)
+        return _add_actionqs(url, actionqs)
+
+    def remove_authorization(self):
+        """Removes this application's authorization to access the record.
+
+        This uses `RemoveApplicationRecordAuthorization
+        <https://platform.healthvault-ppe.com/platform/XSD/method-removeapplicationrecordauthorization.xsd>`_.
+        """
+        self._build_and_send_request('RemoveApplicationRecordAuthorization',
+                '<info/>')
@@ -1,6 +1,3 @@
-from django.conf import settings
-
-
 HEALTHVAULT_APP_ID = None
 """
 The UUID of your application, assigned by HealthVault when you create your
@@ -43,6 +40,9 @@ HEALTHVAULT_SERVER = None
 The server address at which to reach HealthVault. For example, the
 pre-production server is "platform.healthvault-ppe.com" in the United States
 and "platform.healthvault-ppe.co.uk" in Europe. For production, drop the "ppe".
+
+A bare host name is reached over HTTPS on port 443. You may instead give a URL
+such as "http://localhost:8000" to talk to a local stand-in server.
 """
 
 
@@ -53,10 +53,10 @@ shell server is "account.healthvault-ppe.com" in the United States.
 """
 
 
-HEALTHVAULT_IN_DEVELOPMENT = getattr(settings, 'DEBUG', True)
+HEALTHVAULT_IN_DEVELOPMENT = None
 """
-Set this to False when your HealthVault project is operating in production. It
-defaults to :py:data:`settings.DEBUG`.
+Set this to False when your HealthVault project is operating in production. If
+``None``, :py:data:`settings.DEBUG` is used.
 
 This setting determines whether to pass a test callback URL to HealthVault. In
 production, the shell server will always redirect to the application's
@@ -89,3 +89,300 @@ The template to use when an unavoidable error occurs during HealthVault
 integration. This is rendered by the :py:func:`error <healthvaultapp.views.error>`
 view.
 """
+
+
+HEALTHVAULT_CONNECTION_POOL_SIZE = 10
+"""
+The maximum number of idle, persistent connections to
+:py:data:`HEALTHVAULT_SERVER` that each process keeps for reuse. Reusing a
+connection saves the TCP and TLS handshakes of a new one. Set this to 0 to
+close every connection after a single request.
+"""
+
+
+HEALTHVAULT_CONNECTION_IDLE_TIMEOUT = 30
+"""
+The number of seconds a persistent connection may sit idle before it is
+closed rather than reused.
+"""
+
+
+HEALTHVAULT_CONNECTION_HEALTH_CHECK = True
+"""
+Whether to check that an idle connection hasn't been closed by the server
+before reusing it.
+"""
+
+
+HEALTHVAULT_HEALTH_FAILURE_THRESHOLD = 3
+"""
+The number of consecutive failed requests to HealthVault after which the
+:py:func:`health <healthvaultapp.views.health>` view reports HealthVault as
+unreachable.
+"""
+
+
+HEALTHVAULT_HEALTH_PROBE = False
+"""
+Whether the :py:func:`health <healthvaultapp.views.health>` view should
+include the result of a live handshake with HealthVault.
+"""
+
+
+HEALTHVAULT_HEALTH_PROBE_INTERVAL = 30
+"""
+The number of seconds for which a live probe result is cached, in Django's
+cache, before HealthVault is probed again.
+"""
+
+
+HEALTHVAULT_TIMING_SAMPLE_RATE = 0.01
+"""
+The fraction of requests, between 0.0 and 1.0, which the
+:py:class:`~healthvaultapp.middleware.ServerTimingMiddleware` measures.
+Measured requests log their database queries, so the default keeps the
+overhead negligible in production. Set it to 1.0 in development to measure
+every request.
+"""
+
+
+HEALTHVAULT_TIMING_LOG = False
+"""
+Whether the :py:class:`~healthvaultapp.middleware.ServerTimingMiddleware`
+logs the timings of each measured request. The log record's
+``healthvault_timing`` attribute holds the timings in seconds.
+"""
+
+
+HEALTHVAULT_HEDGE = False
+"""
+Whether to hedge idempotent requests, such as GetPersonInfo and GetThings,
+to cut tail latency. If a response takes longer than most recent responses
+to the same kind of request, an identical request is sent and the first
+response to arrive is used.
+"""
+
+
+HEALTHVAULT_HEDGE_PERCENTILE = 95
+"""
+The percentile of recent response times after which a hedged request is
+sent.
+"""
+
+
+HEALTHVAULT_HEDGE_MIN_DELAY = 0.05
+"""
+The minimum number of seconds to wait for a response before sending a hedged
+request.
+"""
+
+
+HEALTHVAULT_HEDGE_MAX_RATIO = 0.05
+"""
+The largest fraction of requests which may be hedged, capping the extra load
+that hedging puts on HealthVault.
+"""
+
+
+HEALTHVAULT_SINGLE_FLIGHT = True
+"""
+Whether concurrent identical idempotent requests for a record, such as from
+several threads rendering the same user's dashboard, share a single request
+to HealthVault and its result.
+"""
+
+
+HEALTHVAULT_NOTIFICATION_KEYS = {}
+"""
+The shared keys with which HealthVault signs eventing notifications sent to
+the :py:func:`notify <healthvaultapp.views.notify>` view, as a dictionary
+of key ids to keys. Notifications are rejected unless they are signed with
+one of these keys.
+"""
+
+
+HEALTHVAULT_NOTIFICATION_DEDUPE_SECONDS = 60
+"""
+The number of seconds during which further notifications for the same record
+and data type don't request another sync.
+"""
+
+
+HEALTHVAULT_WATERMARK_TIMEOUT = 86400
+"""
+The number of seconds for which the watermarks of
+:py:func:`~healthvaultapp.watermarks.watermark_condition` are cached. Once
+one expires, it is taken to be the time it is next read, so changes which
+weren't noticed are picked up within this time. If ``None``, watermarks are
+kept until they are evicted.
+"""
+
+
+HEALTHVAULT_NEXT_IN_STATE = False
+"""
+Whether the URL to redirect to after authorization or deauthorization is
+signed and passed through HealthVault in the ``actionqs`` parameter, rather
+than stored in the session. This saves a session write on each leg of the
+integration flow, and works with read-only or cookie-based sessions.
+"""
+
+
+HEALTHVAULT_NEXT_MAX_AGE = 3600
+"""
+The number of seconds for which a signed next URL is accepted, if
+:py:data:`HEALTHVAULT_NEXT_IN_STATE` is ``True``.
+"""
+
+
+HEALTHVAULT_NEXT_ALLOWED_HOSTS = []
+"""
+Hosts other than the current site's to which users may be redirected after
+authorization or deauthorization, if :py:data:`HEALTHVAULT_NEXT_IN_STATE` is
+``True``. Next URLs pointing elsewhere are ignored.
+"""
+
+
+HEALTHVAULT_READ_DATABASE = None
+"""
+The database alias to which
+:py:class:`~healthvaultapp.routers.HealthVaultRouter` sends reads of
+:py:class:`~healthvaultapp.models.HealthVaultUser`, such as a read replica.
+If ``None``, reads go to the default database.
+"""
+
+
+HEALTHVAULT_REPLICA_PIN_SECONDS = 5
+"""
+The number of seconds after a write of a
+:py:class:`~healthvaultapp.models.HealthVaultUser` during which
+:py:class:`~healthvaultapp.routers.HealthVaultRouter` sends reads to the
+default database. This should comfortably exceed your replication lag.
+"""
+
+
+HEALTHVAULT_USER_CACHE_SIZE = 0
+"""
+The number of :py:class:`~healthvaultapp.models.HealthVaultUser` rows which
+each process keeps in memory for
+:py:func:`~healthvaultapp.utils.get_healthvault_user` and
+:py:func:`~healthvaultapp.utils.is_integrated`, evicting the least recently
+used. If 0, rows aren't cached. The cache relies on Django's cache being
+shared between processes to see other processes' changes.
+"""
+
+
+HEALTHVAULT_USER_CACHE_TTL = 300
+"""
+The maximum number of seconds for which a row is kept in the in-process user
+cache.
+"""
+
+
+HEALTHVAULT_USER_CACHE_REVALIDATE = 5
+"""
+The number of seconds for which a cached row is used before checking that it
+hasn't been changed by another process. This bounds how long a revocation in
+another process can go unnoticed.
+"""
+
+
+HEALTHVAULT_TOKEN_LIFETIME = None
+"""
+The number of seconds for which a user's ``wctoken`` is valid after it is
+issued, if known. If ``None``, a token is only known to have expired once
+HealthVault says so.
+"""
+
+
+HEALTHVAULT_TOKEN_MAX_FAILURES = 5
+"""
+The number of consecutive failed HealthVault calls with a user's token after
+which it is no longer used, until the user authorizes us again. If ``None``,
+tokens are used however often they fail.
+"""
+
+
+HEALTHVAULT_THINGS_PAGE_SIZE = 240
+"""
+The number of things which :py:func:`~healthvaultapp.things.get_things`
+requests by key at a time, once HealthVault has left some of a group's
+things unprocessed. Things which HealthVault still leaves unprocessed are
+requested again, so this needn't match the platform's limit exactly.
+"""
+
+
+HEALTHVAULT_THINGS_WORKERS = 4
+"""
+The maximum number of concurrent requests which
+:py:func:`~healthvaultapp.things.get_things` makes for the pages of a
+group.
+"""
+
+
+HEALTHVAULT_PREFETCH_DATATYPES = ()
+"""
+The data types whose things are fetched into Django's cache in the
+background as soon as a user authorizes us, so that the first page they are
+redirected to needn't wait for HealthVault (see
+:py:func:`~healthvaultapp.things.prefetch_things`). Nothing is prefetched
+by default.
+"""
+
+
+HEALTHVAULT_PREFETCH_TIMEOUT = 300
+"""
+The number of seconds for which prefetched things are cached.
+"""
+
+
+HEALTHVAULT_PREFETCH_MAX = 240
+"""
+The most things of each data type which are prefetched, the most recent
+first, so that a user with a long history doesn't fill the cache. If
+``None``, all of them are.
+"""
+
+
+HEALTHVAULT_PREFETCH_WORKERS = 2
+"""
+The number of threads in each process which prefetch things. Further
+prefetches wait for a free thread.
+"""
+
+
+HEALTHVAULT_ARCHIVE_COMPACT_DAYS = 31
+"""
+The number of days after which :py:func:`~healthvaultapp.archive.compact`
+rolls archived things into compressed monthly chunks.
+"""
+
+
+HEALTHVAULT_ARCHIVE_RETENTION_DAYS = None
+"""
+The number of days for which archived things are kept. A monthly chunk is
+deleted once all of its month is past this window. If ``None``, archived
+things are kept forever.
+"""
+
+
+HEALTHVAULT_ARCHIVE_BLOCK_SIZE = 65536
+"""
+The number of bytes of XML which are compressed together in archive chunks.
+Larger blocks compress better, but reading a single thing decompresses its
+whole block.
+"""
+
+
+HEALTHVAULT_EXPORT_SERIES = {
+    'weight': ('3d34d87e-7fc1-4153-800f-f56592cb0d17', 'kg'),
+    'height': ('40750a6a-89b2-455c-bd8d-b420a4cb500b', 'value.m'),
+    'blood_glucose': ('879e7c04-4e8a-4707-9ad3-b054df467ce4',
+            'value.mmolperl'),
+    'systolic': ('ca3c57f4-f4c1-4e15-be67-0a3caf5414ed', 'systolic'),
+    'diastolic': ('ca3c57f4-f4c1-4e15-be67-0a3caf5414ed', 'diastolic'),
+}
+"""
+The time series which :py:func:`~healthvaultapp.export.export_series` and
+the ``healthvault_export`` command write by default: ``(datatype, field)``
+tuples keyed by the name of each series.
+"""
@@ -0,0 +1,200 @@
+import itertools
+import logging
+import os
+import shutil
+import xml.etree.ElementTree as ET
+
+from healthvaultlib.exceptions import HealthVaultException
+from healthvaultlib.xmlutils import parse_group
+
+from . import archive
+from .rollups import get_value
+from .utils import chunks, get_setting, import_numpy
+
+
+# Arrays of an exported series, and their types.
+COLUMNS = (('when', 'datetime64[s]'), ('record', 'int32'),
+        ('value', 'float64'))
+
+# Array of the record IDs which the ``record`` column indexes into.
+RECORDS = 'records'
+
+# Errors of archived things which python-healthvault can't parse, such as
+# things missing an element or with malformed values.
+PARSE_ERRORS = (HealthVaultException, ET.ParseError, ValueError, TypeError,
+        AttributeError)
+
+
+class SeriesWriter(object):
+    """
+    Writes one time series of measurements as NumPy arrays into the directory
+    ``path``, a chunk at a time:
+
+    ``when.npy``
+        The time of each measurement, as ``datetime64[s]``.
+    ``record.npy``
+        The index in ``records.npy`` of the record of each measurement.
+    ``value.npy``
+        Each measured value, as ``float64``.
+    ``records.npy``
+        The IDs of the records, in the order they were first seen.
+
+    Chunks are appended to the raw data of each column, so only one chunk is
+    ever held in memory, and the ``.npy`` files are written by
+    :py:meth:`close`.
+    """
+
+    def __init__(self, path):
+        self.numpy = import_numpy()
+        self.path = path
+        self.count = 0
+        self.records = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.files = [open(self._raw_path(name), 'wb')
+                for name, dtype in COLUMNS]
+
+    def _raw_path(self, name):
+        return os.path.join(self.path, name + '.raw')
+
+    def write(self, measurements):
+        """Appends ``(record_id, when, value)`` measurements."""
+        when, record, value = [], [], []
+        for record_id, time, measured in measurements:
+            when.append(time)
+            record.append(self.records.setdefault(record_id,
+                    len(self.records)))
+            value.append(measured)
+        for data, (name, dtype), f in zip((when, record, value), COLUMNS,
+                self.files):
+            self.numpy.array(data, dtype=dtype).tofile(f)
+        self.count += len(value)
+
+    def close(self):
+        """Writes the ``.npy`` files of the series, and returns the number of
+        measurements in it."""
+        for (name, dtype), f in zip(COLUMNS, self.files):
+            f.close()
+            self._write_npy(name, dtype)
+        records = sorted(self.records, key=self.records.get)
+        self.numpy.save(os.path.join(self.path, RECORDS + '.npy'),
+                self.numpy.array(records, dtype='U36'))
+        return self.count
+
+    def discard(self):
+        """Closes and removes the raw data of the columns which is left, such
+        as after an error. Does nothing once :py:meth:`close` is done."""
+        for (name, dtype), f in zip(COLUMNS, self.files):
+            f.close()
+            if os.path.exists(self._raw_path(name)):
+                os.remove(self._raw_path(name))
+
+    def _write_npy(self, name, dtype):
+        """Prefixes the raw data of a column with a ``.npy`` header."""
+        npy_format = self.numpy.lib.format
+        header = {
+            'descr': npy_format.dtype_to_descr(self.numpy.dtype(dtype)),
+            'fortran_order': False,
+            'shape': (self.count,),
+        }
+        raw_path = self._raw_path(name)
+        with open(os.path.join(self.path, name + '.npy'), 'wb') as f:
+            npy_format.write_array_header_1_0(f, header)
+            with open(raw_path, 'rb') as raw:
+                shutil.copyfileobj(raw, f)
+        os.remove(raw_path)
+
+
+def load_series(path, mmap_mode='r'):
+    """
+    Returns a dictionary of the arrays of a series written by
+    :py:func:`export_series`, keyed by ``when``, ``record``, ``value`` and
+    ``records``. The columns are memory-mapped with ``mmap_mode`` (see
+    :py:func:`numpy.load`), so they aren't read until they are used.
+    """
+    numpy = import_numpy()
+    arrays = dict((name, numpy.load(os.path.join(path, name + '.npy'),
+            mmap_mode=mmap_mode)) for name, dtype in COLUMNS)
+    arrays[RECORDS] = numpy.load(os.path.join(path, RECORDS + '.npy'))
+    return arrays
+
+
+def export_series(directory, series=None, chunk_size=10000):
+    """
+    Exports the archived things (see :py:mod:`healthvaultapp.archive`) as
+    column-oriented time series of NumPy arrays, for analysis outside of
+    the database. Each series is written to a subdirectory of ``directory``
+    by a :py:class:`SeriesWriter`, and can be loaded with
+    :py:func:`load_series`.
+
+    The archive is read once for each data type, and ``chunk_size`` things
+    are parsed at a time. Things without a time or value are left out, and
+    things which can't be parsed are logged and left out. If the export
+    fails, the raw data of the series being written is removed.
+
+    :param series: A dictionary of ``(datatype, field)`` tuples keyed by the
+        names of the series. ``field`` is a field of the things as parsed by
+        python-healthvault, as for :py:func:`~healthvaultapp.rollups.get_value`.
+        Defaults to
+        :py:data:`~healthvaultapp.defaults.HEALTHVAULT_EXPORT_SERIES`.
+    :returns: A dictionary of the number of measurements in each series.
+    """
+    if series is None:
+        series = get_setting('HEALTHVAULT_EXPORT_SERIES')
+    datatypes = {}
+    for name, (datatype, field) in series.items():
+        datatypes.setdefault(datatype, []).append((name, field))
+
+    counts = {}
+    for datatype, fields in datatypes.items():
+        writers = []
+        try:
+            for name, field in fields:
+                writers.append((name,
+                        SeriesWriter(os.path.join(directory, name)), field))
+            things = archive.iter_archived_things(datatype)
+            for chunk in chunks(things, chunk_size):
+                parsed = list(_parse_things(chunk))
+                for name, writer, field in writers:
+                    writer.write(_measurements(parsed, field))
+            for name, writer, field in writers:
+                counts[name] = writer.close()
+        finally:
+            for name, writer, field in writers:
+                writer.discard()
+    return counts
+
+
+def _parse_things(things):
+    """Yields ``(record_id, thing)`` for ``(record_id, xml)`` things, parsing
+    consecutive things of a record together. If a group fails to parse, its
+    things are parsed one at a time, and those which fail are logged and
+    left out."""
+    logger = logging.getLogger('healthvaultapp.export.export_series')
+    for record_id, group in itertools.groupby(things, lambda thing: thing[0]):
+        xmls = [thing[1] for thing in group]
+        try:
+            parsed = _parse_group(xmls)
+        except PARSE_ERRORS:
+            parsed = []
+            for xml in xmls:
+                try:
+                    parsed.extend(_parse_group([xml]))
+                except PARSE_ERRORS:
+                    logger.exception('Unable to parse an archived thing of '
+                            'record {0}: {1}'.format(record_id, xml))
+        for thing in parsed:
+            yield record_id, thing
+
+
+def _parse_group(xmls):
+    element = ET.fromstring(u'<group>{0}</group>'.format(u''.join(xmls))
+            .encode('utf-8'))
+    return parse_group(element)
+
+
+def _measurements(things, field):
+    for record_id, thing in things:
+        value = get_value(thing, field)
+        if thing.get('when') is not None and value is not None:
+            yield record_id, thing['when'], value
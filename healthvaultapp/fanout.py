@@ -0,0 +1,516 @@
+from collections import deque
+import errno
+import httplib
+from multiprocessing import Pool
+import os
+import select
+import socket
+import ssl
+import time
+import xml.etree.ElementTree as ET
+
+from django.utils import timezone
+
+from healthvaultlib.exceptions import (HealthVaultException,
+        HealthVaultHTTPException)
+
+from .connection import parse_response, parse_server, PLATFORM_PATH
+from .things import build_group, GETTHINGS_INFO, parse_things
+from .utils import (_unusable_token_error, chunks, create_connection,
+        create_offline_connection, get_setting, is_token_usable)
+
+
+# States of a _Channel.
+CONNECTING, HANDSHAKING, SENDING, RECEIVING = range(4)
+
+# Errors which mean that a non-blocking socket operation should be retried
+# once the socket is ready.
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+# Errors of responses which HealthVault failed, or which aren't the XML we
+# expect, including things which python-healthvault can't parse because
+# they are missing an element or have malformed values.
+RESPONSE_ERRORS = (HealthVaultException, ET.ParseError, ValueError,
+        TypeError, AttributeError)
+
+
+class _Response(object):
+    """Incrementally parses an HTTP/1.1 response fed to it in pieces."""
+
+    def __init__(self):
+        self.status = None
+        self.will_close = False
+        self.body = None
+        self._head = ''
+        self._length = None
+        self._chunked = False
+        self._buffer = ''
+        self._pieces = []
+        self._received = 0
+
+    def feed(self, data):
+        """Adds ``data`` to the response, returning ``True`` once the
+        response is complete."""
+        if self.status is None:
+            self._head += data
+            end = self._head.find('\r\n\r\n')
+            if end == -1:
+                return False
+            data = self._head[end + 4:]
+            self._parse_head(self._head[:end])
+        if self._chunked:
+            self._buffer += data
+            return self._feed_chunks()
+        self._pieces.append(data)
+        self._received += len(data)
+        if self._length is not None and self._received >= self._length:
+            self.body = ''.join(self._pieces)[:self._length]
+            return True
+        return False
+
+    def finish(self):
+        """Called when the server closes the connection. Returns ``True`` if
+        that completes the response."""
+        if self.status is None or self._chunked or self._length is not None:
+            return False
+        self.body = ''.join(self._pieces)
+        return True
+
+    def _parse_head(self, head):
+        lines = head.split('\r\n')
+        version, status = lines[0].split(' ', 2)[:2]
+        self.status = int(status)
+        headers = {}
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip().lower()
+        self.will_close = (version == 'HTTP/1.0' or
+                headers.get('connection') == 'close')
+        if 'chunked' in headers.get('transfer-encoding', ''):
+            self._chunked = True
+        elif 'content-length' in headers:
+            self._length = int(headers['content-length'])
+        else:
+            # The body runs until the server closes the connection.
+            self.will_close = True
+
+    def _feed_chunks(self):
+        while True:
+            end = self._buffer.find('\r\n')
+            if end == -1:
+                return False
+            size = int(self._buffer[:end].split(';')[0], 16)
+            if size == 0:
+                # Wait for the blank line after any trailers.
+                if self._buffer[end:end + 4] != '\r\n\r\n' and \
+                        self._buffer.find('\r\n\r\n', end) == -1:
+                    return False
+                self.body = ''.join(self._pieces)
+                return True
+            if len(self._buffer) < end + 2 + size + 2:
+                return False
+            self._pieces.append(self._buffer[end + 2:end + 2 + size])
+            self._buffer = self._buffer[end + 2 + size + 2:]
+
+
+class _Channel(object):
+    """A non-blocking, keep-alive connection to HealthVault, which sends one
+    request at a time."""
+
+    def __init__(self, scheme, host, address):
+        self.scheme = scheme
+        self.host = host
+        self.address = address
+        self.sock = None
+        self.key = self.payload = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def start(self, key, payload, timeout):
+        """Starts sending ``payload``, opening a connection if needed."""
+        self.key = key
+        self.payload = payload
+        self.deadline = time.time() + timeout
+        self.response = _Response()
+        self.received = False
+        self.reused = self.sock is not None
+        self.outgoing = ('POST {0} HTTP/1.1\r\n'
+                'Host: {1}\r\n'
+                'Content-Type: text/xml\r\n'
+                'Content-Length: {2}\r\n'
+                '\r\n'.format(PLATFORM_PATH, self.host, len(payload)) +
+                payload)
+        if self.reused:
+            self.state, self.want = SENDING, 'w'
+            return
+        family, sockaddr = self.address
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        error = self.sock.connect_ex(sockaddr)
+        if error and error not in WOULD_BLOCK:
+            raise socket.error(error, os.strerror(error))
+        self.state, self.want = CONNECTING, 'w'
+
+    def has_pending(self):
+        """Whether decrypted data is waiting, which select() won't see."""
+        return (self.state == RECEIVING and
+                isinstance(self.sock, ssl.SSLSocket) and
+                self.sock.pending() > 0)
+
+    def step(self):
+        """Advances the request as far as possible without blocking.
+        Returns ``True`` once the whole response has been received."""
+        try:
+            return self._step()
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.want = 'r'
+                return False
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.want = 'w'
+                return False
+            raise
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return False
+            raise
+
+    def _step(self):
+        if self.state == CONNECTING:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            if self.scheme == 'https':
+                self.sock = _wrap_socket(self.sock, self.host)
+                self.state = HANDSHAKING
+            else:
+                self.state = SENDING
+        if self.state == HANDSHAKING:
+            self.sock.do_handshake()
+            self.state = SENDING
+        if self.state == SENDING:
+            self.want = 'w'
+            while self.outgoing:
+                sent = self.sock.send(self.outgoing)
+                self.outgoing = self.outgoing[sent:]
+            self.state = RECEIVING
+        self.want = 'r'
+        while True:
+            data = self.sock.recv(65536)
+            if not data:
+                if self.response.finish():
+                    return True
+                raise httplib.IncompleteRead(
+                        ''.join(self.response._pieces))
+            self.received = True
+            if self.response.feed(data):
+                return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def _wrap_socket(sock, host):
+    if hasattr(ssl, 'create_default_context'):
+        # Verify certificates as httplib does in Python 2.7.9+.
+        context = ssl.create_default_context()
+        return context.wrap_socket(sock, server_hostname=host,
+                do_handshake_on_connect=False)
+    return ssl.wrap_socket(sock, do_handshake_on_connect=False)
+
+
+def fan_out(requests, server=None, concurrency=100, timeout=60, parse=True):
+    """
+    Sends many requests to HealthVault concurrently from a single thread,
+    using non-blocking sockets, and yields their results as they arrive.
+
+    Unlike threads over blocking connections, each request in flight costs
+    only a socket and a small buffer, so one process can keep hundreds of
+    requests in flight. Requests are taken from ``requests`` only as slots
+    free up, so it may be a lazy iterator over any number of requests.
+    Connections are kept alive and reused for further requests; a request
+    which fails on a reused connection before any response arrives is
+    retried once on a new one.
+
+    :param requests: An iterable of ``(key, payload)`` tuples, where
+        ``payload`` is a signed request from
+        :py:meth:`HealthVaultConn.build_request
+        <healthvaultapp.connection.HealthVaultConn.build_request>`.
+    :param server: Defaults to the
+        :py:data:`~healthvaultapp.defaults.HEALTHVAULT_SERVER` setting.
+    :param concurrency: The most requests in flight at once. With
+        ``select()``, this must stay well below the process's limit of 1024
+        file descriptors.
+    :param timeout: Seconds after which a request fails with
+        :py:exc:`socket.timeout`.
+    :param parse: If ``False``, the bodies of successful responses are
+        yielded unparsed, for parsing elsewhere.
+    :returns: An iterator of ``(key, tree, error)`` tuples, in the order in
+        which responses arrive. ``tree`` is the parsed response, or ``None``
+        if the request failed with the exception ``error``.
+    """
+    scheme, host, port = parse_server(server or
+            get_setting('HEALTHVAULT_SERVER'))
+    family, _, _, _, sockaddr = socket.getaddrinfo(host, port, 0,
+            socket.SOCK_STREAM)[0]
+    address = (family, sockaddr)
+
+    requests = iter(requests)
+    exhausted = False
+    retries = deque()
+    idle = []
+    active = {}
+    try:
+        while True:
+            # Fill free slots, retrying failed requests first.
+            while len(active) < concurrency and (retries or not exhausted):
+                if retries:
+                    key, payload = retries.popleft()
+                    # Retry on a new connection.
+                    channel = _Channel(scheme, host, address)
+                else:
+                    try:
+                        key, payload = next(requests)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    channel = idle.pop() if idle else \
+                            _Channel(scheme, host, address)
+                try:
+                    channel.start(key, payload, timeout)
+                except Exception as e:
+                    channel.close()
+                    yield key, None, e
+                    continue
+                active[channel.fileno()] = channel
+            if not active:
+                return
+
+            now = time.time()
+            pending = [fd for fd, channel in active.items()
+                    if channel.has_pending()]
+            readers = [fd for fd, channel in active.items()
+                    if channel.want == 'r']
+            writers = [fd for fd, channel in active.items()
+                    if channel.want == 'w']
+            wait = 0 if pending else max(0, min(channel.deadline
+                    for channel in active.values()) - now)
+            readable, writable, _ = select.select(readers, writers, [], wait)
+
+            for fd in set(readable) | set(writable) | set(pending):
+                channel = active[fd]
+                try:
+                    done = channel.step()
+                except Exception as e:
+                    # Any error, such as a certificate which doesn't match
+                    # the host, only fails this channel's request.
+                    del active[fd]
+                    channel.close()
+                    if (channel.reused and not channel.received and
+                            isinstance(e, (socket.error,
+                            httplib.HTTPException))):
+                        # The server probably closed the idle connection.
+                        retries.append((channel.key, channel.payload))
+                    else:
+                        yield channel.key, None, e
+                    continue
+                if not done:
+                    continue
+                del active[fd]
+                response = channel.response
+                if response.will_close:
+                    channel.close()
+                else:
+                    idle.append(channel)
+                yield (channel.key,) + _parse(response, parse)
+
+            now = time.time()
+            for fd, channel in active.items():
+                if channel.deadline <= now:
+                    del active[fd]
+                    channel.close()
+                    yield channel.key, None, socket.timeout('timed out')
+    finally:
+        for channel in idle + active.values():
+            channel.close()
+
+
+def _parse(response, parse=True):
+    if response.status != 200:
+        return None, HealthVaultHTTPException('Non-success HTTP response '
+                'status from HealthVault.  Status={0}'.format(response.status),
+                code=response.status)
+    if not parse:
+        return response.body, None
+    try:
+        return parse_response(response.body), None
+    except RESPONSE_ERRORS as e:
+        return None, e
+
+
+def fetch_things(hvusers, groups, processes=None, batch_size=100,
+        offline=False, **kwargs):
+    """
+    Gets things from the records of many users at once with
+    :py:func:`fan_out`, which takes the keyword arguments.
+
+    Parsing responses takes CPU time which, with the GIL, extra threads
+    can't share. If ``processes`` is given, that work is moved to a pool of
+    that many worker processes, ``batch_size`` responses at a time, and
+    results are yielded a batch at a time, as each batch is parsed. This
+    pays off on machines with several cores when responses hold many
+    things, which take several times longer to parse than to send to a
+    worker. Requests are always signed in this process, as an HMAC costs
+    less than a round trip to a worker.
+
+    If ``offline`` is ``True``, records are accessed offline with each
+    user's stored ``person_id``, as by
+    :py:func:`~healthvaultapp.utils.create_offline_connection`, rather than
+    with their ``wctoken``, which may have expired. Users without a stored
+    ``person_id`` are yielded with a ``ValueError``. Otherwise, users whose
+    tokens aren't usable, according to
+    :py:func:`~healthvaultapp.utils.is_token_usable`, are yielded with a
+    ``HealthVaultTokenExpiredException`` without calling HealthVault. The
+    results can be passed to
+    :py:func:`~healthvaultapp.utils.record_token_results`.
+
+    :param hvusers: An iterable of
+        :py:class:`~healthvaultapp.models.HealthVaultUser`, which may be a
+        lazy ``queryset.iterator()``.
+    :param groups: A list of dictionaries describing the things to get from
+        each record, as for python-healthvault's ``batch_get``, which may
+        also give a :py:class:`~healthvaultapp.things.Projection` as
+        ``projection``.
+    :returns: An iterator of ``(hvuser, results, error)`` tuples, where
+        ``results`` is a list of the parsed things of each group, or
+        ``None`` if getting them failed with ``error``.
+    """
+    skipped = deque()
+    if offline:
+        hvusers = _skip_offline_unusable(hvusers, skipped)
+    else:
+        hvusers = _skip_unusable(hvusers, skipped)
+    if processes:
+        results = _fetch_things_offloaded(hvusers, groups, processes,
+                batch_size, offline, **kwargs)
+    else:
+        results = _fetch_things(hvusers, groups, offline, **kwargs)
+    for result in results:
+        while skipped:
+            yield skipped.popleft()
+        yield result
+    while skipped:
+        yield skipped.popleft()
+
+
+def _skip_unusable(hvusers, skipped):
+    """Yields the users of ``hvusers`` with usable tokens, and appends
+    failed results for the others to ``skipped``."""
+    now = timezone.now()
+    for hvuser in hvusers:
+        if is_token_usable(hvuser, now):
+            yield hvuser
+        else:
+            skipped.append((hvuser, None, _unusable_token_error(hvuser)))
+
+
+def _skip_offline_unusable(hvusers, skipped):
+    """Yields the users of ``hvusers`` who can be accessed offline, and
+    appends failed results for the others, such as users stored before
+    ``person_id`` was, to ``skipped``."""
+    for hvuser in hvusers:
+        if hvuser.person_id and hvuser.record_id:
+            yield hvuser
+        else:
+            skipped.append((hvuser, None, ValueError('Offline connections '
+                    'require a person_id and a record_id')))
+
+
+def _requests(hvusers, groups, offline):
+    """Yields signed ``(hvuser, payload)`` GetThings requests."""
+    for hvuser in hvusers:
+        if offline:
+            conn = create_offline_connection(hvuser.person_id,
+                    hvuser.record_id)
+        else:
+            conn = create_connection(wctoken=hvuser.token,
+                    record_id=hvuser.record_id)
+        yield hvuser, conn.build_request('GetThings',
+                _build_info(conn, groups))
+
+
+def _fetch_things(hvusers, groups, offline, **kwargs):
+    for hvuser, tree, error in fan_out(_requests(hvusers, groups, offline),
+            **kwargs):
+        if error is None:
+            try:
+                yield hvuser, _parse_things(tree, groups), None
+                continue
+            except RESPONSE_ERRORS as error:
+                pass
+        yield hvuser, None, error
+
+
+def _fetch_things_offloaded(hvusers, groups, processes, batch_size, offline,
+        **kwargs):
+    # Requests are signed here: an HMAC costs less than sending the request
+    # to a worker and back.
+    pool = Pool(processes, _init_worker, (groups,))
+    try:
+        responses = fan_out(_requests(hvusers, groups, offline), parse=False,
+                **kwargs)
+        pending = deque()
+        for batch in chunks(responses, batch_size):
+            pending.append((batch, pool.apply_async(_parse_batch,
+                    ([(body, error) for hvuser, body, error in batch],))))
+            # Yield parsed batches while later ones are being fetched.
+            while pending and (pending[0][1].ready() or len(pending) > 2):
+                batch, parsed = pending.popleft()
+                for (hvuser, body, error), result in zip(batch, parsed.get()):
+                    yield (hvuser,) + result
+        while pending:
+            batch, parsed = pending.popleft()
+            for (hvuser, body, error), result in zip(batch, parsed.get()):
+                yield (hvuser,) + result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# The groups of things which a pool worker parses.
+_worker_groups = None
+
+
+def _init_worker(groups):
+    global _worker_groups
+    _worker_groups = groups
+
+
+def _parse_batch(responses):
+    results = []
+    for body, error in responses:
+        if error is None:
+            try:
+                results.append((_parse_things(parse_response(body),
+                        _worker_groups), None))
+                continue
+            except RESPONSE_ERRORS as error:
+                pass
+        results.append((None, error))
+    return results
+
+
+def _build_info(conn, groups):
+    return '<info>' + ''.join(build_group(**group) for group in groups) + \
+            '</info>'
+
+
+def _parse_things(tree, groups):
+    info = tree.find(GETTHINGS_INFO)
+    if info is None:
+        raise HealthVaultException('GetThings response without info.')
+    return [parse_things(group, spec.get('projection'))
+            for group, spec in zip(info.findall('group'), groups)]
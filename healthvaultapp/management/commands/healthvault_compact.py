@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from healthvaultapp import archive
+
+
+class Command(BaseCommand):
+    help = ('Rolls archived HealthVault things into compressed monthly '
+            'chunks, and deletes those past the retention window.')
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=None,
+            help='Compact things archived more than this many days ago. '
+                 'Defaults to HEALTHVAULT_ARCHIVE_COMPACT_DAYS.'),
+        make_option('--retention-days', dest='retention_days', type='int',
+            default=None,
+            help='Delete things archived more than this many days ago. '
+                 'Defaults to HEALTHVAULT_ARCHIVE_RETENTION_DAYS.'),
+    )
+
+    def handle(self, *args, **options):
+        compacted, expired = archive.compact(days=options.get('days'),
+                retention_days=options.get('retention_days'))
+        self.stdout.write('Compacted {0} things.\n'.format(compacted))
+        if expired:
+            self.stdout.write('Deleted {0} expired things.\n'.format(expired))
@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from healthvaultapp import export
+from healthvaultapp.utils import get_setting
+
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = ('Exports archived HealthVault measurements as NumPy arrays of '
+            'each time series.')
+    option_list = BaseCommand.option_list + (
+        make_option('--series', dest='series', action='append', default=[],
+            help='Name of a series of HEALTHVAULT_EXPORT_SERIES to export. '
+                 'May be given several times. Defaults to all of them.'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=10000,
+            help='Number of things to parse at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the directory to export to.')
+        series = get_setting('HEALTHVAULT_EXPORT_SERIES')
+        names = options.get('series') or sorted(series)
+        for name in names:
+            if name not in series:
+                raise CommandError('Unknown series {0!r}.'.format(name))
+        counts = export.export_series(args[0],
+                dict((name, series[name]) for name in names),
+                chunk_size=options.get('chunk_size'))
+        for name in names:
+            self.stdout.write('Exported {0} {1} measurements.\n'.format(
+                    counts[name], name))
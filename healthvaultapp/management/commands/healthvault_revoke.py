@@ -0,0 +1,78 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from healthvaultapp import utils
+from healthvaultapp.models import HealthVaultUser
+
+
+class Command(BaseCommand):
+    help = ('Removes the stored HealthVault credentials of many users at '
+            'once. Select users with --filter and/or --ids-file.')
+    option_list = BaseCommand.option_list + (
+        make_option('--filter', action='append', dest='filters', default=[],
+            metavar='LOOKUP=VALUE',
+            help='Only revoke users matching this User lookup, for example '
+                 'is_active=False. May be given more than once.'),
+        make_option('--ids-file', dest='ids_file', default=None,
+            help='Only revoke users whose ids are listed, one per line, in '
+                 'this file.'),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=500, help='Number of rows to delete at a time.'),
+        make_option('--workers', dest='workers', type='int', default=4,
+            help='Number of concurrent HealthVault calls with --remote.'),
+        make_option('--remote', action='store_true', dest='remote',
+            default=False,
+            help='Also ask HealthVault to remove our authorization to each '
+                 'record.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False, help='Report what would be revoked, without '
+                                'changing anything.'),
+    )
+
+    # Filter values which are converted to Python values.
+    literals = {'True': True, 'False': False, 'None': None}
+
+    def handle(self, *args, **options):
+        filters = options.get('filters') or []
+        ids_file = options.get('ids_file')
+        if not filters and not ids_file:
+            raise CommandError('Select users with --filter or --ids-file.')
+
+        queryset = HealthVaultUser.objects.all()
+        for lookup in filters:
+            key, sep, value = lookup.partition('=')
+            if not sep or not key:
+                raise CommandError('Invalid filter: {0}'.format(lookup))
+            value = self.literals.get(value, value)
+            queryset = queryset.filter(**{'user__' + key: value})
+        if ids_file:
+            try:
+                with open(ids_file) as f:
+                    ids = [line.strip() for line in f if line.strip()]
+            except IOError as e:
+                raise CommandError(e)
+            # Look the ids up in batches to stay within database limits on
+            # the number of query parameters.
+            pks = []
+            for chunk in utils.chunks(ids, options.get('batch_size') or 500):
+                pks.extend(queryset.filter(user__pk__in=chunk)
+                        .values_list('pk', flat=True))
+            queryset = pks
+
+        dry_run = options.get('dry_run')
+        revoked, failed = utils.revoke_users(queryset,
+                batch_size=options.get('batch_size') or 500,
+                workers=options.get('workers') or 4,
+                remote=options.get('remote'), dry_run=dry_run,
+                progress=self._progress)
+
+        verb = 'Would revoke' if dry_run else 'Revoked'
+        self.stdout.write('{0} {1} users.\n'.format(verb, revoked))
+        if failed:
+            self.stdout.write('{0} HealthVault calls failed.\n'.format(failed))
+
+    def _progress(self, done, total, elapsed):
+        rate = done / elapsed if elapsed else float(done)
+        self.stdout.write('{0}/{1} users ({2:.1f} users/s)\n'.format(
+                done, total, rate))
@@ -0,0 +1,135 @@
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from . import routers, timing, utils
+
+
+logger = logging.getLogger(__name__)
+
+
+class ServerTimingMiddleware(object):
+    """
+    Breaks down where the time of a request went: HealthVault network calls,
+    request signing, XML parsing and database queries. The totals are sent
+    in a `Server-Timing <http://www.w3.org/TR/server-timing/>`_ header, and
+    logged if :py:data:`~healthvaultapp.defaults.HEALTHVAULT_TIMING_LOG` is
+    ``True``.
+
+    Only a fraction of requests, set by
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_TIMING_SAMPLE_RATE`, are
+    measured. Add the middleware as early as possible in your
+    :py:data:`MIDDLEWARE_CLASSES` so that it measures the whole request::
+
+        MIDDLEWARE_CLASSES = (
+            'healthvaultapp.middleware.ServerTimingMiddleware',
+            ...
+        )
+    """
+
+    def process_request(self, request):
+        rate = utils.get_setting('HEALTHVAULT_TIMING_SAMPLE_RATE')
+        if random.random() >= rate:
+            return None
+        timing.start()
+        # Database time is taken from the queries logged by Django's debug
+        # cursor, which we turn on for this request.
+        query_logs = []
+        for connection in connections.all():
+            query_logs.append((connection, connection.use_debug_cursor,
+                    len(connection.queries)))
+            connection.use_debug_cursor = True
+        request._healthvault_timing = (time.time(), query_logs)
+        return None
+
+    def process_exception(self, request, exception):
+        # Response middleware isn't called if the exception propagates, such
+        # as with DEBUG_PROPAGATE_EXCEPTIONS, so stop measuring now rather
+        # than leave this thread collecting timings and logging queries.
+        request._healthvault_timings = self._stop(request)
+        return None
+
+    def process_response(self, request, response):
+        timings = getattr(request, '_healthvault_timings', None)
+        if timings is None:
+            timings = self._stop(request)
+        if timings is None:
+            return response
+
+        header = ', '.join('{0};dur={1:.1f}'.format(name, seconds * 1000)
+                for name, seconds in sorted(timings.items()))
+        if response.has_header('Server-Timing'):
+            header = response['Server-Timing'] + ', ' + header
+        response['Server-Timing'] = header
+
+        if utils.get_setting('HEALTHVAULT_TIMING_LOG'):
+            logger.info('{0} {1}'.format(request.path, header),
+                    extra={'healthvault_timing': timings})
+        return response
+
+    def _stop(self, request):
+        """Stops measuring the request, and returns its timings, or ``None``
+        if it wasn't measured."""
+        timings = timing.stop()
+        state = getattr(request, '_healthvault_timing', None)
+        if state is None:
+            return None
+        request._healthvault_timing = None
+        start, query_logs = state
+
+        database = 0.0
+        for connection, use_debug_cursor, logged in query_logs:
+            queries = connection.queries[logged:]
+            database += sum(float(query['time']) for query in queries)
+            connection.use_debug_cursor = use_debug_cursor
+            # Forget queries which wouldn't have been logged without us.
+            if not (use_debug_cursor or
+                    use_debug_cursor is None and settings.DEBUG):
+                del connection.queries[logged:]
+        if timings is None:
+            return None
+        timings[timing.DATABASE] = database
+        timings['total'] = time.time() - start
+        return timings
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Carries the read-your-writes pinning of
+    :py:class:`~healthvaultapp.routers.HealthVaultRouter` across requests.
+    When a request writes a :py:class:`~healthvaultapp.models.HealthVaultUser`,
+    a short-lived cookie is set, and while it lasts that browser's reads go
+    to the default database::
+
+        MIDDLEWARE_CLASSES = (
+            ...
+            'healthvaultapp.middleware.ReplicaPinningMiddleware',
+        )
+    """
+    cookie_name = 'healthvault_pinned'
+
+    def process_request(self, request):
+        # Don't carry another request's pinning over in this thread.
+        routers.unpin()
+        if self.cookie_name in request.COOKIES:
+            routers.pin_to_primary()
+        return None
+
+    def process_exception(self, request, exception):
+        # Response middleware isn't called if the exception propagates, so
+        # don't leave this thread pinned.
+        request._healthvault_wrote = routers.has_written()
+        routers.unpin()
+        return None
+
+    def process_response(self, request, response):
+        if routers.has_written() or getattr(request, '_healthvault_wrote',
+                False):
+            seconds = utils.get_setting('HEALTHVAULT_REPLICA_PIN_SECONDS')
+            response.set_cookie(self.cookie_name, '1', max_age=seconds,
+                    httponly=True)
+        routers.unpin()
+        return response
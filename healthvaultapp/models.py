@@ -1,5 +1,10 @@
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone
+
+from . import defaults
 
 
 class HealthVaultUser(models.Model):
@@ -16,8 +21,150 @@ class HealthVaultUser(models.Model):
     # HealthVault UUID.
     record_id = models.CharField(max_length=36, unique=True)
 
+    # HealthVault UUID of the person who authorized access to the record,
+    # used to access it offline.
+    person_id = models.CharField(max_length=36, blank=True)
+
     # Used to authorize the current session with HealthVault.
     token = models.TextField()
 
+    # When the token was issued, and when it is known to have expired or
+    # to expire, if ever.
+    token_issued = models.DateTimeField(null=True, blank=True)
+    token_expires = models.DateTimeField(null=True, blank=True,
+            db_index=True)
+
+    # When a HealthVault call last succeeded with the token, and how many
+    # calls have failed since.
+    token_used = models.DateTimeField(null=True, blank=True)
+    token_failures = models.PositiveIntegerField(default=0, db_index=True)
+
     def __unicode__(self):
         return self.user.__unicode__()
+
+
+def invalidate_cached_user(sender, instance, **kwargs):
+    """Drops the saved or deleted row from the in-process user cache."""
+    from .usercache import invalidate
+    invalidate(instance.user_id)
+
+
+_cache_receivers = {'connected': False}
+
+
+def connect_cache_receivers(enabled=True):
+    """
+    Connects :py:func:`invalidate_cached_user` to the ``post_save`` and
+    ``post_delete`` signals of :py:class:`HealthVaultUser` while the user
+    cache is ``enabled``, and disconnects it otherwise. A ``post_delete``
+    receiver makes Django fetch rows before deleting them, so it is only
+    connected when it is needed.
+    """
+    if enabled == _cache_receivers['connected']:
+        return
+    for signal, uid in ((post_save, 'healthvault-user-cache-save'),
+            (post_delete, 'healthvault-user-cache-delete')):
+        if enabled:
+            signal.connect(invalidate_cached_user, sender=HealthVaultUser,
+                    dispatch_uid=uid)
+        else:
+            signal.disconnect(sender=HealthVaultUser, dispatch_uid=uid)
+    _cache_receivers['connected'] = enabled
+
+
+# Rows are invalidated in every process which writes them, including those
+# which never read through the cache.
+connect_cache_receivers(bool(getattr(settings, 'HEALTHVAULT_USER_CACHE_SIZE',
+        defaults.HEALTHVAULT_USER_CACHE_SIZE)))
+
+
+class HealthVaultRollup(models.Model):
+    """
+    Aggregates of one numeric field of a HealthVault data type over a day,
+    week or month, maintained by :py:func:`healthvaultapp.rollups.update_rollups`.
+    """
+    PERIOD_CHOICES = (
+        ('day', 'Day'),
+        ('week', 'Week'),
+        ('month', 'Month'),
+    )
+
+    # HealthVault UUIDs of the record and data type.
+    record_id = models.CharField(max_length=36)
+    datatype = models.CharField(max_length=36)
+
+    # Path to the value in parsed things, such as "kg" or "value.mmolperl".
+    field = models.CharField(max_length=50)
+
+    period = models.CharField(max_length=5, choices=PERIOD_CHOICES)
+
+    # The first day of the period. Weeks start on Monday.
+    start = models.DateField()
+
+    count = models.PositiveIntegerField()
+    total = models.FloatField()
+    minimum = models.FloatField()
+    maximum = models.FloatField()
+
+    class Meta:
+        unique_together = ('record_id', 'datatype', 'field', 'period',
+                'start')
+
+    def __unicode__(self):
+        return u'{0} {1} {2} of {3}'.format(self.record_id, self.field,
+                self.period, self.start)
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+
+class HealthVaultThing(models.Model):
+    """
+    The raw XML of a thing synced from HealthVault, kept for audit, which
+    :py:func:`healthvaultapp.archive.compact` later rolls into a
+    :py:class:`HealthVaultArchiveChunk`.
+    """
+    # HealthVault UUIDs of the record, thing and data type.
+    record_id = models.CharField(max_length=36, db_index=True)
+    thing_id = models.CharField(max_length=36)
+    datatype = models.CharField(max_length=36)
+
+    # When the thing was archived.
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    xml = models.TextField()
+
+    class Meta:
+        ordering = ('created', 'pk')
+
+    def __unicode__(self):
+        return u'{0} in {1}'.format(self.thing_id, self.record_id)
+
+
+class HealthVaultArchiveChunk(models.Model):
+    """
+    The compressed raw XML of the things archived for a record in a month.
+
+    ``data`` holds independently compressed blocks of things, base64
+    encoded, and ``index`` holds where each thing is, so that one thing can
+    be read by decompressing only its block. See
+    :py:mod:`healthvaultapp.archive`.
+    """
+    record_id = models.CharField(max_length=36)
+
+    # The first day of the month the things were archived in.
+    month = models.DateField()
+
+    count = models.PositiveIntegerField(default=0)
+    data = models.TextField(blank=True)
+
+    # JSON list of [thing id, data type, block offset, block length,
+    # offset in the block, length] of each thing.
+    index = models.TextField(default='[]')
+
+    class Meta:
+        unique_together = ('record_id', 'month')
+
+    def __unicode__(self):
+        return u'{0} {1:%Y-%m}'.format(self.record_id, self.month)
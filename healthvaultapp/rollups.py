@@ -0,0 +1,149 @@
+from django.db import IntegrityError, transaction
+
+from .models import HealthVaultRollup
+from .utils import import_numpy
+
+
+PERIODS = ('day', 'week', 'month')
+
+# Django 1.6 replaced commit_on_success with atomic.
+atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+
+
+def get_value(thing, field):
+    """
+    Returns the value at ``field`` in a thing parsed by python-healthvault,
+    following dots into nested dictionaries, e.g. ``"value.mmolperl"`` for
+    blood glucose. Returns ``None`` if the thing doesn't have the value.
+    """
+    value = thing
+    for key in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def to_arrays(things, field):
+    """
+    Returns a NumPy array of the times of ``things`` and an array of their
+    ``field`` values, skipping things without a time or value.
+    """
+    numpy = import_numpy()
+    times, values = [], []
+    for thing in things:
+        value = get_value(thing, field)
+        if thing.get('when') is None or value is None:
+            continue
+        times.append(thing['when'])
+        values.append(value)
+    return (numpy.array(times, dtype='datetime64[s]'),
+            numpy.array(values, dtype='float64'))
+
+
+def aggregate(times, values, period):
+    """
+    Aggregates ``values`` over the days, weeks or months of ``times`` in one
+    pass over the arrays. Returns arrays of the first day of each period
+    (weeks start on Monday), and the count, total, minimum and maximum of
+    the values in it, sorted by period.
+    """
+    numpy = import_numpy()
+    if period not in PERIODS:
+        raise ValueError('Unknown period {0!r}'.format(period))
+    days = times.astype('datetime64[D]')
+    if period == 'day':
+        starts = days
+    elif period == 'week':
+        # 1970-01-01, day 0, was a Thursday.
+        weekday = (days.astype('int64') + 3) % 7
+        starts = days - weekday.astype('timedelta64[D]')
+    else:
+        starts = days.astype('datetime64[M]').astype('datetime64[D]')
+
+    order = numpy.argsort(starts, kind='mergesort')
+    starts, values = starts[order], values[order]
+    # Index of the first value of each period.
+    first = numpy.flatnonzero(numpy.concatenate(
+            ([True], starts[1:] != starts[:-1])))
+    counts = numpy.diff(numpy.append(first, len(values)))
+    return (starts[first], counts, numpy.add.reduceat(values, first),
+            numpy.minimum.reduceat(values, first),
+            numpy.maximum.reduceat(values, first))
+
+
+def update_rollups(record_id, datatype, field, things):
+    """
+    Adds ``things`` of ``datatype`` from the record ``record_id`` into the
+    stored daily, weekly and monthly :py:class:`~healthvaultapp.models.HealthVaultRollup`
+    aggregates of ``field``.
+
+    Rollups are updated incrementally, so pass only things which haven't
+    been added before, such as those from the latest sync; adding a thing
+    twice counts it twice. Only periods which the new things fall in are
+    touched. The rollups are locked while they are updated, so concurrent
+    syncs of a record don't lose each other's things. Returns the number of
+    rollups created or updated.
+
+    :param things: Things parsed by python-healthvault, with a ``"when"``
+        datetime.
+    :param field: See :py:func:`get_value`.
+    """
+    times, values = to_arrays(things, field)
+    if not len(values):
+        return 0
+
+    try:
+        return _update_rollups(record_id, datatype, field, times, values)
+    except IntegrityError:
+        # Another sync created some of the same rollups first. They are
+        # locked and updated like the others on a second try.
+        return _update_rollups(record_id, datatype, field, times, values)
+
+
+def _update_rollups(record_id, datatype, field, times, values):
+    changed = 0
+    with atomic():
+        for period in PERIODS:
+            starts, counts, totals, minimums, maximums = aggregate(
+                    times, values, period)
+            dates = [start.item() for start in starts]
+            existing = HealthVaultRollup.objects.select_for_update().filter(
+                    record_id=record_id, datatype=datatype, field=field,
+                    period=period, start__gte=dates[0], start__lte=dates[-1])
+            existing = dict((rollup.start, rollup)
+                    for rollup in existing.order_by('start'))
+            created = []
+            for i, date in enumerate(dates):
+                rollup = existing.get(date)
+                if rollup is None:
+                    created.append(HealthVaultRollup(record_id=record_id,
+                            datatype=datatype, field=field, period=period,
+                            start=date, count=int(counts[i]),
+                            total=float(totals[i]),
+                            minimum=float(minimums[i]),
+                            maximum=float(maximums[i])))
+                    continue
+                rollup.count += int(counts[i])
+                rollup.total += float(totals[i])
+                rollup.minimum = min(rollup.minimum, float(minimums[i]))
+                rollup.maximum = max(rollup.maximum, float(maximums[i]))
+                rollup.save()
+            HealthVaultRollup.objects.bulk_create(created)
+            changed += len(dates)
+    return changed
+
+
+def get_rollups(record_id, datatype, field, period, start=None, end=None):
+    """
+    Returns the stored rollups of ``field`` for ``period``, ordered by their
+    start, optionally limited to those starting from ``start`` up to and
+    including ``end``.
+    """
+    rollups = HealthVaultRollup.objects.filter(record_id=record_id,
+            datatype=datatype, field=field, period=period)
+    if start is not None:
+        rollups = rollups.filter(start__gte=start)
+    if end is not None:
+        rollups = rollups.filter(start__lte=end)
+    return rollups.order_by('start')
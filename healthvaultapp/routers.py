@@ -0,0 +1,91 @@
+import threading
+import time
+
+from django.db import DEFAULT_DB_ALIAS
+
+from .models import HealthVaultUser
+from .utils import get_setting
+
+
+# Until when reads in this thread go to the primary database, after a write.
+_local = threading.local()
+
+
+def pin_to_primary(seconds=None):
+    """
+    Sends this thread's :py:class:`~healthvaultapp.models.HealthVaultUser`
+    reads to the primary database for ``seconds``, which defaults to
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_REPLICA_PIN_SECONDS`.
+    """
+    if seconds is None:
+        seconds = get_setting('HEALTHVAULT_REPLICA_PIN_SECONDS')
+    _local.pinned_until = max(getattr(_local, 'pinned_until', 0),
+            time.time() + seconds)
+
+
+def unpin():
+    """Lets this thread read from the replica again."""
+    _local.pinned_until = 0
+    _local.wrote = False
+
+
+def is_pinned():
+    return getattr(_local, 'pinned_until', 0) > time.time()
+
+
+def has_written():
+    """Whether this thread has written a HealthVaultUser since
+    :py:func:`unpin` was last called."""
+    return getattr(_local, 'wrote', False)
+
+
+class HealthVaultRouter(object):
+    """
+    Sends reads of :py:class:`~healthvaultapp.models.HealthVaultUser` to the
+    replica named by :py:data:`~healthvaultapp.defaults.HEALTHVAULT_READ_DATABASE`,
+    and writes to the default database.
+
+    After a write, such as when the :py:func:`complete
+    <healthvaultapp.views.complete>` or :py:func:`deauthorize
+    <healthvaultapp.views.deauthorize>` view changes a user's row, reads are
+    pinned to the default database for
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_REPLICA_PIN_SECONDS`, so
+    that they don't see stale integration state while the replica catches
+    up. Pinning applies to the rest of the thread's work and, with
+    :py:class:`~healthvaultapp.middleware.ReplicaPinningMiddleware`, to the
+    user's next requests.
+
+    Add the router to your :py:data:`DATABASE_ROUTERS`::
+
+        DATABASE_ROUTERS = ['healthvaultapp.routers.HealthVaultRouter']
+    """
+
+    def db_for_read(self, model, **hints):
+        if model is not HealthVaultUser:
+            return None
+        replica = get_setting('HEALTHVAULT_READ_DATABASE')
+        if replica is None or is_pinned():
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_write(self, model, **hints):
+        if model is not HealthVaultUser:
+            return None
+        _local.wrote = True
+        pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Users are related to HealthVaultUsers read from the replica.
+        if isinstance(obj1, HealthVaultUser) or \
+                isinstance(obj2, HealthVaultUser):
+            return True
+        return None
+
+    def allow_migrate(self, db, model):
+        if model is not HealthVaultUser:
+            return None
+        return db == DEFAULT_DB_ALIAS
+
+    # Django < 1.7
+    allow_syncdb = allow_migrate
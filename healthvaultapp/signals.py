@@ -0,0 +1,13 @@
+from django.dispatch import Signal
+
+
+sync_requested = Signal(providing_args=['hvusers', 'datatypes'])
+"""
+Sent when the HealthVault data of some users should be synced again. This app
+doesn't sync data itself; connect a receiver which queues the work with your
+task system.
+
+``hvusers`` is a list of :py:class:`~healthvaultapp.models.HealthVaultUser`
+objects, and ``datatypes`` is a list of the HealthVault data type ids to sync,
+or ``None`` for all types.
+"""
@@ -1,3 +1,17 @@
+from healthvaultapp.tests.test_admin import *
+from healthvaultapp.tests.test_archive import *
+from healthvaultapp.tests.test_commands import *
+from healthvaultapp.tests.test_connection import *
+from healthvaultapp.tests.test_export import *
+from healthvaultapp.tests.test_fanout import *
 from healthvaultapp.tests.test_integration import *
+from healthvaultapp.tests.test_middleware import *
+from healthvaultapp.tests.test_performance import *
+from healthvaultapp.tests.test_rollups import *
+from healthvaultapp.tests.test_routers import *
 from healthvaultapp.tests.test_tags import *
+from healthvaultapp.tests.test_things import *
+from healthvaultapp.tests.test_units import *
+from healthvaultapp.tests.test_usercache import *
 from healthvaultapp.tests.test_utils import *
+from healthvaultapp.tests.test_watermarks import *
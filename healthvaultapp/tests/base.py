@@ -1,6 +1,13 @@
+import BaseHTTPServer
+import errno
 from mock import patch
 import random
+import socket
+import SocketServer
 import string
+import sys
+import threading
+import time
 from urllib import urlencode, splitquery
 
 from django.contrib.auth.models import User
@@ -15,16 +22,116 @@ class MockHealthVaultConnection(object):
 
     def __init__(self, **kwargs):
         self.record_id = kwargs.pop('record_id', None)
+        self.person_id = kwargs.pop('person_id', None)
         self.auth_url = kwargs.pop('auth_url', None)
         self.deauth_url = kwargs.pop('deauth_url', None)
         self.sharedsec = kwargs.pop('sharedsec', None)
         self.auth_token = kwargs.pop('auth_token', None)
 
-    def authorization_url(self, callback_url=None, record_id=None):
-        return self.auth_url
-
-    def deauthorization_url(self, callback_url=None):
-        return self.deauth_url
+    def authorization_url(self, callback_url=None, record_id=None,
+            actionqs=None):
+        return self._add_actionqs(self.auth_url, actionqs)
+
+    def deauthorization_url(self, callback_url=None, actionqs=None):
+        return self._add_actionqs(self.deauth_url, actionqs)
+
+    def _add_actionqs(self, url, actionqs):
+        if actionqs is None:
+            return url
+        return url + '?' + urlencode({'actionqs': actionqs})
+
+
+WEIGHT = '3d34d87e-7fc1-4153-800f-f56592cb0d17'
+
+WEIGHT_THING = ('<thing><thing-id>{0}</thing-id><type-id>' + WEIGHT +
+        '</type-id><data-xml><weight><when><date><y>2014</y><m>1</m>'
+        '<d>29</d></date><time><h>8</h><m>0</m><s>0</s></time></when>'
+        '<value><kg>{1}</kg><display units="lb">{2}</display></value>'
+        '</weight></data-xml></thing>')
+
+
+def things_response(*groups):
+    """Returns the body of a GetThings response with a group of each of the
+    given lists of things."""
+    return ('<response><status><code>0</code></status>'
+            '<wc:info xmlns:wc="urn:com.microsoft.wc.methods.response.'
+            'GetThings">' + ''.join('<group>' + ''.join(things) + '</group>'
+            for things in groups) + '</wc:info></response>')
+
+
+class StandInRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        self.server.requests.append(self.rfile.read(length))
+        if self.server.delays:
+            time.sleep(self.server.delays.pop(0))
+        if self.server.respond is not None:
+            status, body, headers = self.server.respond(
+                    self.server.requests[-1])
+        else:
+            status, body, headers = self.server.responses.pop(0) \
+                    if self.server.responses else (200, self.server.body, {})
+        if status is None:
+            self.close_connection = 1
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local, keep-alive HTTP server which stands in for the HealthVault
+    platform. Each POST is answered with the next of ``responses`` (a list of
+    ``(status, body, headers)`` tuples), or with ``body`` once those run out,
+    after waiting for the next of ``delays`` seconds (if any). If
+    ``respond`` is set, it is called with the request body instead, and
+    returns the response tuple. A ``status`` of ``None`` closes the
+    connection without answering.
+    """
+    daemon_threads = True
+    respond = None
+    body = ('<response><status><code>0</code></status>'
+            '<wc:info xmlns:wc="urn:com.microsoft.wc.methods.response.'
+            'GetPersonInfo"><person-info><person-id>person</person-id>'
+            '<selected-record-id>record</selected-record-id></person-info>'
+            '</wc:info></response>')
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                StandInRequestHandler)
+        self.requests = []
+        self.responses = []
+        self.delays = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients which give up on a request are expected; anything else is
+        # reported as usual.
+        error = sys.exc_info()[1]
+        if isinstance(error, socket.error) and error.args and \
+                error.args[0] in (errno.EPIPE, errno.ECONNRESET):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
 
 
 class HealthVaultTestBase(TestCase):
@@ -65,6 +172,7 @@ class HealthVaultTestBase(TestCase):
         defaults = {
             'user': kwargs.pop('user', self.create_user()),
             'record_id': self.random_string(25),
+            'person_id': self.random_string(25),
             'token': self.random_string(25),
         }
         defaults.update(kwargs)
@@ -116,7 +224,7 @@ class HealthVaultTestBase(TestCase):
         for arg in args:
             session.pop(arg, None)
 
-    @patch('healthvaultapp.utils.HealthVaultConn')
+    @patch('healthvaultapp.connection.HealthVaultConn')
     def _mock_connection_get(self, conn=None, conn_kwargs=None,
             side_effect=None, **kwargs):
         """
@@ -133,7 +241,7 @@ class HealthVaultTestBase(TestCase):
         conn.side_effect = side_effect
         return self._get(**kwargs)
 
-    @patch('healthvaultapp.utils.HealthVaultConn')
+    @patch('healthvaultapp.connection.HealthVaultConn')
     def _create_mock_connection(self, conn=None, conn_kwargs=None,
             side_effect=None, **kwargs):
         defaults = {
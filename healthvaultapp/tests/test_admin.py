@@ -0,0 +1,119 @@
+from mock import patch
+import socket
+
+from django.contrib.admin.sites import AdminSite
+from django.test.client import RequestFactory
+
+from healthvaultlib.exceptions import HealthVaultException
+
+from healthvaultapp.admin import EstimatedCountPaginator, HealthVaultUserAdmin
+from healthvaultapp.models import HealthVaultUser
+from healthvaultapp.signals import sync_requested
+
+from .base import HealthVaultTestBase, MockHealthVaultConnection
+
+
+class TestHealthVaultUserAdmin(HealthVaultTestBase):
+    """Tests for healthvaultapp.admin.HealthVaultUserAdmin"""
+
+    def setUp(self):
+        super(TestHealthVaultUserAdmin, self).setUp()
+        self.other = self.create_healthvault_user()
+        self.admin = HealthVaultUserAdmin(HealthVaultUser, AdminSite())
+        self.request = RequestFactory().get('/')
+        self.messages = []
+        self.admin.message_user = lambda request, msg: \
+                self.messages.append(msg)
+
+    def test_revoke(self):
+        """The selected users' credentials are deleted."""
+        queryset = HealthVaultUser.objects.filter(pk=self.hvuser.pk)
+        self.admin.revoke(self.request, queryset)
+        self.assertEqual(list(HealthVaultUser.objects.all()), [self.other])
+        self.assertEqual(self.messages, ['Revoked 1 HealthVault users.'])
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_resolve_record_ids(self, conn):
+        """Changed record ids are saved."""
+        conn.return_value = MockHealthVaultConnection(
+                record_id=self.record_id)
+        queryset = HealthVaultUser.objects.filter(pk=self.hvuser.pk)
+        self.admin.resolve_record_ids(self.request, queryset)
+        hvuser = HealthVaultUser.objects.get(pk=self.hvuser.pk)
+        self.assertEqual(hvuser.record_id, self.record_id)
+        self.assertEqual(conn.call_args[1]['wctoken'], self.hvuser.token)
+        self.assertEqual(conn.call_args[1]['record_id'], None)
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_resolve_taken_record_id(self, conn):
+        """A record that belongs to another user isn't reassigned."""
+        conn.return_value = MockHealthVaultConnection(
+                record_id=self.other.record_id)
+        queryset = HealthVaultUser.objects.filter(pk=self.hvuser.pk)
+        self.admin.resolve_record_ids(self.request, queryset)
+        hvuser = HealthVaultUser.objects.get(pk=self.hvuser.pk)
+        self.assertEqual(hvuser.record_id, self.hvuser.record_id)
+        self.assertTrue('1 could not be resolved' in self.messages[0])
+
+    def _resolve_to(self, conn, record_ids):
+        """Resolves every user, to the record of their token in
+        ``record_ids``."""
+        conn.side_effect = lambda **kwargs: MockHealthVaultConnection(
+                record_id=record_ids[kwargs['wctoken']])
+        self.admin.resolve_record_ids(self.request,
+                HealthVaultUser.objects.all())
+        return dict(HealthVaultUser.objects.values_list('pk', 'record_id'))
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_resolve_swapped_record_ids(self, conn):
+        """Users whose records are swapped are skipped, not an error."""
+        record_ids = self._resolve_to(conn, {
+            self.hvuser.token: self.other.record_id,
+            self.other.token: self.hvuser.record_id,
+        })
+        self.assertEqual(record_ids, {self.hvuser.pk: self.hvuser.record_id,
+                self.other.pk: self.other.record_id})
+        self.assertTrue('2 could not be resolved' in self.messages[0])
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_resolve_same_record_id(self, conn):
+        """A record resolved for several users isn't given to any."""
+        record_ids = self._resolve_to(conn, {
+            self.hvuser.token: 'record',
+            self.other.token: 'record',
+        })
+        self.assertFalse('record' in record_ids.values())
+        self.assertTrue('2 could not be resolved' in self.messages[0])
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_resolve_failure(self, conn):
+        conn.side_effect = HealthVaultException
+        self.admin.resolve_record_ids(self.request,
+                HealthVaultUser.objects.all())
+        self.assertTrue('2 could not be resolved' in self.messages[0])
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_resolve_connection_error(self, conn):
+        """Connection errors fail only the users they happen for."""
+        conn.side_effect = socket.error
+        self.admin.resolve_record_ids(self.request,
+                HealthVaultUser.objects.all())
+        self.assertTrue('2 could not be resolved' in self.messages[0])
+
+    def test_request_sync(self):
+        """A sync is requested for the selected users."""
+        received = []
+
+        def receiver(sender, hvusers, datatypes, **kwargs):
+            received.extend(hvusers)
+        sync_requested.connect(receiver)
+        self.addCleanup(sync_requested.disconnect, receiver)
+
+        self.admin.request_sync(self.request, HealthVaultUser.objects.all())
+        self.assertEqual(set(received), set([self.hvuser, self.other]))
+
+    def test_paginator(self):
+        """Counts fall back to COUNT(*) outside PostgreSQL."""
+        paginator = EstimatedCountPaginator(HealthVaultUser.objects.all(), 1)
+        self.assertEqual(paginator.count, 2)
+        self.assertEqual(paginator.num_pages, 2)
@@ -0,0 +1,121 @@
+import base64
+import datetime
+import json
+import xml.etree.ElementTree as ET
+
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from healthvaultapp import archive
+from healthvaultapp.models import HealthVaultArchiveChunk, HealthVaultThing
+
+from .base import HealthVaultTestBase, WEIGHT, WEIGHT_THING
+
+
+class TestArchive(HealthVaultTestBase):
+    """Tests for healthvaultapp.archive"""
+
+    def setUp(self):
+        super(TestArchive, self).setUp()
+        self.record_id = self.hvuser.record_id
+        self.now = timezone.now()
+
+    def _archive(self, ids, days_ago=0, record_id=None):
+        things = [WEIGHT_THING.format(id, i, i) for i, id in enumerate(ids)]
+        archive.archive_things(record_id or self.record_id, things)
+        HealthVaultThing.objects.filter(thing_id__in=ids).update(
+                created=self.now - datetime.timedelta(days=days_ago))
+        return things
+
+    def test_archive_things(self):
+        element = ET.fromstring(WEIGHT_THING.format('b', 80, 176))
+        count = archive.archive_things(self.record_id,
+                [WEIGHT_THING.format('a', 80, 176), element])
+        self.assertEqual(count, 2)
+        row = HealthVaultThing.objects.get(thing_id='b')
+        self.assertEqual(row.datatype, WEIGHT)
+        self.assertEqual(ET.fromstring(row.xml).findtext('thing-id'), 'b')
+
+    @override_settings(HEALTHVAULT_ARCHIVE_BLOCK_SIZE=1000)
+    def test_compact(self):
+        """Old things are rolled into one chunk per record and month, and
+        can still be read one at a time."""
+        ids = ['thing{0}'.format(i) for i in range(20)]
+        things = self._archive(ids, days_ago=100)
+        self._archive(['other'], days_ago=100, record_id='other')
+        self._archive(['recent'])
+        compacted, expired = archive.compact(now=self.now)
+        self.assertEqual((compacted, expired), (21, 0))
+        self.assertEqual(list(HealthVaultThing.objects.values_list(
+                'thing_id', flat=True)), ['recent'])
+        chunk = HealthVaultArchiveChunk.objects.get(record_id=self.record_id)
+        self.assertEqual(chunk.count, 20)
+        created = self.now - datetime.timedelta(days=100)
+        self.assertEqual((chunk.month.year, chunk.month.month),
+                (created.year, created.month))
+        self.assertTrue(len(chunk.data) < sum(len(thing) for thing in things))
+        # Things are compressed in several blocks.
+        blocks = set(entry[archive.BLOCK_START]
+                for entry in json.loads(chunk.index))
+        self.assertTrue(len(blocks) > 1)
+        for i in (0, 7, 19):
+            self.assertEqual(archive.get_archived_thing(self.record_id,
+                    ids[i]), things[i])
+        self.assertEqual(archive.get_archived_thing('other', 'other'),
+                WEIGHT_THING.format('other', 0, 0))
+        self.assertEqual(archive.get_archived_thing(self.record_id, 'recent'),
+                WEIGHT_THING.format('recent', 0, 0))
+        self.assertEqual(archive.get_archived_thing(self.record_id, 'none'),
+                None)
+
+    def test_compact_again(self):
+        """Compacting a month again appends to its chunk."""
+        self._archive(['a'], days_ago=100)
+        archive.compact(now=self.now)
+        self._archive(['b'], days_ago=100)
+        archive.compact(now=self.now)
+        chunk = HealthVaultArchiveChunk.objects.get()
+        self.assertEqual(chunk.count, 2)
+        # The rows, the chunks holding the thing, and its block.
+        with self.assertNumQueries(3):
+            self.assertEqual(archive.get_archived_thing(self.record_id, 'a'),
+                    WEIGHT_THING.format('a', 0, 0))
+        self.assertEqual(archive.get_archived_thing(self.record_id, 'b'),
+                WEIGHT_THING.format('b', 0, 0))
+
+    def test_retention(self):
+        """Things past the retention window are deleted."""
+        self._archive(['old'], days_ago=400)
+        archive.compact(now=self.now)
+        self._archive(['expired'], days_ago=200)
+        self._archive(['kept'], days_ago=10)
+        compacted, expired = archive.compact(days=300, retention_days=100,
+                now=self.now)
+        self.assertEqual((compacted, expired), (0, 2))
+        self.assertEqual(HealthVaultArchiveChunk.objects.count(), 0)
+        self.assertEqual(list(HealthVaultThing.objects.values_list(
+                'thing_id', flat=True)), ['kept'])
+
+    def test_iter_archived_things(self):
+        """Compacted and recent things are read back, by data type."""
+        self._archive(['a', 'b'], days_ago=100)
+        archive.compact(now=self.now)
+        self._archive(['c'])
+        archive.archive_things('other', ['<thing><thing-id>d</thing-id>'
+                '<type-id>other</type-id></thing>'])
+        things = list(archive.iter_archived_things(WEIGHT, batch_size=1))
+        self.assertEqual([ET.fromstring(xml).findtext('thing-id')
+                for record_id, xml in things], ['a', 'b', 'c'])
+        self.assertEqual(things[1], (self.record_id,
+                WEIGHT_THING.format('b', 1, 1)))
+        self.assertEqual(len(list(archive.iter_archived_things())), 4)
+
+    def test_read_data(self):
+        data = ''.join(chr(i) for i in range(256))
+        chunk = HealthVaultArchiveChunk.objects.create(
+                record_id=self.record_id, month=self.now.date(),
+                data=base64.b64encode(data))
+        for start in range(5):
+            for length in range(1, 7):
+                self.assertEqual(archive._read_data(chunk.pk, start, length),
+                        data[start:start + length])
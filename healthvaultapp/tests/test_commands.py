@@ -0,0 +1,148 @@
+from mock import patch
+import os
+import shutil
+import socket
+from StringIO import StringIO
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import unittest
+
+from healthvaultlib.exceptions import HealthVaultException
+
+from healthvaultapp import archive
+from healthvaultapp.models import HealthVaultArchiveChunk, HealthVaultUser
+
+from .base import HealthVaultTestBase, WEIGHT_THING
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+class TestRevokeCommand(HealthVaultTestBase):
+    """Tests for the healthvault_revoke management command"""
+
+    def setUp(self):
+        super(TestRevokeCommand, self).setUp()
+        self.other = self.create_healthvault_user()
+        self.inactive = self.create_healthvault_user(
+                user=self.create_user(is_active=False))
+
+    def _call(self, **options):
+        stdout = StringIO()
+        call_command('healthvault_revoke', stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_no_selection(self):
+        """Revoking everyone by accident isn't possible."""
+        with self.assertRaises(CommandError):
+            self._call()
+        self.assertEqual(HealthVaultUser.objects.count(), 3)
+
+    def test_filter(self):
+        """Only users matching the filter are revoked."""
+        output = self._call(filters=['is_active=False'])
+        self.assertTrue('Revoked 1 users.' in output)
+        self.assertEqual(HealthVaultUser.objects.count(), 2)
+        self.assertFalse(HealthVaultUser.objects.filter(
+                pk=self.inactive.pk).exists())
+
+    def test_bad_filter(self):
+        with self.assertRaises(CommandError):
+            self._call(filters=['is_active'])
+
+    def test_ids_file(self):
+        """Users listed in the file are revoked, in batches."""
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write('{0}\n{1}\n'.format(self.user.pk, self.other.user.pk))
+        output = self._call(ids_file=path, batch_size=1)
+        self.assertTrue('1/2 users' in output)
+        self.assertTrue('2/2 users' in output)
+        self.assertEqual(list(HealthVaultUser.objects.all()), [self.inactive])
+
+    def test_missing_ids_file(self):
+        with self.assertRaises(CommandError):
+            self._call(ids_file='/does/not/exist')
+
+    def test_dry_run(self):
+        """Nothing is changed in a dry run."""
+        output = self._call(filters=['is_active=True'], dry_run=True)
+        self.assertTrue('Would revoke 2 users.' in output)
+        self.assertEqual(HealthVaultUser.objects.count(), 3)
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_remote(self, conn):
+        """HealthVault is asked to remove authorization for each record."""
+        # Mock's call counting isn't thread-safe, but appending to a list is.
+        calls = []
+        conn.return_value.remove_authorization.side_effect = \
+                lambda: calls.append(1)
+        self._call(filters=['is_active=True'], remote=True, workers=2)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(HealthVaultUser.objects.count(), 1)
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_remote_failure(self, conn):
+        """Rows are deleted even if HealthVault calls fail."""
+        conn.return_value.remove_authorization.side_effect = \
+                HealthVaultException
+        output = self._call(filters=['is_active=True'], remote=True)
+        self.assertTrue('2 HealthVault calls failed.' in output)
+        self.assertEqual(HealthVaultUser.objects.count(), 1)
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_remote_connection_error(self, conn):
+        """Rows are deleted even if HealthVault can't be reached."""
+        conn.return_value.remove_authorization.side_effect = socket.error
+        output = self._call(filters=['is_active=True'], remote=True,
+                workers=2)
+        self.assertTrue('2 HealthVault calls failed.' in output)
+        self.assertEqual(HealthVaultUser.objects.count(), 1)
+
+
+class TestCompactCommand(HealthVaultTestBase):
+    """Tests for the healthvault_compact management command"""
+
+    def test_compact(self):
+        archive.archive_things(self.hvuser.record_id,
+                [WEIGHT_THING.format('a', 80, 176)])
+        stdout = StringIO()
+        call_command('healthvault_compact', days=0, stdout=stdout)
+        self.assertTrue('Compacted 1 things.' in stdout.getvalue())
+        self.assertEqual(HealthVaultArchiveChunk.objects.get().count, 1)
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class TestExportCommand(HealthVaultTestBase):
+    """Tests for the healthvault_export management command"""
+
+    def setUp(self):
+        super(TestExportCommand, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestExportCommand, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_export(self):
+        archive.archive_things(self.hvuser.record_id,
+                [WEIGHT_THING.format('a', 80, 176)])
+        stdout = StringIO()
+        call_command('healthvault_export', self.directory, series=['weight'],
+                stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Exported 1 weight measurements.\n')
+        self.assertEqual(os.listdir(self.directory), ['weight'])
+
+    def test_unknown_series(self):
+        with self.assertRaises(CommandError):
+            call_command('healthvault_export', self.directory,
+                    series=['mood'])
+
+    def test_no_directory(self):
+        with self.assertRaises(CommandError):
+            call_command('healthvault_export')
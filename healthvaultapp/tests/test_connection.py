@@ -0,0 +1,397 @@
+import httplib
+from mock import patch
+import threading
+import time
+from urlparse import parse_qs, urlsplit
+
+from django.test.utils import override_settings
+
+from healthvaultlib.exceptions import (HealthVaultException,
+        HealthVaultHTTPException)
+
+from healthvaultapp import connection
+from healthvaultapp.connection import (ConnectionPool, HealthVaultConn,
+        Hedger, SingleFlight)
+
+from .base import HealthVaultTestBase, StandInServer
+
+
+class TestParseServer(HealthVaultTestBase):
+    """Tests for healthvaultapp.connection.parse_server"""
+
+    def test_host(self):
+        """A bare host name is reached over HTTPS."""
+        result = connection.parse_server('platform.healthvault-ppe.com')
+        self.assertEqual(result,
+                ('https', 'platform.healthvault-ppe.com', 443))
+
+    def test_url(self):
+        """A URL may give the scheme and port."""
+        result = connection.parse_server('http://localhost:8000')
+        self.assertEqual(result, ('http', 'localhost', 8000))
+        result = connection.parse_server('http://localhost')
+        self.assertEqual(result, ('http', 'localhost', 80))
+
+    def test_bad_scheme(self):
+        with self.assertRaises(ValueError):
+            connection.parse_server('ftp://localhost')
+
+
+class PooledConnectionTestBase(HealthVaultTestBase):
+
+    def setUp(self):
+        super(PooledConnectionTestBase, self).setUp()
+        connection.close_pools()
+        self.server = StandInServer()
+
+    def tearDown(self):
+        connection.close_pools()
+        self.server.stop()
+        super(PooledConnectionTestBase, self).tearDown()
+
+    def _conn(self):
+        return HealthVaultConn(app_id='app', app_thumbprint='thumb',
+                public_key=12345678L, private_key=12345678L,
+                server=self.server.url, sharedsec='12345',
+                auth_token='token')
+
+    def _send(self, conn=None):
+        conn = conn or self._conn()
+        return conn._build_and_send_request('GetPersonInfo', '<info/>',
+                use_record_id=False, use_wctoken=False)
+
+    def _stats(self):
+        return connection.get_pool(self.server.url).stats
+
+
+class TestPooledConnection(PooledConnectionTestBase):
+    """Tests for healthvaultapp.connection.HealthVaultConn"""
+
+    def test_reuse(self):
+        """Consecutive requests should share one connection."""
+        self._send()
+        self._send()
+        self._send(self._conn())
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self._stats()['created'], 1)
+        self.assertEqual(self._stats()['reused'], 2)
+        self.assertEqual(connection.pool_stats()['idle'], 1)
+
+    def test_record_id(self):
+        """Responses are parsed as by the base HealthVaultConn."""
+        conn = self._conn()
+        conn.connect('wctoken')
+        self.assertEqual(conn.record_id, 'record')
+        self.assertEqual(conn.person_id, 'person')
+
+    def test_missing_record_id(self):
+        self.server.body = ('<response><status><code>0</code></status>'
+                '</response>')
+        with self.assertRaises(HealthVaultException):
+            self._conn().connect('wctoken')
+
+    @override_settings(HEALTHVAULT_CONNECTION_POOL_SIZE=0)
+    def test_no_pooling(self):
+        """A pool size of 0 closes each connection after use."""
+        self._send()
+        self._send()
+        self.assertEqual(self._stats()['created'], 2)
+        self.assertEqual(self._stats()['reused'], 0)
+
+    @override_settings(HEALTHVAULT_CONNECTION_IDLE_TIMEOUT=-1)
+    def test_idle_timeout(self):
+        """Connections idle for too long are discarded."""
+        self._send()
+        self._send()
+        self.assertEqual(self._stats()['created'], 2)
+        self.assertEqual(self._stats()['discarded'], 1)
+
+    def test_server_close(self):
+        """A connection the server won't keep open isn't pooled."""
+        self.server.responses.append(
+                (200, self.server.body, {'Connection': 'close'}))
+        self._send()
+        self._send()
+        self.assertEqual(self._stats()['created'], 2)
+        self.assertEqual(self._stats()['reused'], 0)
+
+    def test_health_check(self):
+        """An idle connection closed by the server isn't reused."""
+        self._send()
+        pool = connection.get_pool(self.server.url)
+        conn, released = pool._idle[0]
+        self.assertTrue(pool._is_healthy(conn))
+        conn.sock.close()
+        conn.sock = None
+        self._send()
+        self.assertEqual(self._stats()['created'], 2)
+        self.assertEqual(self._stats()['discarded'], 1)
+
+    def test_retry(self):
+        """Idempotent requests which fail on a reused connection are sent
+        again on a new one."""
+        self._send()
+        self.server.responses.append((None, None, {}))
+        self._send()
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_no_retry(self):
+        """Other requests aren't sent again, since HealthVault may have
+        acted on them."""
+        self._send()
+        self.server.responses.append((None, None, {}))
+        with self.assertRaises(httplib.HTTPException):
+            self._conn()._build_and_send_request('PutThings', '<info/>',
+                    use_record_id=False, use_wctoken=False)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_http_error(self):
+        """Non-200 responses raise HealthVaultHTTPException."""
+        self.server.responses.append((500, 'Oops', {}))
+        with self.assertRaises(HealthVaultHTTPException):
+            self._send()
+        # The connection is still usable.
+        self._send()
+        self.assertEqual(self._stats()['reused'], 1)
+
+    def test_connection_status(self):
+        """Transport failures are counted until a request succeeds."""
+        self.server.responses.append((500, 'Oops', {}))
+        with self.assertRaises(HealthVaultHTTPException):
+            self._send()
+        status = connection.connection_status()
+        self.assertTrue(status['consecutive_failures'] >= 1)
+        self.assertTrue('500' in status['last_error_message'])
+        self._send()
+        status = connection.connection_status()
+        self.assertEqual(status['consecutive_failures'], 0)
+        self.assertTrue(status['last_success'] >= status['last_error'])
+
+    def test_status_error(self):
+        """Non-zero statuses raise HealthVaultException."""
+        body = ('<response><status><code>3</code><error><message>Bad'
+                '</message></error></status></response>')
+        self.server.responses.append((200, body, {}))
+        with self.assertRaises(HealthVaultException):
+            self._send()
+
+
+class TestConnectionPool(HealthVaultTestBase):
+    """Tests for healthvaultapp.connection.ConnectionPool"""
+
+    def test_size(self):
+        """Only up to `size` idle connections are kept."""
+        pool = ConnectionPool('localhost', size=1)
+        first, reused = pool.get()
+        second, reused = pool.get()
+        pool.put(first)
+        pool.put(second)
+        self.assertEqual(pool.idle_count(), 1)
+        self.assertEqual(pool.stats['discarded'], 1)
+
+
+class TestHedging(PooledConnectionTestBase):
+    """Tests for hedged requests in healthvaultapp.connection.HealthVaultConn"""
+
+    def setUp(self):
+        super(TestHedging, self).setUp()
+        self.hedger = Hedger(max_ratio=0.5)
+        for i in range(Hedger.min_samples):
+            self.hedger.record('GetPersonInfo', 0.01)
+        hedger = patch('healthvaultapp.connection._hedger', self.hedger)
+        hedger.start()
+        self.addCleanup(hedger.stop)
+
+    @override_settings(HEALTHVAULT_HEDGE=True, HEALTHVAULT_HEDGE_MAX_RATIO=1)
+    def test_hedge_wins(self):
+        """A slow request is hedged, and the faster response is used."""
+        self.server.delays.append(2)
+        start = time.time()
+        self._send()
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.hedger.stats,
+                {'requests': 1, 'hedged': 1, 'hedge_wins': 1})
+
+    @override_settings(HEALTHVAULT_HEDGE=True, HEALTHVAULT_HEDGE_MAX_RATIO=1)
+    def test_fast_request(self):
+        """Requests which answer quickly aren't hedged."""
+        self._send()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.hedger.stats['hedged'], 0)
+
+    @override_settings(HEALTHVAULT_HEDGE=True, HEALTHVAULT_HEDGE_MAX_RATIO=0)
+    def test_cap(self):
+        """No more than the configured fraction of requests are hedged."""
+        self.server.delays.append(0.2)
+        self._send()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.hedger.stats['hedged'], 0)
+
+    @override_settings(HEALTHVAULT_HEDGE=True, HEALTHVAULT_HEDGE_MAX_RATIO=1)
+    def test_not_idempotent(self):
+        """Only idempotent requests are hedged."""
+        self.server.delays.append(0.2)
+        conn = self._conn()
+        conn.wctoken = 'wctoken'
+        conn.record_id = 'record'
+        conn.remove_authorization()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.hedger.stats['requests'], 0)
+
+    @override_settings(HEALTHVAULT_HEDGE=True, HEALTHVAULT_HEDGE_MAX_RATIO=1)
+    def test_hedge_failure(self):
+        """A failed attempt doesn't fail the request while another is
+        outstanding."""
+        self.server.delays.extend([0.5, 0.0])
+        # Responses are taken in the order in which they are sent, so the
+        # hedged request fails first.
+        self.server.responses.append((500, 'Oops', {}))
+        self.server.responses.append((200, self.server.body, {}))
+        self._send()
+        self.assertEqual(self.hedger.stats['hedge_wins'], 0)
+
+
+class TestActionQS(HealthVaultTestBase):
+    """Tests for actionqs in healthvaultapp.connection.HealthVaultConn"""
+
+    def setUp(self):
+        super(TestActionQS, self).setUp()
+        self.conn = HealthVaultConn(app_id='app', app_thumbprint='thumb',
+                public_key=12345678L, private_key=12345678L,
+                server='localhost', shell_server='shell', sharedsec='12345',
+                auth_token='token')
+
+    def _targetqs(self, url):
+        return parse_qs(parse_qs(urlsplit(url).query)['targetqs'][0])
+
+    def test_authorization_url(self):
+        url = self.conn.authorization_url('http://callback', actionqs='a&b')
+        self.assertTrue(url.startswith('https://shell/redirect.aspx?'))
+        targetqs = self._targetqs(url)
+        self.assertEqual(targetqs['actionqs'], ['a&b'])
+        self.assertEqual(targetqs['redirect'], ['http://callback'])
+
+    def test_deauthorization_url(self):
+        url = self.conn.deauthorization_url(actionqs='state')
+        self.assertEqual(self._targetqs(url)['actionqs'], ['state'])
+        url = self.conn.deauthorization_url()
+        self.assertFalse('actionqs' in self._targetqs(url))
+
+
+class TestOfflineAccess(PooledConnectionTestBase):
+    """Tests for offline access with healthvaultapp.connection.HealthVaultConn"""
+
+    def test_offline(self):
+        """Requests authenticate as the offline person, not with a wctoken."""
+        conn = HealthVaultConn(app_id='app', app_thumbprint='thumb',
+                public_key=12345678L, private_key=12345678L,
+                server=self.server.url, sharedsec='12345',
+                auth_token='token', record_id='record',
+                offline_person_id='person')
+        self.assertEqual(conn.person_id, 'person')
+        conn._build_and_send_request('GetThings', '<info/>')
+        request = self.server.requests[0]
+        self.assertTrue('<offline-person-info><offline-person-id>person'
+                '</offline-person-id></offline-person-info>' in request)
+        self.assertTrue('<record-id>record</record-id>' in request)
+        self.assertFalse('user-auth-token' in request)
+
+    def test_online(self):
+        conn = self._conn()
+        conn.connect('wctoken')
+        conn._build_and_send_request('GetThings', '<info/>')
+        request = self.server.requests[-1]
+        self.assertTrue('<user-auth-token>wctoken</user-auth-token>' in
+                request)
+        self.assertFalse('offline-person-id' in request)
+
+    def test_no_wctoken(self):
+        with self.assertRaises(ValueError):
+            self._conn()._build_and_send_request('GetThings', '<info/>',
+                    use_record_id=False)
+
+
+class TestSingleFlight(PooledConnectionTestBase):
+    """Tests for healthvaultapp.connection.SingleFlight"""
+
+    def _concurrently(self, *funcs):
+        """Calls ``funcs`` in separate threads, returning their results or
+        exceptions."""
+        results = [None] * len(funcs)
+
+        def run(i):
+            try:
+                results[i] = funcs[i]()
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i,))
+                for i in range(len(funcs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_shared(self):
+        flight = SingleFlight()
+        calls = []
+
+        def func():
+            calls.append(1)
+            time.sleep(0.1)
+            return object()
+        results = self._concurrently(*[lambda: flight.do('key', func)] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(results[0] is results[1] is results[2])
+        self.assertEqual(flight.stats, {'calls': 1, 'shared': 2})
+        # Later calls run the function again.
+        flight.do('key', func)
+        self.assertEqual(len(calls), 2)
+
+    def test_error(self):
+        """Every waiter gets the exception."""
+        flight = SingleFlight()
+
+        def func():
+            time.sleep(0.1)
+            raise HealthVaultException('failed', code=7)
+        results = self._concurrently(*[lambda: flight.do('key', func)] * 2)
+        for result in results:
+            self.assertTrue(isinstance(result, HealthVaultException))
+            self.assertEqual(result.code, 7)
+
+    def _get_things(self, wctoken='wctoken', record_id='record',
+            method='GetThings'):
+        conn = HealthVaultConn(app_id='app', app_thumbprint='thumb',
+                public_key=12345678L, private_key=12345678L,
+                server=self.server.url, sharedsec='12345',
+                auth_token='token', wctoken=wctoken, record_id=record_id)
+        return lambda: conn._build_and_send_request(method, '<info/>')
+
+    def test_requests(self):
+        """Concurrent identical requests are sent once."""
+        self.server.delays = [0.2]
+        stats = connection.singleflight_stats()
+        results = self._concurrently(self._get_things(), self._get_things())
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(results[0] is results[1])
+        self.assertEqual(connection.singleflight_stats()['shared'],
+                stats['shared'] + 1)
+
+    def test_different_requests(self):
+        """Requests for other records or users, or which change data, aren't
+        shared."""
+        self.server.delays = [0.2] * 4
+        self._concurrently(self._get_things(),
+                self._get_things(record_id='other'),
+                self._get_things(wctoken='other'),
+                self._get_things(method='PutThings'),
+                self._get_things(method='PutThings'))
+        self.assertEqual(len(self.server.requests), 5)
+
+    @override_settings(HEALTHVAULT_SINGLE_FLIGHT=False)
+    def test_disabled(self):
+        self.server.delays = [0.2]
+        self._concurrently(self._get_things(), self._get_things())
+        self.assertEqual(len(self.server.requests), 2)
@@ -0,0 +1,98 @@
+import datetime
+from mock import patch
+import os
+import shutil
+import tempfile
+
+from django.utils import timezone
+from django.utils import unittest
+
+from healthvaultapp import archive, export
+from healthvaultapp.models import HealthVaultThing
+
+from .base import HealthVaultTestBase, WEIGHT, WEIGHT_THING
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+HEIGHT = '40750a6a-89b2-455c-bd8d-b420a4cb500b'
+HEIGHT_THING = ('<thing><thing-id>{0}</thing-id><type-id>' + HEIGHT +
+        '</type-id><data-xml><height><when><date><y>2014</y><m>2</m>'
+        '<d>1</d></date></when><value><m>{1}</m></value></height>'
+        '</data-xml></thing>')
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class TestExport(HealthVaultTestBase):
+    """Tests for healthvaultapp.export"""
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.series = {'weight': (WEIGHT, 'kg'), 'height': (HEIGHT, 'value.m')}
+
+    def tearDown(self):
+        super(TestExport, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def _export(self, **kwargs):
+        counts = export.export_series(self.directory, self.series, **kwargs)
+        return counts, dict((name, export.load_series(
+                '{0}/{1}'.format(self.directory, name))) for name in counts)
+
+    def test_export(self):
+        """Compacted and recent things of every record are exported."""
+        archive.archive_things('a', [WEIGHT_THING.format('1', 80, 176),
+                WEIGHT_THING.format('2', 81, 178),
+                HEIGHT_THING.format('3', 1.8)])
+        HealthVaultThing.objects.update(
+                created=timezone.now() - datetime.timedelta(days=100))
+        archive.compact()
+        archive.archive_things('b', [WEIGHT_THING.format('4', 70, 154)])
+        archive.archive_things('a', [WEIGHT_THING.format('5', 82, 180)])
+
+        counts, series = self._export(chunk_size=2)
+        self.assertEqual(counts, {'weight': 4, 'height': 1})
+        weight = series['weight']
+        self.assertEqual(list(weight['value']), [80.0, 81.0, 70.0, 82.0])
+        self.assertEqual(list(weight['records']), ['a', 'b'])
+        self.assertEqual(list(weight['record']), [0, 0, 1, 0])
+        self.assertEqual(weight['when'][0].item(),
+                datetime.datetime(2014, 1, 29, 8))
+        self.assertEqual(weight['when'].dtype, numpy.dtype('datetime64[s]'))
+        self.assertTrue(isinstance(weight['value'], numpy.memmap))
+        self.assertEqual(list(series['height']['value']), [1.8])
+
+    def test_empty(self):
+        counts, series = self._export()
+        self.assertEqual(counts, {'weight': 0, 'height': 0})
+        self.assertEqual(len(series['weight']['when']), 0)
+        self.assertEqual(len(series['weight']['records']), 0)
+
+    def test_unparseable(self):
+        """Things which can't be parsed are left out."""
+        archive.archive_things('a', [WEIGHT_THING.format('1', 80, 176)])
+        HealthVaultThing.objects.create(record_id='a', thing_id='2',
+                datatype=WEIGHT, created=timezone.now(), xml='<thing>')
+        archive.archive_things('a', [WEIGHT_THING.format('3', 'heavy', 180),
+                WEIGHT_THING.replace('<when>', '<nowhen>')
+                .replace('</when>', '</nowhen>').format('4', 81, 178),
+                WEIGHT_THING.format('5', 82, 180)])
+        with patch('healthvaultapp.export.logging') as mock_logging:
+            counts, series = self._export()
+        self.assertEqual(list(series['weight']['value']), [80.0, 82.0])
+        self.assertEqual(
+                mock_logging.getLogger.return_value.exception.call_count, 3)
+
+    def test_error(self):
+        """The raw data of series is removed if the export fails."""
+        archive.archive_things('a', [WEIGHT_THING.format('1', 80, 176)])
+        with patch('healthvaultapp.export._measurements',
+                side_effect=IOError):
+            with self.assertRaises(IOError):
+                self._export()
+        self.assertEqual([files for path, dirs, files
+                in os.walk(self.directory) if files], [])
@@ -0,0 +1,303 @@
+from mock import patch
+import socket
+import ssl
+import xml.etree.ElementTree as ET
+
+from django.test.utils import override_settings
+
+from healthvaultlib.exceptions import (HealthVaultException,
+        HealthVaultHTTPException, HealthVaultTokenExpiredException)
+
+from healthvaultapp import fanout
+from healthvaultapp.connection import HealthVaultConn
+from healthvaultapp.things import Projection
+
+from .base import (HealthVaultTestBase, StandInServer, things_response,
+        WEIGHT, WEIGHT_THING)
+
+
+class FanOutTestBase(HealthVaultTestBase):
+
+    def setUp(self):
+        super(FanOutTestBase, self).setUp()
+        self.server = StandInServer()
+        self.addCleanup(self.server.stop)
+        self.conn = HealthVaultConn(app_id='app', app_thumbprint='thumb',
+                public_key=12345678L, private_key=12345678L,
+                server=self.server.url, sharedsec='12345',
+                auth_token='token', wctoken='wctoken', record_id='record')
+
+    def _requests(self, count):
+        for i in range(count):
+            yield i, self.conn.build_request('GetPersonInfo', '<info/>',
+                    use_record_id=False)
+
+    def _fan_out(self, count, **kwargs):
+        kwargs.setdefault('server', self.server.url)
+        return list(fanout.fan_out(self._requests(count), **kwargs))
+
+
+class TestFanOut(FanOutTestBase):
+    """Tests for healthvaultapp.fanout.fan_out"""
+
+    def test_fan_out(self):
+        """All responses are yielded, over reused connections."""
+        results = self._fan_out(20, concurrency=5)
+        self.assertEqual(sorted(key for key, tree, error in results),
+                range(20))
+        for key, tree, error in results:
+            self.assertEqual(error, None)
+            self.assertEqual(tree.find('status/code').text, '0')
+        self.assertEqual(len(self.server.requests), 20)
+        self.assertTrue(self.server.requests[0].startswith(
+                '<wc-request:request'))
+
+    def test_lazy(self):
+        """Requests are only taken from the iterator as slots free up."""
+        taken = []
+
+        def requests():
+            for key, payload in self._requests(10):
+                taken.append(key)
+                yield key, payload
+        results = fanout.fan_out(requests(), server=self.server.url,
+                concurrency=2)
+        next(results)
+        self.assertTrue(len(taken) <= 3)
+        self.assertEqual(len(list(results)), 9)
+
+    def test_errors(self):
+        """Failed requests are yielded with their errors, and don't stop
+        the others."""
+        self.server.responses.append((500, 'Oops', {}))
+        body = ('<response><status><code>3</code><error><message>Bad'
+                '</message></error></status></response>')
+        self.server.responses.append((200, body, {}))
+        results = self._fan_out(4, concurrency=1)
+        errors = [error for key, tree, error in results]
+        self.assertTrue(isinstance(errors[0], HealthVaultHTTPException))
+        self.assertTrue(isinstance(errors[1], HealthVaultException))
+        self.assertEqual(errors[2:], [None, None])
+
+    def test_server_close(self):
+        """Connections which the server closes aren't reused."""
+        self.server.responses.append(
+                (200, self.server.body, {'Connection': 'close'}))
+        results = self._fan_out(3, concurrency=1)
+        self.assertEqual([error for key, tree, error in results],
+                [None, None, None])
+
+    def test_timeout(self):
+        self.server.delays.append(1)
+        results = self._fan_out(1, timeout=0.1)
+        self.assertTrue(isinstance(results[0][2], socket.timeout))
+
+    def test_connection_refused(self):
+        server = self.server.url
+        self.server.stop()
+        results = self._fan_out(2, server=server)
+        for key, tree, error in results:
+            self.assertTrue(isinstance(error, socket.error))
+
+
+    def test_channel_error(self):
+        """Other errors in a channel, such as a certificate which doesn't
+        match the host, fail only that request."""
+        step = fanout._Channel.step
+
+        def mismatch(channel):
+            if channel.key == 1:
+                raise ssl.CertificateError("hostname doesn't match")
+            return step(channel)
+        with patch.object(fanout._Channel, 'step', mismatch):
+            results = dict((key, error) for key, tree, error in
+                    self._fan_out(3, concurrency=3))
+        self.assertTrue(isinstance(results[1], ssl.CertificateError))
+        self.assertEqual((results[0], results[2]), (None, None))
+
+
+class TestResponse(HealthVaultTestBase):
+    """Tests for healthvaultapp.fanout._Response"""
+
+    def test_chunked(self):
+        response = fanout._Response()
+        self.assertFalse(response.feed('HTTP/1.1 200 OK\r\nTransfer-'
+                'Encoding: chunked\r\n\r\n5\r\nHel'))
+        self.assertFalse(response.feed('lo\r\n6;ext=1\r\n world\r\n'))
+        self.assertTrue(response.feed('0\r\n\r\n'))
+        self.assertEqual(response.body, 'Hello world')
+        self.assertFalse(response.will_close)
+
+    def test_until_close(self):
+        response = fanout._Response()
+        self.assertFalse(response.feed('HTTP/1.0 200 OK\r\n\r\nHello'))
+        self.assertTrue(response.will_close)
+        self.assertTrue(response.finish())
+        self.assertEqual(response.body, 'Hello')
+
+
+class TestFetchThings(FanOutTestBase):
+    """Tests for healthvaultapp.fanout.fetch_things"""
+
+    @patch.multiple('healthvaultapp.utils', sharedsec='12345',
+            auth_token='token')
+    def test_fetch_things(self):
+        self.server.body = things_response([WEIGHT_THING.format('a', 80, 176)])
+        hvusers = [self.create_healthvault_user(
+                user=self.create_user(username=str(i))) for i in range(3)]
+        hvusers.append(self.hvuser)
+        with override_settings(HEALTHVAULT_SERVER=self.server.url):
+            results = list(fanout.fetch_things(iter(hvusers),
+                    [{'datatype': WEIGHT, 'max': 10}], concurrency=2))
+        self.assertEqual(set(hvuser for hvuser, things, error in results),
+                set(hvusers))
+        for hvuser, things, error in results:
+            self.assertEqual(error, None)
+            self.assertEqual(things[0][0]['kg'], 80.0)
+        self.assertTrue('<group max="10">' in self.server.requests[0])
+
+    @patch.multiple('healthvaultapp.utils', sharedsec='12345',
+            auth_token='token')
+    def test_processes(self):
+        """Parsing can be done by worker processes."""
+        self.server.body = things_response([WEIGHT_THING.format('a', 80, 176)])
+        self.server.responses.append((500, 'Oops', {}))
+        hvusers = [self.create_healthvault_user(
+                user=self.create_user(username=str(i))) for i in range(6)]
+        with override_settings(HEALTHVAULT_SERVER=self.server.url):
+            results = list(fanout.fetch_things(iter(hvusers),
+                    [{'datatype': WEIGHT}], processes=2, batch_size=2,
+                    concurrency=1))
+        self.assertEqual([hvuser for hvuser, things, error in results],
+                hvusers)
+        self.assertTrue(isinstance(results[0][2], HealthVaultHTTPException))
+        self.assertEqual(results[0][2].code, 500)
+        for hvuser, things, error in results[1:]:
+            self.assertEqual(error, None)
+            self.assertEqual(things[0][0]['kg'], 80.0)
+        self.assertTrue(hvusers[0].token in self.server.requests[0])
+
+    @patch.multiple('healthvaultapp.utils', sharedsec='12345',
+            auth_token='token')
+    def test_offline(self):
+        """Records can be accessed offline, without the users' tokens."""
+        self.server.body = things_response([WEIGHT_THING.format('a', 80, 176)])
+        with override_settings(HEALTHVAULT_SERVER=self.server.url):
+            results = list(fanout.fetch_things([self.hvuser],
+                    [{'datatype': WEIGHT}], offline=True))
+            results += list(fanout.fetch_things([self.hvuser],
+                    [{'datatype': WEIGHT}], processes=1, offline=True))
+        for hvuser, things, error in results:
+            self.assertEqual(error, None)
+        for request in self.server.requests:
+            self.assertTrue(self.hvuser.person_id in request)
+            self.assertFalse(self.hvuser.token in request)
+
+    @patch.multiple('healthvaultapp.utils', sharedsec='12345',
+            auth_token='token')
+    def test_offline_without_person_id(self):
+        """Users without a stored person_id fail without stopping the
+        others."""
+        self.server.body = things_response([WEIGHT_THING.format('a', 80, 176)])
+        legacy = self.create_healthvault_user(user=self.create_user(),
+                person_id='')
+        with override_settings(HEALTHVAULT_SERVER=self.server.url):
+            for processes in (None, 1):
+                results = list(fanout.fetch_things([legacy, self.hvuser],
+                        [{'datatype': WEIGHT}], processes=processes,
+                        offline=True))
+                self.assertEqual([hvuser for hvuser, things, error
+                        in results], [legacy, self.hvuser])
+                self.assertEqual(results[0][1], None)
+                self.assertTrue(isinstance(results[0][2], ValueError))
+                self.assertEqual(results[1][2], None)
+        self.assertEqual(len(self.server.requests), 2)
+
+    @patch.multiple('healthvaultapp.utils', sharedsec='12345',
+            auth_token='token')
+    def test_unusable_token(self):
+        """Users whose tokens are known to be unusable are skipped."""
+        self.server.body = things_response([WEIGHT_THING.format('a', 80, 176)])
+        expired = self.create_healthvault_user(user=self.create_user(),
+                token_failures=5)
+        with override_settings(HEALTHVAULT_SERVER=self.server.url):
+            results = list(fanout.fetch_things([expired, self.hvuser],
+                    [{'datatype': WEIGHT}]))
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(results[0][0], expired)
+        self.assertTrue(isinstance(results[0][2],
+                HealthVaultTokenExpiredException))
+        self.assertEqual(results[1][:1] + results[1][2:], (self.hvuser, None))
+
+    @patch.multiple('healthvaultapp.utils', sharedsec='12345',
+            auth_token='token')
+    def test_projection(self):
+        """Groups may give the projection of the things to get."""
+        thing = WEIGHT_THING.format('a', 80, 176)
+        self.server.body = things_response([thing], [thing])
+        groups = [{'datatype': WEIGHT,
+                'projection': Projection(sections=['core', 'tags'])},
+                {'datatype': WEIGHT, 'projection': Projection(xml=False)}]
+        with override_settings(HEALTHVAULT_SERVER=self.server.url):
+            results = list(fanout.fetch_things([self.hvuser], groups))
+            results += list(fanout.fetch_things([self.hvuser], groups,
+                    processes=1))
+        for hvuser, things, error in results:
+            self.assertEqual(things[0][0]['kg'], 80.0)
+            self.assertEqual(things[1][0].findtext('thing-id'), 'a')
+        self.assertTrue('<section>tags</section>' in self.server.requests[0])
+
+    @patch.multiple('healthvaultapp.utils', sharedsec='12345',
+            auth_token='token')
+    def test_parse_error(self):
+        """Things of unknown types are failures, not exceptions."""
+        self.server.body = things_response(['<thing><type-id>unknown'
+                '</type-id></thing>'])
+        with override_settings(HEALTHVAULT_SERVER=self.server.url):
+            results = list(fanout.fetch_things([self.hvuser],
+                    [{'datatype': WEIGHT}]))
+        self.assertTrue(isinstance(results[0][2], HealthVaultException))
+
+    @patch.multiple('healthvaultapp.utils', sharedsec='12345',
+            auth_token='token')
+    def test_malformed_response(self):
+        """Responses which aren't the XML we expect are failures, inline and
+        in worker processes."""
+        self.server.body = 'Service unavailable'
+        self.server.responses.append((200, '<response/>', {}))
+        with override_settings(HEALTHVAULT_SERVER=self.server.url):
+            results = list(fanout.fetch_things([self.hvuser],
+                    [{'datatype': WEIGHT}]))
+            results += list(fanout.fetch_things([self.hvuser],
+                    [{'datatype': WEIGHT}], processes=1))
+        self.assertTrue(isinstance(results[0][2], HealthVaultException))
+        self.assertTrue(isinstance(results[1][2], ET.ParseError))
+
+    @patch.multiple('healthvaultapp.utils', sharedsec='12345',
+            auth_token='token')
+    def test_malformed_thing(self):
+        """Things which can't be parsed only fail their own user, inline and
+        in worker processes."""
+        malformed = things_response([WEIGHT_THING.format('a', 'heavy', 176)])
+        good = things_response([WEIGHT_THING.format('b', 80, 176)])
+        other = self.create_healthvault_user(user=self.create_user())
+        with override_settings(HEALTHVAULT_SERVER=self.server.url):
+            for processes in (None, 1):
+                self.server.responses = [(200, malformed, {}),
+                        (200, good, {})]
+                results = list(fanout.fetch_things([self.hvuser, other],
+                        [{'datatype': WEIGHT}], processes=processes,
+                        concurrency=1))
+                self.assertEqual(len(results), 2)
+                errors = [error for hvuser, things, error in results]
+                self.assertEqual(len([error for error in errors
+                        if isinstance(error, ValueError)]), 1)
+                self.assertTrue(None in errors)
+
+    def test_programming_error(self):
+        """Errors which aren't about the response aren't hidden."""
+        with patch.object(fanout, '_worker_groups', [{}]):
+            with patch.object(fanout, '_parse_things',
+                    side_effect=NameError):
+                with self.assertRaises(NameError):
+                    fanout._parse_batch([(self.server.body, None)])
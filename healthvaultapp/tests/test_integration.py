@@ -1,11 +1,26 @@
+import base64
+import hashlib
+import hmac
+import httplib
+import json
+from mock import patch
+import time
+from urlparse import parse_qs, urlsplit
+import xml.etree.ElementTree as ET
+
+from django.core import signing
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
 
 from healthvaultlib.healthvault import HealthVaultException
 from healthvaultlib.targets import ApplicationTarget
 
-from healthvaultapp import utils
+from healthvaultapp import connection, utils, watermarks
 from healthvaultapp.models import HealthVaultUser
-from healthvaultapp.views import NEXT_GET_PARAM, NEXT_SESSION_KEY
+from healthvaultapp.signals import sync_requested
+from healthvaultapp.views import (NEXT_GET_PARAM, NEXT_SESSION_KEY,
+        NEXT_STATE_PARAM, NEXT_STATE_SALT)
 
 from .base import HealthVaultTestBase
 
@@ -176,6 +191,36 @@ class TestCompleteView_APPAUTHSUCCESS(HealthVaultTestBase):
         hvuser = HealthVaultUser.objects.get()
         self.assertEqual(hvuser.token, self.token)
         self.assertEqual(hvuser.record_id, self.record_id)
+        self.assertEqual(hvuser.person_id, '')
+
+    @override_settings(HEALTHVAULT_TOKEN_LIFETIME=3600)
+    def test_token_expiry(self):
+        """Complete view should record when the new token expires."""
+        self.create_healthvault_user(user=self.user, token_failures=3)
+        self._mock_connection_get()
+        hvuser = HealthVaultUser.objects.get()
+        self.assertEqual(hvuser.token_failures, 0)
+        self.assertEqual(hvuser.token_used, hvuser.token_issued)
+        self.assertEqual((hvuser.token_expires - hvuser.token_issued)
+                .total_seconds(), 3600)
+
+    def test_person_id(self):
+        """Complete view should store the person ID for offline access."""
+        self._mock_connection_get(conn_kwargs={'person_id': 'person'})
+        self.assertEqual(HealthVaultUser.objects.get().person_id, 'person')
+
+    def test_prefetch(self):
+        """Complete view should only prefetch things if configured to."""
+        with patch('healthvaultapp.things.schedule_prefetch') as prefetch:
+            self._mock_connection_get()
+            self.assertFalse(prefetch.called)
+            with override_settings(HEALTHVAULT_PREFETCH_DATATYPES=['weight']):
+                response = self._mock_connection_get()
+        redirect_url = utils.get_setting('HEALTHVAULT_AUTHORIZE_REDIRECT')
+        self.assertRedirectsNoFollow(response, redirect_url)
+        conn, datatypes = prefetch.call_args[0]
+        self.assertEqual(conn.record_id, self.record_id)
+        self.assertEqual(datatypes, ['weight'])
 
     def test_integrated(self):
         """Complete view should overwrite any existing credentials."""
@@ -261,6 +306,67 @@ class TestCompleteView_SIGNOUT(HealthVaultTestBase):
         self.assertEqual(HealthVaultUser.objects.count(), 0)
 
 
+@override_settings(HEALTHVAULT_NEXT_IN_STATE=True)
+class TestNextState(HealthVaultTestBase):
+    """Tests for passing the next URL through HealthVault in actionqs"""
+    url_name = 'healthvault-complete'
+
+    def _get_state(self, url_name, next_url):
+        response = self._mock_connection_get(url_name=url_name,
+                get_params={NEXT_GET_PARAM: next_url})
+        query = parse_qs(urlsplit(response['location']).query)
+        self.assertFalse(NEXT_SESSION_KEY in self.client.session)
+        return query.get(NEXT_STATE_PARAM, [None])[0]
+
+    def _complete(self, state, target=ApplicationTarget.APP_AUTH_SUCCESS):
+        get_params = {'target': target, 'wctoken': self.token}
+        if state:
+            get_params[NEXT_STATE_PARAM] = state
+        return self._mock_connection_get(get_params=get_params)
+
+    def test_authorize(self):
+        state = self._get_state('healthvault-authorize', '/next')
+        self.assertRedirectsNoFollow(self._complete(state), '/next')
+
+    def test_deauthorize(self):
+        state = self._get_state('healthvault-deauthorize', '/next')
+        response = self._complete(state, target=ApplicationTarget.SIGN_OUT)
+        self.assertRedirectsNoFollow(response, '/next')
+
+    def test_no_state(self):
+        response = self._complete(None)
+        redirect_url = utils.get_setting('HEALTHVAULT_AUTHORIZE_REDIRECT')
+        self.assertRedirectsNoFollow(response, redirect_url)
+
+    def test_tampered(self):
+        """State which wasn't signed by us is ignored."""
+        response = self._complete(signing.dumps('/evil', key='wrong',
+                salt=NEXT_STATE_SALT))
+        redirect_url = utils.get_setting('HEALTHVAULT_AUTHORIZE_REDIRECT')
+        self.assertRedirectsNoFollow(response, redirect_url)
+
+    @override_settings(HEALTHVAULT_NEXT_MAX_AGE=-1)
+    def test_expired(self):
+        state = self._get_state('healthvault-authorize', '/next')
+        redirect_url = utils.get_setting('HEALTHVAULT_AUTHORIZE_REDIRECT')
+        self.assertRedirectsNoFollow(self._complete(state), redirect_url)
+
+    def test_disallowed_host(self):
+        """Next URLs must be on this site or an allowed host."""
+        self.assertEqual(self._get_state('healthvault-authorize',
+                'http://example.com/next'), None)
+        state = signing.dumps('http://example.com/next', salt=NEXT_STATE_SALT)
+        redirect_url = utils.get_setting('HEALTHVAULT_AUTHORIZE_REDIRECT')
+        self.assertRedirectsNoFollow(self._complete(state), redirect_url)
+
+    @override_settings(HEALTHVAULT_NEXT_ALLOWED_HOSTS=['example.com'])
+    def test_allowed_host(self):
+        state = self._get_state('healthvault-authorize',
+                'http://example.com/next')
+        response = self._complete(state)
+        self.assertEqual(response['location'], 'http://example.com/next')
+
+
 class TestErrorView(HealthVaultTestBase):
     """Tests for healthvaultapp.views.error"""
     url_name = 'healthvault-error'
@@ -289,3 +395,165 @@ class TestErrorView(HealthVaultTestBase):
         response = self._get()
         self.assertEqual(response.status_code, 200)
         self.assertFalse(NEXT_SESSION_KEY in self.client.session)
+
+
+class TestHealthView(HealthVaultTestBase):
+    """Tests for healthvaultapp.views.health"""
+    url_name = 'healthvault-health'
+
+    def setUp(self):
+        super(TestHealthView, self).setUp()
+        cache.clear()
+        status = patch.dict(connection._status, consecutive_failures=0)
+        status.start()
+        self.addCleanup(status.stop)
+
+    def _health(self, response):
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return json.loads(response.content)
+
+    def test_anonymous(self):
+        """Monitoring doesn't require a login."""
+        self.client.logout()
+        response = self._get()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self._health(response)['healthy'])
+
+    def test_in_process_state(self):
+        """Handshake and token cache state are reported."""
+        self._create_mock_connection()
+        response = self._get()
+        health = self._health(response)
+        self.assertTrue('handshake_seconds' in health)
+        self.assertEqual(health['consecutive_failures'], 0)
+        self.assertFalse('probe' in health)
+
+    def test_failing(self):
+        """Consecutive transport failures make the response unhealthy."""
+        connection._status['consecutive_failures'] = 3
+        response = self._get()
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(self._health(response)['healthy'])
+
+    @override_settings(HEALTHVAULT_HEALTH_PROBE=True)
+    def test_probe_cached(self):
+        """Live probes are cached between polls."""
+        with patch('healthvaultapp.connection.HealthVaultConn') as conn:
+            first = self._health(self._get())
+            second = self._health(self._get())
+        self.assertEqual(conn.call_count, 1)
+        self.assertTrue(first['probe']['ok'])
+        self.assertEqual(first['probe'], second['probe'])
+
+    @override_settings(HEALTHVAULT_HEALTH_PROBE=True)
+    def test_probe_failure(self):
+        """A failed probe makes the response unhealthy."""
+        with patch('healthvaultapp.connection.HealthVaultConn') as conn:
+            conn.side_effect = HealthVaultException('Unreachable')
+            response = self._get()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self._health(response)['probe']['error'],
+                'Unreachable')
+
+    @override_settings(HEALTHVAULT_HEALTH_PROBE=True)
+    def test_probe_bad_response(self):
+        """Malformed responses are reported as failed probes too."""
+        for error in (httplib.BadStatusLine(''), ET.ParseError('syntax')):
+            cache.clear()
+            with patch('healthvaultapp.connection.HealthVaultConn') as conn:
+                conn.side_effect = error
+                response = self._get()
+            self.assertEqual(response.status_code, 503)
+            self.assertFalse(self._health(response)['probe']['ok'])
+
+
+@override_settings(HEALTHVAULT_NOTIFICATION_KEYS={'1': 'sharedkey'})
+class TestNotifyView(HealthVaultTestBase):
+    """Tests for healthvaultapp.views.notify"""
+    url_name = 'healthvault-notify'
+    weight = '3d34d87e-7fc1-4153-800f-f56592cb0d17'
+    height = '40750a6a-89b2-455c-bd8d-b420a4cb500b'
+
+    def setUp(self):
+        super(TestNotifyView, self).setUp()
+        cache.clear()
+        self.client.logout()
+        self.requests = []
+
+        def receiver(sender, hvusers, datatypes, **kwargs):
+            self.requests.append((hvusers, datatypes))
+        sync_requested.connect(receiver, weak=False,
+                dispatch_uid='test-notify')
+        self.addCleanup(sync_requested.disconnect, dispatch_uid='test-notify')
+
+    def _notification(self, record_id=None, datatypes=()):
+        things = ''.join('<thing><type-id>{0}</type-id><thing-id>x'
+                '</thing-id></thing>'.format(datatype)
+                for datatype in datatypes)
+        return ('<notification><common><subscription-id>s</subscription-id>'
+                '</common><record-change-notification><person-id>p'
+                '</person-id><record-id>{0}</record-id><things>{1}</things>'
+                '</record-change-notification></notification>'.format(
+                    record_id or self.hvuser.record_id, things))
+
+    def _post(self, body, key='sharedkey', key_id='1'):
+        digest = hmac.new(key, body, hashlib.sha256).digest()
+        signature = 'HMACSHA256 {0}:{1}'.format(key_id,
+                base64.b64encode(digest))
+        return self.client.post(reverse(self.url_name), body,
+                content_type='text/xml', HTTP_X_HV_SIGNATURE=signature)
+
+    def test_sync(self):
+        """A sync of the changed types is requested for the record."""
+        response = self._post(self._notification(datatypes=[self.weight]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.requests, [([self.hvuser], [self.weight])])
+
+    def test_watermark(self):
+        """The changed types' watermarks are moved."""
+        record_id = self.hvuser.record_id
+        weight = watermarks.get_watermark(record_id, [self.weight])
+        height = watermarks.get_watermark(record_id, [self.height])
+        time.sleep(0.002)
+        self._post(self._notification(datatypes=[self.weight]))
+        self.assertTrue(watermarks.get_watermark(record_id, [self.weight]) >
+                weight)
+        self.assertEqual(watermarks.get_watermark(record_id, [self.height]),
+                height)
+
+    def test_whole_record(self):
+        """Without thing types, the whole record is synced."""
+        self._post(self._notification())
+        self.assertEqual(self.requests, [([self.hvuser], None)])
+
+    def test_dedupe(self):
+        """Repeated notifications only request a sync of new types."""
+        self._post(self._notification(datatypes=[self.weight]))
+        self._post(self._notification(datatypes=[self.weight]))
+        self._post(self._notification(datatypes=[self.weight, self.height]))
+        self.assertEqual(self.requests, [
+            ([self.hvuser], [self.weight]),
+            ([self.hvuser], [self.height]),
+        ])
+
+    def test_unknown_record(self):
+        response = self._post(self._notification(record_id='unknown'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.requests, [])
+
+    def test_bad_signature(self):
+        """Notifications which aren't signed with a known key are
+        rejected."""
+        response = self._post(self._notification(), key='wrong')
+        self.assertEqual(response.status_code, 403)
+        response = self._post(self._notification(), key_id='2')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.requests, [])
+
+    def test_bad_xml(self):
+        response = self._post('<notification>')
+        self.assertEqual(response.status_code, 400)
+
+    def test_get(self):
+        response = self._get()
+        self.assertEqual(response.status_code, 405)
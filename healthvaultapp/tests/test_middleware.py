@@ -0,0 +1,99 @@
+from mock import patch
+
+from django.db import connection
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from healthvaultapp import timing
+from healthvaultapp.connection import close_pools, HealthVaultConn
+from healthvaultapp.middleware import ServerTimingMiddleware
+from healthvaultapp.models import HealthVaultUser
+
+from .base import HealthVaultTestBase, StandInServer
+
+
+@override_settings(HEALTHVAULT_TIMING_SAMPLE_RATE=1.0)
+class TestServerTimingMiddleware(HealthVaultTestBase):
+    """Tests for healthvaultapp.middleware.ServerTimingMiddleware"""
+
+    def setUp(self):
+        super(TestServerTimingMiddleware, self).setUp()
+        self.middleware = ServerTimingMiddleware()
+        self.request = RequestFactory().get('/page/')
+        self.addCleanup(timing.stop)
+
+    def _process(self, view):
+        self.middleware.process_request(self.request)
+        response = self.middleware.process_response(self.request, view())
+        return response
+
+    def _durations(self, response):
+        durations = {}
+        for entry in response['Server-Timing'].split(', '):
+            name, duration = entry.split(';dur=')
+            durations[name] = float(duration)
+        return durations
+
+    def test_database(self):
+        """Database queries are timed, and not left logged."""
+        logged = len(connection.queries)
+
+        def view():
+            HealthVaultUser.objects.count()
+            return HttpResponse()
+        durations = self._durations(self._process(view))
+        self.assertTrue(durations['db'] >= 0)
+        self.assertTrue(durations['total'] >= durations['db'])
+        self.assertEqual(len(connection.queries), logged)
+        self.assertFalse(connection.use_debug_cursor)
+
+    def test_healthvault(self):
+        """HealthVault network, signing and parsing time are separated."""
+        server = StandInServer()
+        self.addCleanup(server.stop)
+        self.addCleanup(close_pools)
+
+        def view():
+            conn = HealthVaultConn(app_id='app', app_thumbprint='thumb',
+                    public_key=12345678L, private_key=12345678L,
+                    server=server.url, sharedsec='12345', auth_token='token')
+            conn.connect('wctoken')
+            return HttpResponse()
+        durations = self._durations(self._process(view))
+        for name in ('hv-network', 'hv-signing', 'hv-parsing'):
+            self.assertTrue(durations[name] >= 0)
+        self.assertTrue(durations['total'] >= durations['hv-network'])
+
+    def test_existing_header(self):
+        def view():
+            response = HttpResponse()
+            response['Server-Timing'] = 'cache;dur=1'
+            return response
+        response = self._process(view)
+        self.assertTrue(response['Server-Timing'].startswith('cache;dur=1, '))
+
+    def test_exception(self):
+        """Measuring stops when the view raises, even if no response
+        follows."""
+        self.middleware.process_request(self.request)
+        HealthVaultUser.objects.count()
+        self.middleware.process_exception(self.request, ValueError())
+        self.assertFalse(timing.is_active())
+        self.assertFalse(connection.use_debug_cursor)
+        response = self.middleware.process_response(self.request,
+                HttpResponse(status=500))
+        self.assertTrue('db' in self._durations(response))
+
+    @override_settings(HEALTHVAULT_TIMING_SAMPLE_RATE=0.0)
+    def test_not_sampled(self):
+        response = self._process(HttpResponse)
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertFalse(timing.is_active())
+
+    @override_settings(HEALTHVAULT_TIMING_LOG=True)
+    def test_log(self):
+        with patch('healthvaultapp.middleware.logger') as logger:
+            self._process(HttpResponse)
+        extra = logger.info.call_args[1]['extra']
+        self.assertTrue('total' in extra['healthvault_timing'])
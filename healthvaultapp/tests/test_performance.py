@@ -0,0 +1,218 @@
+import json
+from mock import patch
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+from django.contrib.sessions.backends.db import SessionStore
+from django.core import signing
+from django.test.utils import override_settings
+
+from healthvaultlib.targets import ApplicationTarget
+
+from healthvaultapp import fanout, utils
+from healthvaultapp.views import (NEXT_GET_PARAM, NEXT_SESSION_KEY,
+        NEXT_STATE_PARAM, NEXT_STATE_SALT)
+
+from .base import (HealthVaultTestBase, MockHealthVaultConnection,
+        things_response, WEIGHT, WEIGHT_THING)
+
+
+class PerformanceTestBase(HealthVaultTestBase):
+    """
+    Pins the database queries, session writes and HealthVault connections
+    made by each view, plus a generous wall-clock budget with HealthVault
+    stubbed out. If one of these tests fails, make sure the extra work is
+    intended before updating its numbers.
+    """
+    url_name = None
+    time_budget = 0.5  # Seconds.
+
+    def _assertBudget(self, queries, session_saves, connections,
+            get_params=None):
+        save = SessionStore.save
+        with patch('healthvaultapp.connection.HealthVaultConn') as conn:
+            conn.return_value = MockHealthVaultConnection(
+                    record_id=self.record_id,
+                    auth_url=self.authorization_url,
+                    deauth_url=self.deauthorization_url)
+            with patch.object(SessionStore, 'save', autospec=True,
+                    side_effect=save) as saves:
+                start = time.time()
+                with self.assertNumQueries(queries):
+                    response = self._get(get_params=get_params)
+                elapsed = time.time() - start
+        self.assertEqual(saves.call_count, session_saves)
+        self.assertEqual(conn.call_count, connections)
+        self.assertTrue(elapsed < self.time_budget,
+                'Took {0:.3f}s'.format(elapsed))
+        return response
+
+
+class TestAuthorizePerformance(PerformanceTestBase):
+    url_name = 'healthvault-authorize'
+
+    def test_authorize(self):
+        self._assertBudget(queries=3, session_saves=0, connections=1)
+
+    def test_authorize_next(self):
+        self._assertBudget(queries=6, session_saves=1, connections=1,
+                get_params={NEXT_GET_PARAM: '/next'})
+
+    @override_settings(HEALTHVAULT_NEXT_IN_STATE=True)
+    def test_authorize_next_in_state(self):
+        self._assertBudget(queries=3, session_saves=0, connections=1,
+                get_params={NEXT_GET_PARAM: '/next'})
+
+
+class TestDeauthorizePerformance(PerformanceTestBase):
+    url_name = 'healthvault-deauthorize'
+
+    def test_deauthorize(self):
+        self._assertBudget(queries=4, session_saves=0, connections=1)
+
+    def test_unintegrated(self):
+        self.hvuser.delete()
+        self._assertBudget(queries=3, session_saves=0, connections=0)
+
+
+class TestCompletePerformance(PerformanceTestBase):
+    url_name = 'healthvault-complete'
+
+    def setUp(self):
+        super(TestCompletePerformance, self).setUp()
+        self._set_session_vars(**{NEXT_SESSION_KEY: '/next'})
+
+    def test_app_auth_success(self):
+        self._assertBudget(queries=10, session_saves=1, connections=1,
+                get_params={'target': ApplicationTarget.APP_AUTH_SUCCESS,
+                            'wctoken': self.token})
+
+    def test_selected_record_changed(self):
+        self._assertBudget(queries=10, session_saves=1, connections=1,
+                get_params={
+                    'target': ApplicationTarget.SELECTED_RECORD_CHANGED,
+                    'wctoken': self.token})
+
+    def test_app_auth_reject(self):
+        self._assertBudget(queries=6, session_saves=1, connections=0,
+                get_params={'target': ApplicationTarget.APP_AUTH_REJECT})
+
+    def test_sign_out(self):
+        self._assertBudget(queries=6, session_saves=1, connections=0,
+                get_params={'target': ApplicationTarget.SIGN_OUT})
+
+
+@override_settings(HEALTHVAULT_NEXT_IN_STATE=True)
+class TestNextInStatePerformance(PerformanceTestBase):
+    url_name = 'healthvault-complete'
+
+    def test_app_auth_success(self):
+        self._assertBudget(queries=7, session_saves=0, connections=1,
+                get_params={'target': ApplicationTarget.APP_AUTH_SUCCESS,
+                            'wctoken': self.token,
+                            NEXT_STATE_PARAM: signing.dumps('/next',
+                                    salt=NEXT_STATE_SALT)})
+
+
+class TestErrorPerformance(PerformanceTestBase):
+    url_name = 'healthvault-error'
+
+    def test_error(self):
+        self._set_session_vars(**{NEXT_SESSION_KEY: '/next'})
+        self._assertBudget(queries=5, session_saves=1, connections=0)
+
+    @override_settings(HEALTHVAULT_NEXT_IN_STATE=True)
+    def test_error_next_in_state(self):
+        self._assertBudget(queries=2, session_saves=0, connections=0)
+
+
+class TestIsIntegratedPerformance(HealthVaultTestBase):
+
+    def test_is_integrated(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(utils.is_integrated(self.user))
+
+    @override_settings(HEALTHVAULT_USER_CACHE_SIZE=10)
+    @patch('healthvaultapp.usercache._cache', None)
+    def test_cached(self):
+        utils.is_integrated(self.user)
+        with self.assertNumQueries(0):
+            self.assertTrue(utils.is_integrated(self.user))
+
+
+class TestOffloadPerformance(HealthVaultTestBase):
+    """
+    Checks that GetThings responses parsed by a pool of worker processes, as
+    by ``fetch_things(processes=...)``, match those parsed in this process.
+    What offloading saves depends on the machine's cores and load, so it
+    isn't timed here.
+    """
+    responses = 4
+    things = 50
+
+    def setUp(self):
+        super(TestOffloadPerformance, self).setUp()
+        self.groups = [{'datatype': WEIGHT}]
+        body = things_response([WEIGHT_THING.format(i, 80, 176)
+                for i in range(self.things)])
+        self.batch = [(body, None)] * self.responses
+
+    def test_offloaded(self):
+        with patch.object(fanout, '_worker_groups', self.groups):
+            inline = fanout._parse_batch(self.batch)
+        pool = multiprocessing.Pool(2, fanout._init_worker, (self.groups,))
+        try:
+            half = self.responses // 2
+            offloaded = sum(pool.map(fanout._parse_batch,
+                    [self.batch[:half], self.batch[half:]]), [])
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual(offloaded, inline)
+        self.assertEqual(len(inline[0][0][0]), self.things)
+
+
+# Imports the app's modules which are loaded on every request or command,
+# in a fresh interpreter.
+IMPORT_SCRIPT = """
+import json, sys, time
+from django.conf import settings
+settings.configure(INSTALLED_APPS=('django.contrib.auth',
+        'django.contrib.contenttypes', 'healthvaultapp'),
+        ROOT_URLCONF='healthvaultapp.urls')
+import django
+if hasattr(django, 'setup'):
+    django.setup()
+start = time.time()
+import healthvaultapp.admin, healthvaultapp.middleware, healthvaultapp.urls
+import healthvaultapp.templatetags.healthvault
+print(json.dumps({'seconds': time.time() - start,
+                  'modules': sorted(sys.modules)}))
+"""
+
+
+class TestStartupPerformance(HealthVaultTestBase):
+    """
+    Checks that importing the app doesn't load the HealthVault client stack,
+    which takes most of its import time, and stays within a time budget.
+    """
+    time_budget = 0.5  # Seconds.
+    lazy_modules = ('healthvaultlib.healthvault', 'healthvaultlib.hvcrypto',
+            'multiprocessing')
+
+    def test_import(self):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([root] + sys.path)
+        output = subprocess.Popen([sys.executable, '-c', IMPORT_SCRIPT],
+                stdout=subprocess.PIPE, env=env).communicate()[0]
+        result = json.loads(output.splitlines()[-1])
+        for module in self.lazy_modules:
+            self.assertFalse(module in result['modules'],
+                    '{0} was imported'.format(module))
+        self.assertTrue(result['seconds'] < self.time_budget,
+                'Took {0:.3f}s'.format(result['seconds']))
@@ -0,0 +1,107 @@
+from datetime import date, datetime
+from mock import patch
+
+from django.db import IntegrityError
+from django.utils import unittest
+
+from healthvaultapp import rollups
+from healthvaultapp.models import HealthVaultRollup
+
+from .base import HealthVaultTestBase, WEIGHT
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class TestRollups(HealthVaultTestBase):
+    """Tests for healthvaultapp.rollups"""
+
+    def setUp(self):
+        super(TestRollups, self).setUp()
+        self.things = [
+            # Wednesday, Thursday and Friday of one week.
+            {'when': datetime(2014, 1, 29, 8), 'kg': 80.0},
+            {'when': datetime(2014, 1, 29, 20), 'kg': 82.0},
+            {'when': datetime(2014, 1, 30, 8), 'kg': 81.0},
+            {'when': datetime(2014, 1, 31, 8), 'kg': 79.0},
+            # Saturday, in a new month.
+            {'when': datetime(2014, 2, 1, 8), 'kg': 78.0},
+        ]
+
+    def _rollups(self, period):
+        return list(rollups.get_rollups(self.record_id, WEIGHT, 'kg', period))
+
+    def test_aggregate(self):
+        times, values = rollups.to_arrays(reversed(self.things), 'kg')
+        starts, counts, totals, minimums, maximums = rollups.aggregate(
+                times, values, 'week')
+        self.assertEqual([start.item() for start in starts],
+                [date(2014, 1, 27)])
+        self.assertEqual(list(counts), [5])
+        self.assertEqual(list(totals), [400.0])
+        self.assertEqual(list(minimums), [78.0])
+        self.assertEqual(list(maximums), [82.0])
+
+    def test_update(self):
+        """Daily, weekly and monthly rollups are created."""
+        changed = rollups.update_rollups(self.record_id, WEIGHT, 'kg',
+                self.things)
+        self.assertEqual(changed, 4 + 1 + 2)
+        days = self._rollups('day')
+        self.assertEqual([rollup.start for rollup in days], [date(2014, 1, 29),
+                date(2014, 1, 30), date(2014, 1, 31), date(2014, 2, 1)])
+        self.assertEqual((days[0].count, days[0].mean, days[0].minimum,
+                days[0].maximum), (2, 81.0, 80.0, 82.0))
+        months = self._rollups('month')
+        self.assertEqual([(rollup.start, rollup.count) for rollup in months],
+                [(date(2014, 1, 1), 4), (date(2014, 2, 1), 1)])
+
+    def test_incremental(self):
+        """New things are merged into existing rollups."""
+        rollups.update_rollups(self.record_id, WEIGHT, 'kg', self.things[:2])
+        with self.assertNumQueries(3 * 2 + 3):
+            rollups.update_rollups(self.record_id, WEIGHT, 'kg',
+                    self.things[2:])
+        weeks = self._rollups('week')
+        self.assertEqual(len(weeks), 1)
+        self.assertEqual((weeks[0].count, weeks[0].total, weeks[0].minimum,
+                weeks[0].maximum), (5, 400.0, 78.0, 82.0))
+        self.assertEqual(HealthVaultRollup.objects.count(), 4 + 1 + 2)
+
+    def test_concurrent_create(self):
+        """Rollups another sync creates first are updated on a retry."""
+        update = rollups._update_rollups
+        calls = []
+
+        def concurrent(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                update(self.record_id, WEIGHT, 'kg',
+                        *rollups.to_arrays(self.things[:1], 'kg'))
+                raise IntegrityError('duplicate key')
+            return update(*args)
+        with patch.object(rollups, '_update_rollups', concurrent):
+            rollups.update_rollups(self.record_id, WEIGHT, 'kg', self.things)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self._rollups('week')[0].count, 6)
+
+    def test_nested_field(self):
+        things = [{'when': datetime(2014, 1, 29), 'value': {'mmolperl': 5.5}},
+                  {'when': datetime(2014, 1, 29), 'value': {}}]
+        rollups.update_rollups(self.record_id, WEIGHT, 'value.mmolperl',
+                things)
+        rollup = rollups.get_rollups(self.record_id, WEIGHT, 'value.mmolperl',
+                'day').get()
+        self.assertEqual((rollup.count, rollup.total), (1, 5.5))
+
+    def test_no_values(self):
+        self.assertEqual(rollups.update_rollups(self.record_id, WEIGHT, 'kg',
+                [{'when': datetime(2014, 1, 29)}]), 0)
+
+    def test_bad_period(self):
+        times, values = rollups.to_arrays(self.things, 'kg')
+        with self.assertRaises(ValueError):
+            rollups.aggregate(times, values, 'year')
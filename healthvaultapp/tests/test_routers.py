@@ -0,0 +1,114 @@
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from healthvaultapp import routers
+from healthvaultapp.middleware import ReplicaPinningMiddleware
+from healthvaultapp.models import HealthVaultRollup, HealthVaultUser
+
+from .base import HealthVaultTestBase
+
+
+@override_settings(HEALTHVAULT_READ_DATABASE='replica')
+class TestHealthVaultRouter(HealthVaultTestBase):
+    """Tests for healthvaultapp.routers.HealthVaultRouter"""
+
+    def setUp(self):
+        super(TestHealthVaultRouter, self).setUp()
+        self.router = routers.HealthVaultRouter()
+        routers.unpin()
+        self.addCleanup(routers.unpin)
+
+    def test_read(self):
+        """Reads go to the replica."""
+        self.assertEqual(self.router.db_for_read(HealthVaultUser), 'replica')
+        self.assertEqual(self.router.db_for_read(User), None)
+        self.assertEqual(self.router.db_for_read(HealthVaultRollup), None)
+
+    @override_settings(HEALTHVAULT_READ_DATABASE=None)
+    def test_no_replica(self):
+        self.assertEqual(self.router.db_for_read(HealthVaultUser), 'default')
+
+    def test_write(self):
+        """Writes go to the default database, and pin reads to it."""
+        self.assertEqual(self.router.db_for_write(HealthVaultUser), 'default')
+        self.assertTrue(routers.has_written())
+        self.assertEqual(self.router.db_for_read(HealthVaultUser), 'default')
+        self.assertEqual(self.router.db_for_write(User), None)
+
+    @override_settings(HEALTHVAULT_REPLICA_PIN_SECONDS=-1)
+    def test_pin_expires(self):
+        self.router.db_for_write(HealthVaultUser)
+        self.assertEqual(self.router.db_for_read(HealthVaultUser), 'replica')
+
+    def test_allow_relation(self):
+        self.assertTrue(self.router.allow_relation(self.hvuser, self.user))
+        self.assertEqual(self.router.allow_relation(self.user, self.user),
+                None)
+
+    def test_allow_migrate(self):
+        self.assertTrue(self.router.allow_migrate('default', HealthVaultUser))
+        self.assertFalse(self.router.allow_migrate('replica',
+                HealthVaultUser))
+        self.assertEqual(self.router.allow_migrate('replica', User), None)
+
+
+@override_settings(HEALTHVAULT_READ_DATABASE='replica')
+class TestReplicaPinningMiddleware(HealthVaultTestBase):
+    """Tests for healthvaultapp.middleware.ReplicaPinningMiddleware"""
+
+    def setUp(self):
+        super(TestReplicaPinningMiddleware, self).setUp()
+        self.middleware = ReplicaPinningMiddleware()
+        self.router = routers.HealthVaultRouter()
+        self.factory = RequestFactory()
+        self.addCleanup(routers.unpin)
+
+    def _process(self, request, view):
+        self.middleware.process_request(request)
+        return self.middleware.process_response(request, view())
+
+    def test_write(self):
+        """A request which writes sets the pinning cookie."""
+        def view():
+            self.router.db_for_write(HealthVaultUser)
+            return HttpResponse()
+        response = self._process(self.factory.get('/'), view)
+        cookie = response.cookies[ReplicaPinningMiddleware.cookie_name]
+        self.assertEqual(cookie['max-age'], 5)
+
+    def test_read(self):
+        """Requests which only read don't set the cookie, and aren't pinned
+        by earlier requests in the same thread."""
+        routers.pin_to_primary()
+        reads = []
+
+        def view():
+            reads.append(self.router.db_for_read(HealthVaultUser))
+            return HttpResponse()
+        response = self._process(self.factory.get('/'), view)
+        self.assertEqual(reads, ['replica'])
+        self.assertFalse(ReplicaPinningMiddleware.cookie_name in
+                response.cookies)
+
+    def test_exception(self):
+        """Views which raise after writing don't leave the thread pinned,
+        and still set the cookie if a response follows."""
+        request = self.factory.get('/')
+        self.middleware.process_request(request)
+        self.router.db_for_write(HealthVaultUser)
+        self.middleware.process_exception(request, ValueError())
+        self.assertFalse(routers.is_pinned())
+        self.assertFalse(routers.has_written())
+        response = self.middleware.process_response(request,
+                HttpResponse(status=500))
+        self.assertTrue(ReplicaPinningMiddleware.cookie_name in
+                response.cookies)
+
+    def test_cookie(self):
+        """Requests with the cookie read from the default database."""
+        request = self.factory.get('/')
+        request.COOKIES[ReplicaPinningMiddleware.cookie_name] = '1'
+        self.middleware.process_request(request)
+        self.assertEqual(self.router.db_for_read(HealthVaultUser), 'default')
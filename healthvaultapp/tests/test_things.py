@@ -0,0 +1,230 @@
+import datetime
+from mock import patch
+import re
+import threading
+import time
+
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.test.utils import override_settings
+
+from healthvaultlib.exceptions import HealthVaultException
+
+from healthvaultapp import connection, things
+from healthvaultapp.connection import HealthVaultConn
+from healthvaultapp.things import Projection
+
+from .base import (HealthVaultTestBase, StandInServer, things_response,
+        WEIGHT, WEIGHT_THING)
+
+
+class ThingsTestBase(HealthVaultTestBase):
+
+    def setUp(self):
+        super(ThingsTestBase, self).setUp()
+        connection.close_pools()
+        self.server = StandInServer()
+        self.conn = HealthVaultConn(app_id='app', app_thumbprint='thumb',
+                public_key=12345678L, private_key=12345678L,
+                server=self.server.url, sharedsec='12345',
+                auth_token='token', wctoken='wctoken', record_id='record')
+
+    def tearDown(self):
+        connection.close_pools()
+        self.server.stop()
+        super(ThingsTestBase, self).tearDown()
+
+
+class TestGetThings(ThingsTestBase):
+    """Tests for healthvaultapp.things.get_things"""
+
+    def setUp(self):
+        super(TestGetThings, self).setUp()
+        self.server.respond = self._respond
+        # The most things HealthVault returns in full for a group.
+        self.full = 2
+        self.in_flight = self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def _respond(self, request):
+        """Answers with things whose weight is their index, leaving all but
+        the first ``full`` of them unprocessed."""
+        ids = re.findall(r'<id>(\d+)</id>', request)
+        if not ids:
+            ids = [str(i) for i in range(12)]
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.in_flight, self.max_in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= 1
+        group = [WEIGHT_THING.format(id, id, id) for id in ids[:self.full]]
+        group += ['<unprocessed-thing-key-info><thing-id>{0}</thing-id>'
+                '</unprocessed-thing-key-info>'.format(id)
+                for id in ids[self.full:]]
+        return 200, things_response(group), {}
+
+    def _weights(self, results):
+        return [int(thing['kg']) for thing in results]
+
+    def test_pages(self):
+        """Unprocessed things are fetched by key, in order."""
+        self.full = 3
+        results = things.get_things(self.conn, WEIGHT, workers=2,
+                page_size=3)
+        self.assertEqual(self._weights(results), range(12))
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertTrue('<type-id>' + WEIGHT in self.server.requests[0])
+        self.assertTrue('<id>3</id><id>4</id><id>5</id>' in
+                self.server.requests[1])
+        self.assertEqual(self.max_in_flight, 2)
+
+    def test_partial_pages(self):
+        """Things left unprocessed by a page are fetched before later
+        pages'."""
+        results = things.get_things(self.conn, WEIGHT, workers=1,
+                page_size=4)
+        self.assertEqual(self._weights(results), range(12))
+        results = things.get_things(self.conn, WEIGHT, workers=3,
+                page_size=4)
+        self.assertEqual(self._weights(results), range(12))
+
+    def test_no_progress(self):
+        """Pages which HealthVault leaves wholly unprocessed fail."""
+        self.full = 0
+        with self.assertRaises(HealthVaultException):
+            list(things.get_things(self.conn, WEIGHT, workers=2,
+                    page_size=4))
+
+    def test_lazy(self):
+        """Pages are only requested as the iterator is consumed."""
+        results = things.get_things(self.conn, WEIGHT, workers=1,
+                page_size=2)
+        self.assertEqual(len(self.server.requests), 0)
+        self.assertEqual(self._weights([next(results), next(results)]),
+                [0, 1])
+        self.assertEqual(len(self.server.requests), 1)
+        results.close()
+
+    def test_complete(self):
+        """Groups without unprocessed things take one request."""
+        self.full = 12
+        results = list(things.get_things(self.conn, WEIGHT, max=12))
+        self.assertEqual(len(results), 12)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue('<group max="12">' in self.server.requests[0])
+
+    def test_error(self):
+        """Errors fetching a page are raised by the iterator."""
+        self.server.respond = None
+        self.server.responses = [(200, things_response(['<thing>'
+                '<type-id>unknown</type-id></thing>']), {})]
+        with self.assertRaises(HealthVaultException):
+            list(things.get_things(self.conn, WEIGHT))
+
+
+class TestProjection(ThingsTestBase):
+    """Tests for healthvaultapp.things.Projection"""
+
+    def test_default(self):
+        """By default, groups are as python-healthvault builds them."""
+        kwargs = {'datatype': WEIGHT, 'max': 5, 'filter': '<x/>',
+                'min_date': datetime.datetime(2014, 1, 1),
+                'max_date': datetime.datetime(2014, 2, 1)}
+        self.assertEqual(things.build_group(**kwargs),
+                self.conn._build_thing_group(**kwargs))
+
+    def test_sections(self):
+        projection = Projection(sections=['tags', 'core'], xml=False)
+        self.assertEqual(projection.format_xml(), '<format>'
+                '<section>core</section><section>tags</section></format>')
+        self.assertFalse(projection.parsed)
+        with self.assertRaises(ValueError):
+            Projection(sections=['core', 'everything'])
+
+    def test_transform(self):
+        projection = Projection(transform='form')
+        self.assertTrue('<xml>form</xml>' in projection.format_xml())
+        self.assertFalse(projection.parsed)
+
+    def test_xpath(self):
+        """XPath filters are escaped into the group's filter."""
+        group = things.build_group(WEIGHT,
+                projection=Projection(xpath='/thing[kg < 80]'))
+        self.assertTrue('<xpath>/thing[kg &lt; 80]</xpath></filter>' in
+                group)
+        group = things.build_group(ids=['a'],
+                projection=Projection(xpath='/thing'))
+        self.assertFalse('xpath' in group)
+
+    def test_equality(self):
+        self.assertEqual(Projection(sections=['core', 'tags']),
+                Projection(sections=['tags', 'core']))
+        self.assertEqual(len(set([Projection(), Projection()])), 1)
+        self.assertNotEqual(Projection(), Projection(xpath='/thing'))
+
+    def test_unparsed(self):
+        """Things which can't be parsed are returned as elements."""
+        self.server.body = things_response([WEIGHT_THING.format('a', 80,
+                176)])
+        results = list(things.get_things(self.conn, WEIGHT,
+                projection=Projection(transform='form')))
+        self.assertEqual(results[0].findtext('thing-id'), 'a')
+        self.assertTrue('<xml>form</xml>' in self.server.requests[0])
+
+
+class TestPrefetch(ThingsTestBase):
+    """Tests for healthvaultapp.things.prefetch_things"""
+
+    def setUp(self):
+        super(TestPrefetch, self).setUp()
+        cache.clear()
+
+    def test_prefetch(self):
+        self.server.body = things_response([WEIGHT_THING.format('a', 80,
+                176)])
+        self.assertEqual(things.get_prefetched_things('record', WEIGHT),
+                None)
+        things.schedule_prefetch(self.conn, [WEIGHT]).get()
+        prefetched = things.get_prefetched_things('record', WEIGHT)
+        self.assertEqual([thing['kg'] for thing in prefetched], [80.0])
+        self.assertEqual(things.get_prefetched_things('other', WEIGHT), None)
+        self.assertTrue('<group max="240">' in self.server.requests[0])
+
+    @override_settings(HEALTHVAULT_PREFETCH_WORKERS=1)
+    def test_workers(self):
+        """Prefetches share a pool of HEALTHVAULT_PREFETCH_WORKERS threads."""
+        self.server.body = things_response([WEIGHT_THING.format('a', 80,
+                176)])
+        with patch('healthvaultapp.things._prefetch_pool', None):
+            results = [things.schedule_prefetch(self.conn, [WEIGHT], max=1)
+                    for i in range(3)]
+            for result in results:
+                result.get()
+            self.assertEqual(len(things._prefetch_pool._pool), 1)
+            things._prefetch_pool.terminate()
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertTrue('<group max="1">' in self.server.requests[0])
+
+    def test_not_stored(self):
+        """Things which the cache doesn't store are logged."""
+        self.server.body = things_response([WEIGHT_THING.format('a', 80,
+                176)])
+        with patch('healthvaultapp.things.cache', DummyCache('', {})):
+            with patch('healthvaultapp.things.logging') as mock_logging:
+                things.prefetch_things(self.conn, [WEIGHT])
+        self.assertTrue(
+                mock_logging.getLogger.return_value.warning.called)
+
+    def test_error(self):
+        """Errors leave only the failing data type uncached."""
+        height = '40750a6a-89b2-455c-bd8d-b420a4cb500b'
+        self.server.responses = [
+            (200, things_response(['<thing><type-id>unknown</type-id>'
+                    '</thing>']), {}),
+            (200, things_response([WEIGHT_THING.format('a', 80, 176)]), {}),
+        ]
+        things.prefetch_things(self.conn, [height, WEIGHT])
+        self.assertEqual(things.get_prefetched_things('record', height), None)
+        self.assertEqual(len(things.get_prefetched_things('record', WEIGHT)),
+                1)
@@ -0,0 +1,61 @@
+from django.utils import unittest
+
+from healthvaultapp import units
+
+from .base import HealthVaultTestBase
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class TestUnits(HealthVaultTestBase):
+    """Tests for healthvaultapp.units"""
+
+    def assertClose(self, first, second):
+        self.assertTrue(numpy.allclose(first, second),
+                '{0} != {1}'.format(first, second))
+
+    def test_normalize(self):
+        self.assertClose(units.normalize([100, 200], 'lb', 'kg'),
+                [45.359237, 90.718474])
+        self.assertClose(units.normalize([1.0], 'kg', 'lbs'), [2.20462262])
+
+    def test_normalize_mixed(self):
+        """Each value may have its own unit."""
+        values = units.normalize([90.091, 5.0, 180.182],
+                ['mg/dL', 'mmol/L', 'mg/dL'], 'mmol/L')
+        self.assertClose(values, [5.0, 5.0, 10.0])
+
+    def test_normalize_bad_unit(self):
+        with self.assertRaises(ValueError):
+            units.normalize([1], 'furlong', 'm')
+        with self.assertRaises(ValueError):
+            units.normalize([1], ['kg', 'cm'], 'kg')
+
+    def test_validate(self):
+        valid = units.validate([70, 0, 1000, float('nan')], 'kg')
+        self.assertEqual(list(valid), [True, False, False, False])
+        # Ranges are converted into the given unit.
+        self.assertEqual(list(units.validate([150, 1500], 'lb')),
+                [True, False])
+        self.assertEqual(list(units.validate([5, 15], 'kg', bounds=(1, 10))),
+                [True, False])
+
+    def test_flag_outliers(self):
+        outliers = units.flag_outliers([80, 81, 79, 80.5, 180, 80])
+        self.assertEqual(list(outliers),
+                [False, False, False, False, True, False])
+        self.assertFalse(units.flag_outliers([80, 80, 80]).any())
+        self.assertEqual(len(units.flag_outliers([])), 0)
+
+    def test_clean(self):
+        values, valid, outliers = units.clean(
+                [176, 178, 80, 177, 5000, 400], ['lb', 'lb', 'kg', 'lb',
+                'lb', 'lb'], 'kg')
+        self.assertClose(values[:2], [79.832257, 80.739442])
+        self.assertEqual(list(valid), [True, True, True, True, False, True])
+        self.assertEqual(list(outliers),
+                [False, False, False, False, False, True])
@@ -0,0 +1,110 @@
+from mock import patch
+
+from django.core.cache import cache
+from django.db.models.signals import post_delete
+from django.test.utils import override_settings
+
+from healthvaultapp import usercache, utils
+from healthvaultapp.models import HealthVaultUser
+from healthvaultapp.usercache import LRUCache
+
+from .base import HealthVaultTestBase
+
+
+class TestLRUCache(HealthVaultTestBase):
+    """Tests for healthvaultapp.usercache.LRUCache"""
+
+    def test_eviction(self):
+        """The least recently used entry is evicted first."""
+        lru = LRUCache(size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(len(lru), 2)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual((lru.get('a'), lru.get('c')), (1, 3))
+        self.assertEqual(lru.stats, {'hits': 3, 'misses': 1, 'evictions': 1})
+
+    def test_replace(self):
+        lru = LRUCache(size=2)
+        lru.set('a', 1)
+        lru.set('a', 2)
+        self.assertEqual(len(lru), 1)
+        self.assertEqual(lru.get('a'), 2)
+
+    def test_ttl(self):
+        lru = LRUCache(ttl=-1)
+        lru.set('a', 1)
+        self.assertEqual(lru.get('a', 'missing'), 'missing')
+        self.assertEqual(len(lru), 0)
+
+    def test_delete(self):
+        lru = LRUCache()
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.delete('a')
+        lru.delete('missing')
+        self.assertEqual((lru.get('a'), lru.get('b')), (None, 2))
+        lru.clear()
+        self.assertEqual(len(lru), 0)
+
+
+@override_settings(HEALTHVAULT_USER_CACHE_SIZE=10,
+        HEALTHVAULT_USER_CACHE_REVALIDATE=60)
+class TestUserCache(HealthVaultTestBase):
+    """Tests for healthvaultapp.usercache.get_user"""
+
+    def setUp(self):
+        super(TestUserCache, self).setUp()
+        cache.clear()
+        lru = patch('healthvaultapp.usercache._cache', None)
+        lru.start()
+        self.addCleanup(lru.stop)
+
+    def test_cached(self):
+        self.assertEqual(utils.get_healthvault_user(self.user), self.hvuser)
+        with self.assertNumQueries(0):
+            self.assertEqual(utils.get_healthvault_user(self.user),
+                    self.hvuser)
+
+    def test_not_integrated(self):
+        """Users without a row are cached too."""
+        self.hvuser.delete()
+        self.assertEqual(utils.get_healthvault_user(self.user), None)
+        with self.assertNumQueries(0):
+            self.assertFalse(utils.is_integrated(self.user))
+
+    @override_settings(HEALTHVAULT_USER_CACHE_SIZE=0)
+    def test_disabled(self):
+        utils.get_healthvault_user(self.user)
+        with self.assertNumQueries(1):
+            utils.get_healthvault_user(self.user)
+        # Without a delete receiver, Django deletes rows without fetching
+        # them first.
+        self.assertFalse(post_delete.has_listeners(HealthVaultUser))
+
+    def test_save(self):
+        """Saving or deleting a row invalidates it."""
+        utils.get_healthvault_user(self.user)
+        self.hvuser.token = 'new'
+        self.hvuser.save()
+        self.assertEqual(utils.get_healthvault_user(self.user).token, 'new')
+        HealthVaultUser.objects.filter(user=self.user).delete()
+        self.assertFalse(utils.is_integrated(self.user))
+
+    def test_other_process(self):
+        """Rows changed elsewhere are reloaded when they are revalidated."""
+        utils.get_healthvault_user(self.user)
+        # Another process bumps the version, but doesn't touch our cache.
+        with patch.object(usercache.LRUCache, 'delete'):
+            HealthVaultUser.objects.filter(pk=self.hvuser.pk).delete()
+        self.assertEqual(utils.get_healthvault_user(self.user), self.hvuser)
+        with override_settings(HEALTHVAULT_USER_CACHE_REVALIDATE=0):
+            self.assertEqual(utils.get_healthvault_user(self.user), None)
+
+    def test_revalidate_unchanged(self):
+        utils.get_healthvault_user(self.user)
+        with override_settings(HEALTHVAULT_USER_CACHE_REVALIDATE=0):
+            with self.assertNumQueries(0):
+                utils.get_healthvault_user(self.user)
@@ -1,3 +1,4 @@
+import datetime
 from mock import patch
 
 from django.conf import settings
@@ -6,8 +7,12 @@ from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.http import HttpRequest
 from django.test.utils import override_settings
+from django.utils import timezone
 
+from healthvaultlib.exceptions import (HealthVaultHTTPException,
+        HealthVaultTokenExpiredException)
 from healthvaultlib.healthvault import HealthVaultException
+from healthvaultlib.status_codes import HealthVaultStatus
 
 from healthvaultapp import utils
 from healthvaultapp.models import HealthVaultUser
@@ -74,6 +79,104 @@ class TestConnectionUtility(HealthVaultTestBase):
             connection = self._create_mock_connection(side_effect=side_effect)
 
 
+class TestOfflineConnectionUtility(HealthVaultTestBase):
+    """Tests for healthvaultapp.utils.create_offline_connection"""
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_offline(self, conn_class):
+        utils.create_offline_connection('person', 'record')
+        kwargs = conn_class.call_args[1]
+        self.assertEqual(kwargs['offline_person_id'], 'person')
+        self.assertEqual(kwargs['record_id'], 'record')
+        self.assertEqual(kwargs['wctoken'], None)
+
+    def test_missing_ids(self):
+        """Both the person and the record must be known."""
+        with self.assertRaises(ValueError):
+            utils.create_offline_connection('', 'record')
+        with self.assertRaises(ValueError):
+            utils.create_offline_connection('person', None)
+
+
+class TestTokenTracking(HealthVaultTestBase):
+    """Tests for tracking the usability of users' tokens"""
+
+    def setUp(self):
+        super(TestTokenTracking, self).setUp()
+        self.past = timezone.now() - datetime.timedelta(hours=1)
+
+    def _hvuser(self):
+        return HealthVaultUser.objects.get(pk=self.hvuser.pk)
+
+    def test_usable(self):
+        self.assertTrue(utils.is_token_usable(self.hvuser))
+        self.assertEqual(list(utils.usable_tokens(
+                HealthVaultUser.objects.all())), [self.hvuser])
+
+    def test_expired(self):
+        """Tokens past their expiry aren't usable."""
+        HealthVaultUser.objects.update(token_expires=self.past)
+        self.assertFalse(utils.is_token_usable(self._hvuser()))
+        self.assertEqual(list(utils.usable_tokens(
+                HealthVaultUser.objects.all())), [])
+
+    def test_failures(self):
+        """Tokens which keep failing aren't usable."""
+        HealthVaultUser.objects.update(token_failures=5)
+        self.assertFalse(utils.is_token_usable(self._hvuser()))
+        self.assertEqual(utils.usable_tokens(
+                HealthVaultUser.objects.all()).count(), 0)
+        with override_settings(HEALTHVAULT_TOKEN_MAX_FAILURES=None):
+            self.assertTrue(utils.is_token_usable(self._hvuser()))
+            self.assertEqual(utils.usable_tokens(
+                    HealthVaultUser.objects.all()).count(), 1)
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_create_user_connection(self, conn_class):
+        utils.create_user_connection(self.hvuser)
+        self.assertEqual(conn_class.call_args[1]['wctoken'],
+                self.hvuser.token)
+        self.assertEqual(conn_class.call_args[1]['record_id'],
+                self.hvuser.record_id)
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_create_user_connection_expired(self, conn_class):
+        """HealthVault isn't called with tokens known to have expired."""
+        self.hvuser.token_expires = self.past
+        with self.assertRaises(HealthVaultTokenExpiredException):
+            utils.create_user_connection(self.hvuser)
+        self.assertFalse(conn_class.called)
+
+    def test_record_results(self):
+        other = self.create_healthvault_user(token_failures=2)
+        expired = HealthVaultTokenExpiredException(
+                code=HealthVaultStatus.CREDENTIAL_TOKEN_EXPIRED)
+        utils.record_token_results([(self.hvuser, None),
+                (other, HealthVaultException())])
+        self.assertEqual(self._hvuser().token_failures, 0)
+        self.assertTrue(self._hvuser().token_used is not None)
+        self.assertEqual(HealthVaultUser.objects.get(pk=other.pk)
+                .token_failures, 3)
+
+        utils.record_token_results([(self.hvuser, expired),
+                (other, HealthVaultHTTPException(code=500))])
+        self.assertFalse(utils.is_token_usable(self._hvuser()))
+        self.assertEqual(HealthVaultUser.objects.get(pk=other.pk)
+                .token_failures, 3)
+
+    @patch('healthvaultapp.connection.HealthVaultConn')
+    def test_resolve_record_ids(self, conn_class):
+        """Only users with usable tokens are resolved, and the outcomes are
+        recorded."""
+        self.create_healthvault_user(token_expires=self.past)
+        conn_class.side_effect = HealthVaultException
+        updated, failed = utils.resolve_record_ids(
+                HealthVaultUser.objects.all())
+        self.assertEqual((updated, failed), (0, 1))
+        self.assertEqual(conn_class.call_count, 1)
+        self.assertEqual(self._hvuser().token_failures, 1)
+
+
 class TestCallbackURLUtility(HealthVaultTestBase):
     """Tests for healthvaultapp.utils.get_callback_url"""
 
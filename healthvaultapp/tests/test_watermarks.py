@@ -0,0 +1,137 @@
+from mock import patch
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from healthvaultapp import watermarks
+from healthvaultapp.models import HealthVaultUser
+
+from .base import HealthVaultTestBase, WEIGHT
+
+
+HEIGHT = '40750a6a-89b2-455c-bd8d-b420a4cb500b'
+
+
+class TestWatermarks(HealthVaultTestBase):
+    """Tests for healthvaultapp.watermarks"""
+
+    def setUp(self):
+        super(TestWatermarks, self).setUp()
+        cache.clear()
+        self.record_id = self.hvuser.record_id
+
+    def _touch(self, datatypes=None):
+        # Watermarks have a resolution of milliseconds.
+        time.sleep(0.002)
+        watermarks.touch(self.record_id, datatypes)
+
+    def test_missing(self):
+        """Missing watermarks are taken to be now, and kept."""
+        before = int(time.time() * 1000)
+        watermark = watermarks.get_watermark(self.record_id)
+        self.assertTrue(watermark >= before)
+        time.sleep(0.002)
+        self.assertEqual(watermarks.get_watermark(self.record_id), watermark)
+
+    def test_uncached(self):
+        """Watermarks are taken to be now if the cache doesn't keep them."""
+        before = int(time.time() * 1000)
+        with patch('healthvaultapp.watermarks.cache', DummyCache('', {})):
+            self.assertTrue(watermarks.get_watermark(self.record_id,
+                    [WEIGHT]) >= before)
+
+    @override_settings(HEALTHVAULT_WATERMARK_TIMEOUT=10)
+    def test_timeout(self):
+        """Watermarks expire after HEALTHVAULT_WATERMARK_TIMEOUT."""
+        with patch('healthvaultapp.watermarks.cache') as mock_cache:
+            mock_cache.get_many.return_value = {}
+            mock_cache.get.return_value = 5
+            self.assertEqual(watermarks.get_watermark(self.record_id), 5)
+            self.assertEqual(mock_cache.add.call_args[0][2], 10)
+            watermarks.touch(self.record_id)
+            self.assertEqual(mock_cache.set_many.call_args[0][1], 10)
+
+    def test_datatypes(self):
+        """Changes to a data type only move its own watermarks."""
+        weight = watermarks.get_watermark(self.record_id, [WEIGHT])
+        height = watermarks.get_watermark(self.record_id, [HEIGHT])
+        record = watermarks.get_watermark(self.record_id)
+        self._touch([WEIGHT])
+        self.assertTrue(watermarks.get_watermark(self.record_id, [WEIGHT]) >
+                weight)
+        self.assertEqual(watermarks.get_watermark(self.record_id, [HEIGHT]),
+                height)
+        self.assertTrue(watermarks.get_watermark(self.record_id) > record)
+        self.assertTrue(watermarks.get_watermark(self.record_id,
+                [WEIGHT, HEIGHT]) > height)
+
+    def test_whole_record(self):
+        """Changes of unknown data types move every watermark."""
+        height = watermarks.get_watermark(self.record_id, [HEIGHT])
+        self._touch()
+        self.assertTrue(watermarks.get_watermark(self.record_id, [HEIGHT]) >
+                height)
+
+
+class TestWatermarkCondition(HealthVaultTestBase):
+    """Tests for healthvaultapp.watermarks.watermark_condition"""
+
+    def setUp(self):
+        super(TestWatermarkCondition, self).setUp()
+        cache.clear()
+        self.calls = []
+
+        @watermarks.watermark_condition([WEIGHT])
+        def view(request):
+            self.calls.append(request)
+            return HttpResponse('things')
+        self.view = view
+
+    def _get(self, user=None, **headers):
+        request = RequestFactory().get('/weights', **headers)
+        request.user = user or self.user
+        return self.view(request)
+
+    def test_etag(self):
+        """Requests for an unchanged ETag are answered without the view."""
+        response = self._get()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self._get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(self.calls), 1)
+
+        time.sleep(0.002)
+        watermarks.touch(self.hvuser.record_id, [WEIGHT])
+        response = self._get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_last_modified(self):
+        response = self._get()
+        response = self._get(HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        response = self._get(
+                HTTP_IF_MODIFIED_SINCE='Sat, 01 Jan 2000 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+
+    def test_no_queries(self):
+        """Conditional requests don't touch the database beyond the user's
+        row."""
+        etag = self._get()['ETag']
+        with self.assertNumQueries(1):
+            self.assertEqual(self._get(HTTP_IF_NONE_MATCH=etag).status_code,
+                    304)
+
+    def test_unintegrated(self):
+        """Users without a record always get the view."""
+        HealthVaultUser.objects.all().delete()
+        response = self._get()
+        self.assertFalse(response.has_header('ETag'))
+        self._get(user=AnonymousUser())
+        self.assertEqual(len(self.calls), 2)
@@ -0,0 +1,293 @@
+from collections import deque
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+from xml.sax.saxutils import escape
+
+from django.core.cache import cache
+
+from healthvaultlib.exceptions import HealthVaultException
+from healthvaultlib.healthvault import format_datetime
+from healthvaultlib.xmlutils import parse_group
+
+from .utils import get_setting
+
+
+GETTHINGS_INFO = '{urn:com.microsoft.wc.methods.response.GetThings}info'
+
+# Django cache key of the prefetched things of a record and data type.
+PREFETCH_KEY = 'healthvault-prefetch:{0}:{1}'
+
+# The threads which prefetch things. The pool is only valid in the process
+# that created it, so it is replaced if we find ourselves in a child process
+# after a fork.
+_prefetch_pool = None
+_prefetch_pool_pid = None
+_prefetch_pool_lock = threading.Lock()
+
+# The sections of a thing which HealthVault can return.
+SECTIONS = frozenset(['core', 'audits', 'blobpayload', 'effectivepermissions',
+        'tags', 'digitalsignatures'])
+
+
+class Projection(object):
+    """
+    Describes which parts of things to get from HealthVault, so that
+    nothing else is sent over the wire or parsed.
+
+    :param sections: The :py:data:`SECTIONS` to get. Only ``core`` is needed
+        to parse things.
+    :param xml: Whether to get each thing's data XML.
+    :param transform: The name of a HealthVault transform to apply to the
+        data XML on the server.
+    :param xpath: An XPath expression over the data XML, which HealthVault
+        only returns things matching.
+
+    Things are parsed by python-healthvault if the ``core`` section and the
+    untransformed data XML are requested. Otherwise, their ``thing``
+    elements are returned as they are.
+    """
+
+    def __init__(self, sections=('core',), xml=True, transform=None,
+            xpath=None):
+        unknown = set(sections) - SECTIONS
+        if unknown:
+            raise ValueError('Unknown sections {0}'.format(
+                    ', '.join(sorted(unknown))))
+        # Sorted, so that equal projections give identical requests.
+        self.sections = tuple(sorted(set(sections)))
+        self.xml = xml
+        self.transform = transform
+        self.xpath = xpath
+
+    @property
+    def parsed(self):
+        """Whether things can be parsed by python-healthvault."""
+        return ('core' in self.sections and self.xml and
+                self.transform is None)
+
+    def format_xml(self):
+        """Returns the ``<format>`` element of a GetThings group."""
+        xml = ''
+        if self.transform is not None:
+            xml = '<xml>' + escape(self.transform) + '</xml>'
+        elif self.xml:
+            xml = '<xml/>'
+        return ('<format>' + ''.join('<section>' + section + '</section>'
+                for section in self.sections) + xml + '</format>')
+
+    def _key(self):
+        return (self.sections, self.xml, self.transform, self.xpath)
+
+    def __eq__(self, other):
+        return isinstance(other, Projection) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return ('Projection(sections={0!r}, xml={1!r}, transform={2!r}, '
+                'xpath={3!r})'.format(*self._key()))
+
+
+# The projection of python-healthvault's own requests.
+DEFAULT_PROJECTION = Projection()
+
+
+def build_group(datatype=None, ids=None, min_date=None, max_date=None,
+        max=None, filter=None, projection=None):
+    """
+    Returns the ``<group>`` element of a GetThings request for things of
+    ``datatype``, or for the things with ``ids``, in the parts described by
+    ``projection``, which defaults to the ``core`` section and the data XML.
+
+    Other parameters are as for python-healthvault's ``batch_get``.
+    """
+    projection = projection or DEFAULT_PROJECTION
+    group = '<group>' if max is None else '<group max="{0}">'.format(max)
+    group += ''.join('<id>' + id + '</id>' for id in ids or ())
+    if datatype is not None:
+        group += '<filter><type-id>' + datatype + '</type-id>' + (filter or '')
+        if min_date:
+            group += '<eff-date-min>' + format_datetime(min_date) + \
+                    '</eff-date-min>'
+        if max_date:
+            group += '<eff-date-max>' + format_datetime(max_date) + \
+                    '</eff-date-max>'
+        if projection.xpath is not None:
+            group += '<xpath>' + escape(projection.xpath) + '</xpath>'
+        group += '</filter>'
+    return group + projection.format_xml() + '</group>'
+
+
+def get_things(conn, datatype, min_date=None, max_date=None, max=None,
+        filter=None, projection=None, workers=None, page_size=None):
+    """
+    Returns a lazy iterator of all the things of ``datatype`` in the record
+    of ``conn``, most recent first, parsed as allowed by ``projection``.
+
+    HealthVault returns only the first things of a group in full, and the
+    keys of the rest as ``unprocessed-thing-key-info``. Those things are
+    fetched by their keys, ``page_size`` at a time, with up to ``workers``
+    requests in flight. Requests for later pages are only sent as the
+    iterator is consumed.
+
+    :param conn: A :py:class:`~healthvaultapp.connection.HealthVaultConn`,
+        such as from :py:func:`~healthvaultapp.utils.create_user_connection`.
+    :param projection: A :py:class:`Projection` of the parts of things to
+        get.
+    :param workers: Defaults to
+        :py:data:`~healthvaultapp.defaults.HEALTHVAULT_THINGS_WORKERS`.
+    :param page_size: Defaults to
+        :py:data:`~healthvaultapp.defaults.HEALTHVAULT_THINGS_PAGE_SIZE`.
+
+    Other parameters are as for python-healthvault's ``batch_get``.
+    """
+    if workers is None:
+        workers = get_setting('HEALTHVAULT_THINGS_WORKERS')
+    if page_size is None:
+        page_size = get_setting('HEALTHVAULT_THINGS_PAGE_SIZE')
+    projection = projection or DEFAULT_PROJECTION
+    info = '<info>' + build_group(datatype, min_date=min_date,
+            max_date=max_date, max=max, filter=filter,
+            projection=projection) + '</info>'
+    return _iter_pages(conn, info, projection, workers, page_size)
+
+
+def prefetch_things(conn, datatypes, timeout=None, max=None):
+    """
+    Gets the things of each of ``datatypes`` in the record of ``conn`` with
+    :py:func:`get_things`, and stores them in Django's cache for
+    :py:func:`get_prefetched_things`. Errors are logged rather than raised,
+    and leave the things of that data type uncached, as do lists of things
+    which the cache doesn't store, such as because they are too large.
+
+    :param timeout: The number of seconds to cache the things for. Defaults
+        to :py:data:`~healthvaultapp.defaults.HEALTHVAULT_PREFETCH_TIMEOUT`.
+    :param max: The most things of each data type to get, the most recent
+        first. Defaults to
+        :py:data:`~healthvaultapp.defaults.HEALTHVAULT_PREFETCH_MAX`.
+    """
+    if timeout is None:
+        timeout = get_setting('HEALTHVAULT_PREFETCH_TIMEOUT')
+    if max is None:
+        max = get_setting('HEALTHVAULT_PREFETCH_MAX')
+    logger = logging.getLogger('healthvaultapp.things.prefetch_things')
+    for datatype in datatypes:
+        try:
+            things = list(get_things(conn, datatype, max=max))
+        except Exception:
+            logger.exception('Error while prefetching {0} things of record '
+                    '{1}: '.format(datatype, conn.record_id))
+            continue
+        key = _get_prefetch_key(conn.record_id, datatype)
+        cache.set(key, things, timeout)
+        if cache.get(key) is None:
+            logger.warning('The cache did not store {0} prefetched {1} '
+                    'things of record {2}'.format(len(things), datatype,
+                    conn.record_id))
+
+
+def schedule_prefetch(conn, datatypes, timeout=None, max=None):
+    """
+    Calls :py:func:`prefetch_things` in a background thread, so that the
+    caller doesn't wait for HealthVault. Prefetches are run by a pool of
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_PREFETCH_WORKERS`
+    threads, and wait for a free one. Returns the
+    ``multiprocessing.pool.AsyncResult`` of the prefetch.
+    """
+    return _get_prefetch_pool().apply_async(prefetch_things,
+            (conn, datatypes, timeout, max))
+
+
+def _get_prefetch_pool():
+    global _prefetch_pool, _prefetch_pool_pid
+    with _prefetch_pool_lock:
+        if _prefetch_pool is None or _prefetch_pool_pid != os.getpid():
+            _prefetch_pool = ThreadPool(
+                    get_setting('HEALTHVAULT_PREFETCH_WORKERS'))
+            _prefetch_pool_pid = os.getpid()
+        return _prefetch_pool
+
+
+def get_prefetched_things(record_id, datatype):
+    """
+    Returns the list of things of ``datatype`` in the record ``record_id``
+    which were stored by :py:func:`prefetch_things`, or ``None`` if they
+    aren't cached.
+    """
+    return cache.get(_get_prefetch_key(record_id, datatype))
+
+
+def _get_prefetch_key(record_id, datatype):
+    return PREFETCH_KEY.format(record_id, datatype)
+
+
+def _iter_pages(conn, info, projection, workers, page_size):
+    things, keys = _get_page(conn, info, projection)
+    for thing in things:
+        yield thing
+    if not keys:
+        return
+
+    keys = deque(keys)
+    # Pages in the order their things are yielded, as (ids, result).
+    pending = deque()
+    pool = ThreadPool(workers)
+
+    def request(ids):
+        info = '<info>' + build_group(ids=ids, projection=projection) + \
+                '</info>'
+        return ids, pool.apply_async(_get_page, (conn, info, projection))
+
+    try:
+        while keys or pending:
+            while keys and len(pending) < workers:
+                pending.append(request([keys.popleft() for i in
+                        range(min(page_size, len(keys)))]))
+            ids, result = pending.popleft()
+            things, more = result.get()
+            if more and len(more) >= len(ids):
+                raise HealthVaultException('GetThings left all of the '
+                        'things of a page unprocessed')
+            # Keys left unprocessed by a page come before those of the pages
+            # after it, including those already requested.
+            pending.extendleft(reversed([request(more[i:i + page_size])
+                    for i in range(0, len(more), page_size)]))
+            for thing in things:
+                yield thing
+    finally:
+        pool.terminate()
+
+
+def _get_page(conn, info, projection):
+    response, body, tree = conn._build_and_send_request('GetThings', info)
+    return _parse_page(tree, projection)
+
+
+def _parse_page(tree, projection):
+    things, keys = [], []
+    for group in tree.find(GETTHINGS_INFO).findall('group'):
+        parsed = parse_things(group, projection)
+        if isinstance(parsed, dict):
+            # Single-instance types, such as basic demographic data.
+            parsed = [parsed]
+        things.extend(parsed)
+        keys.extend(key.text for key in
+                group.findall('unprocessed-thing-key-info/thing-id'))
+    return things, keys
+
+
+def parse_things(group, projection=None):
+    """
+    Returns the things in a ``<group>`` element of a GetThings response,
+    parsed by python-healthvault if ``projection`` allows it, or as
+    ``thing`` elements.
+    """
+    if projection is not None and not projection.parsed:
+        return group.findall('thing')
+    return parse_group(group)
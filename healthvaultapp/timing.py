@@ -0,0 +1,71 @@
+from contextlib import contextmanager
+import threading
+import time
+
+
+NETWORK = 'hv-network'
+SIGNING = 'hv-signing'
+PARSING = 'hv-parsing'
+DATABASE = 'db'
+
+# Timings are only collected in a thread between start() and stop(), which the
+# ServerTimingMiddleware calls around sampled requests. Elsewhere, recording a
+# timing costs next to nothing.
+_local = threading.local()
+
+
+def start():
+    """Starts collecting timings in this thread."""
+    _local.timings = {}
+
+
+def stop():
+    """Stops collecting timings in this thread, and returns a dictionary of
+    the seconds spent in each category, or ``None`` if timings weren't being
+    collected.
+    """
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    return timings
+
+
+def is_active():
+    return getattr(_local, 'timings', None) is not None
+
+
+def record(category, seconds):
+    """Adds ``seconds`` to the time spent in ``category``."""
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings[category] = timings.get(category, 0.0) + seconds
+
+
+@contextmanager
+def timed(category):
+    """Records the time spent in the block in ``category``."""
+    if not is_active():
+        yield
+        return
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        record(category, time.time() - start_time)
+
+
+@contextmanager
+def timed_exclusive(category):
+    """Records the time spent in the block in ``category``, less any time
+    recorded in other categories from within the block.
+    """
+    if not is_active():
+        yield
+        return
+    start_time = time.time()
+    recorded = sum(_local.timings.values())
+    try:
+        yield
+    finally:
+        timings = getattr(_local, 'timings', None) or {}
+        nested = sum(timings.values()) - recorded
+        record(category, time.time() - start_time - nested)
@@ -0,0 +1,130 @@
+from .utils import import_numpy
+
+
+# Factors converting each unit into the canonical unit of its quantity.
+CONVERSIONS = {
+    # Mass, in kilograms.
+    'kg': ('kg', 1.0),
+    'g': ('kg', 0.001),
+    'lb': ('kg', 0.45359237),
+    'lbs': ('kg', 0.45359237),
+    'st': ('kg', 6.35029318),
+    # Length, in meters.
+    'm': ('m', 1.0),
+    'cm': ('m', 0.01),
+    'in': ('m', 0.0254),
+    'ft': ('m', 0.3048),
+    # Blood glucose concentration, in millimoles per liter.
+    'mmol/L': ('mmol/L', 1.0),
+    'mg/dL': ('mmol/L', 1 / 18.0182),
+    # Blood pressure, in millimeters of mercury.
+    'mmHg': ('mmHg', 1.0),
+    'kPa': ('mmHg', 7.50061683),
+}
+
+# Plausible ranges of human readings, in canonical units. Readings outside
+# these are almost certainly entry or unit errors.
+RANGES = {
+    'kg': (0.2, 650.0),
+    'm': (0.2, 2.75),
+    'mmol/L': (0.5, 60.0),
+    'mmHg': (20.0, 320.0),
+}
+
+
+def normalize(values, units, unit):
+    """
+    Converts a column of readings into ``unit``.
+
+    :param values: A sequence or array of numbers.
+    :param units: The unit of all ``values``, or a sequence of the unit of
+        each, as given in the readings' display values.
+    :param unit: The unit to convert to, one of :py:data:`CONVERSIONS`.
+    :returns: An array of floats.
+    :raises: :py:exc:`ValueError` for unknown units, or units of a
+        different quantity than ``unit``.
+    """
+    numpy = import_numpy()
+    values = numpy.asarray(values, dtype='float64')
+    quantity, factor = _get_conversion(unit)
+    if isinstance(units, basestring):
+        return values * (_get_factor(units, quantity) / factor)
+
+    # Convert each distinct unit in one operation.
+    distinct, inverse = numpy.unique(numpy.asarray(units), return_inverse=True)
+    factors = numpy.array([_get_factor(u, quantity) / factor
+            for u in distinct])
+    return values * factors[inverse]
+
+
+def _get_conversion(unit):
+    try:
+        return CONVERSIONS[unit]
+    except KeyError:
+        raise ValueError('Unknown unit {0!r}'.format(unit))
+
+
+def _get_factor(unit, quantity):
+    unit_quantity, factor = _get_conversion(unit)
+    if unit_quantity != quantity:
+        raise ValueError('Cannot convert {0!r} to {1!r}'.format(unit,
+                quantity))
+    return factor
+
+
+def validate(values, unit, bounds=None):
+    """
+    Returns a boolean array marking which of ``values``, in ``unit``, are
+    finite and within ``bounds``, a ``(low, high)`` tuple which defaults to
+    the plausible range in :py:data:`RANGES`.
+    """
+    numpy = import_numpy()
+    values = numpy.asarray(values, dtype='float64')
+    if bounds is None:
+        quantity, factor = _get_conversion(unit)
+        low, high = RANGES[quantity]
+        bounds = (low / factor, high / factor)
+    low, high = bounds
+    with numpy.errstate(invalid='ignore'):
+        return numpy.isfinite(values) & (values >= low) & (values <= high)
+
+
+def flag_outliers(values, threshold=3.5):
+    """
+    Returns a boolean array marking outliers among ``values``: those whose
+    modified z-score, based on the median and the median absolute deviation,
+    exceeds ``threshold``. Unlike the mean and standard deviation, these
+    aren't skewed by the outliers themselves. Non-finite values are always
+    flagged.
+    """
+    numpy = import_numpy()
+    values = numpy.asarray(values, dtype='float64')
+    finite = numpy.isfinite(values)
+    outliers = ~finite
+    if not finite.any():
+        return outliers
+    median = numpy.median(values[finite])
+    deviations = numpy.abs(values[finite] - median)
+    mad = numpy.median(deviations)
+    if mad == 0:
+        # Over half the values are the same; anything else stands out.
+        outliers[finite] = deviations > 0
+    else:
+        outliers[finite] = 0.6745 * deviations / mad > threshold
+    return outliers
+
+
+def clean(values, units, unit, bounds=None, threshold=3.5):
+    """
+    Normalizes, validates and flags outliers in a column of readings at once.
+    Outliers are only looked for among the valid readings.
+
+    :returns: A tuple of the values converted into ``unit``, a boolean array
+        marking the valid values, and a boolean array marking the outliers.
+    """
+    numpy = import_numpy()
+    values = normalize(values, units, unit)
+    valid = validate(values, unit, bounds)
+    outliers = numpy.zeros(len(values), dtype=bool)
+    outliers[valid] = flag_outliers(values[valid], threshold)
+    return values, valid, outliers
@@ -14,4 +14,12 @@ urlpatterns = patterns('',
         views.complete, name='healthvault-complete'),
     url(r'^error/$',
         views.error, name='healthvault-error'),
+
+    # Eventing
+    url(r'^notify/$',
+        views.notify, name='healthvault-notify'),
+
+    # Monitoring
+    url(r'^health/$',
+        views.health, name='healthvault-health'),
 )
@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+
+from django.core.cache import cache
+
+from .models import connect_cache_receivers, HealthVaultUser
+
+
+# Django cache key of the version counter of a user's HealthVaultUser row,
+# which is bumped whenever the row is saved or deleted.
+VERSION_KEY = 'healthvault-user-version:{0}'
+
+# Fields of the links in LRUCache's linked list.
+PREV, NEXT, KEY, VALUE, EXPIRES = range(5)
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping of up to ``size`` entries, which evicts the least
+    recently used entry to make room for a new one, and forgets entries
+    ``ttl`` seconds after they were set.
+    """
+
+    def __init__(self, size=1000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+        self._links = {}
+        # A circular doubly linked list of entries, from least to most
+        # recently used, around a sentinel root link.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+
+    def __len__(self):
+        return len(self._links)
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._links.get(key)
+            if link is None:
+                self.stats['misses'] += 1
+                return default
+            if link[EXPIRES] <= time.time():
+                self._remove(link)
+                self.stats['misses'] += 1
+                return default
+            # Move the link to the most recently used end.
+            self._unlink(link)
+            self._append(link)
+            self.stats['hits'] += 1
+            return link[VALUE]
+
+    def set(self, key, value):
+        with self._lock:
+            link = self._links.get(key)
+            if link is not None:
+                self._remove(link)
+            if self.size <= 0:
+                return
+            while len(self._links) >= self.size:
+                self._remove(self._root[NEXT])
+                self.stats['evictions'] += 1
+            link = [None, None, key, value, time.time() + self.ttl]
+            self._append(link)
+            self._links[key] = link
+
+    def delete(self, key):
+        with self._lock:
+            link = self._links.get(key)
+            if link is not None:
+                self._remove(link)
+
+    def clear(self):
+        with self._lock:
+            self._links.clear()
+            self._root[:] = [self._root, self._root, None, None, None]
+
+    def _append(self, link):
+        last = self._root[PREV]
+        link[PREV], link[NEXT] = last, self._root
+        last[NEXT] = self._root[PREV] = link
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _remove(self, link):
+        self._unlink(link)
+        del self._links[link[KEY]]
+
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns this process's :py:class:`LRUCache` of HealthVaultUser rows, or
+    ``None`` if :py:data:`~healthvaultapp.defaults.HEALTHVAULT_USER_CACHE_SIZE`
+    is 0.
+    """
+    from .utils import get_setting
+
+    global _cache, _cache_pid
+    size = get_setting('HEALTHVAULT_USER_CACHE_SIZE')
+    # Follow the setting if it changes, such as in tests.
+    connect_cache_receivers(bool(size))
+    if not size:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            _cache = LRUCache()
+            _cache_pid = os.getpid()
+    _cache.size = size
+    _cache.ttl = get_setting('HEALTHVAULT_USER_CACHE_TTL')
+    return _cache
+
+
+def get_user(user_id):
+    """
+    Returns the :py:class:`~healthvaultapp.models.HealthVaultUser` of the
+    user with id ``user_id``, or ``None`` if they aren't integrated.
+
+    Rows, and their absence, are cached in memory. A cached row is used
+    without further checks for
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_USER_CACHE_REVALIDATE`
+    seconds; after that, it is used only while its version in Django's
+    cache is unchanged. Cached rows are shared between threads, and must not
+    be modified.
+    """
+    from .utils import get_setting
+
+    lru = get_cache()
+    if lru is None:
+        return _load(user_id)
+
+    entry = lru.get(user_id)
+    now = time.time()
+    if entry is not None:
+        hvuser, version, checked = entry
+        revalidate = get_setting('HEALTHVAULT_USER_CACHE_REVALIDATE')
+        if now - checked < revalidate:
+            return hvuser
+        if cache.get(VERSION_KEY.format(user_id)) == version:
+            entry[2] = now
+            return hvuser
+
+    # Read the version first, so that a write while we load the row
+    # invalidates it at the next check.
+    version = cache.get(VERSION_KEY.format(user_id))
+    hvuser = _load(user_id)
+    lru.set(user_id, [hvuser, version, now])
+    return hvuser
+
+
+def _load(user_id):
+    try:
+        return HealthVaultUser.objects.get(user_id=user_id)
+    except HealthVaultUser.DoesNotExist:
+        return None
+
+
+def invalidate(user_id):
+    """
+    Forgets the cached row of the user with id ``user_id`` in this process,
+    and bumps its version so that other processes do too.
+    """
+    lru = get_cache()
+    if lru is None:
+        return
+    lru.delete(user_id)
+    key = VERSION_KEY.format(user_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Start from the time rather than 1, so that a counter which was
+        # evicted from the cache doesn't return to an earlier version.
+        cache.set(key, int(time.time() * 1000), None)
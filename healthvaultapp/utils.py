@@ -1,19 +1,39 @@
+import httplib
 import logging
+import time
+import xml.etree.ElementTree as ET
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
 
-from healthvaultlib.exceptions import HealthVaultException
-from healthvaultlib.healthvault import HealthVaultConn
+from healthvaultlib.exceptions import (HealthVaultException,
+        HealthVaultHTTPException, HealthVaultTokenExpiredException)
+from healthvaultlib.status_codes import HealthVaultStatus
 
-from . import defaults
+from . import defaults, usercache
 from .models import HealthVaultUser
+from .signals import sync_requested
+
+
+# Django 1.6 replaced commit_on_success with atomic.
+atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
 
 
 logger = logging.getLogger(__name__)
 
 
+# Errors of HealthVault calls which a broken or unreachable server can
+# cause. Calls go over pooled connections, so transport failures are raised
+# as they are, rather than as HealthVaultException.
+CONNECTION_ERRORS = (HealthVaultException, httplib.HTTPException, IOError,
+        ET.ParseError)
+
+
 # Used by HealthVault to authenticate this application.
 sharedsec = None
 auth_token = None
@@ -40,23 +60,10 @@ def create_connection(wctoken=None, record_id=None, **kwargs):
     """
     global sharedsec, auth_token
 
-    # Default configuration parameters from the settings.
-    config = {
-        'app_id': get_setting('HEALTHVAULT_APP_ID'),
-        'app_thumbprint': get_setting('HEALTHVAULT_THUMBPRINT'),
-        'public_key': get_setting('HEALTHVAULT_PUBLIC_KEY'),
-        'private_key': get_setting('HEALTHVAULT_PRIVATE_KEY'),
-        'server': get_setting('HEALTHVAULT_SERVER'),
-        'shell_server': get_setting('HEALTHVAULT_SHELL_SERVER'),
-    }
-    config.update(kwargs)
+    # The HealthVault client stack is only loaded once it is needed.
+    from . import connection
 
-    # Require that configuration parameters be non-null.
-    for key, value in config.items():
-        if not value:
-            msg = '{0} cannot be null, and must be explicitly ' \
-                    'specified or set in your Django settings.'.format(key)
-            raise ImproperlyConfigured(msg)
+    config = _get_config(**kwargs)
 
     # Since sharedsec and auth_token go together, reset them if both aren't
     # present.
@@ -68,7 +75,8 @@ def create_connection(wctoken=None, record_id=None, **kwargs):
         auth_token = None
 
     try:
-        conn = HealthVaultConn(wctoken=wctoken, record_id=record_id, **config)
+        conn = connection.HealthVaultConn(wctoken=wctoken,
+                record_id=record_id, **config)
     except ValueError as e:
         logger.error(e)
         msg = e.args[0] if e.args else None
@@ -89,6 +97,70 @@ def create_connection(wctoken=None, record_id=None, **kwargs):
     return conn
 
 
+def create_offline_connection(person_id, record_id, **kwargs):
+    """Shortcut to create a HealthVaultConn instance which accesses a record
+    without the user's `wctoken`.
+
+    The connection authenticates with the application's credentials on
+    behalf of the person with `person_id`, so background jobs can read the
+    record at any time, not only while the user's `wctoken` is valid. Pass
+    the `person_id` and `record_id` stored on the user's
+    :py:class:`~healthvaultapp.models.HealthVaultUser`. The application must
+    be granted offline access in its HealthVault configuration.
+
+    Other parameters are as for :py:func:`create_connection`.
+    """
+    if not person_id or not record_id:
+        raise ValueError('Offline connections require a person_id and a '
+                'record_id')
+    return create_connection(record_id=record_id,
+            offline_person_id=person_id, **kwargs)
+
+
+def create_user_connection(hvuser, **kwargs):
+    """Shortcut to create a HealthVaultConn instance with the token and
+    record of a :py:class:`~healthvaultapp.models.HealthVaultUser`.
+
+    Other parameters are as for :py:func:`create_connection`.
+
+    :raises: :py:exc:`healthvaultlib.exceptions.HealthVaultTokenExpiredException`,
+        without calling HealthVault, if the token isn't usable according to
+        :py:func:`is_token_usable`.
+    """
+    if not is_token_usable(hvuser):
+        raise _unusable_token_error(hvuser)
+    return create_connection(wctoken=hvuser.token, record_id=hvuser.record_id,
+            **kwargs)
+
+
+def _unusable_token_error(hvuser):
+    return HealthVaultTokenExpiredException('The token of user {0} is known '
+            'to be unusable'.format(hvuser.user_id),
+            code=HealthVaultStatus.CREDENTIAL_TOKEN_EXPIRED)
+
+
+def _get_config(**kwargs):
+    """Returns HealthVaultConn parameters, defaulting to the settings."""
+    # Default configuration parameters from the settings.
+    config = {
+        'app_id': get_setting('HEALTHVAULT_APP_ID'),
+        'app_thumbprint': get_setting('HEALTHVAULT_THUMBPRINT'),
+        'public_key': get_setting('HEALTHVAULT_PUBLIC_KEY'),
+        'private_key': get_setting('HEALTHVAULT_PRIVATE_KEY'),
+        'server': get_setting('HEALTHVAULT_SERVER'),
+        'shell_server': get_setting('HEALTHVAULT_SHELL_SERVER'),
+    }
+    config.update(kwargs)
+
+    # Require that configuration parameters be non-null.
+    for key, value in config.items():
+        if not value:
+            msg = '{0} cannot be null, and must be explicitly ' \
+                    'specified or set in your Django settings.'.format(key)
+            raise ImproperlyConfigured(msg)
+    return config
+
+
 def get_setting(name, use_defaults=True):
     """Retrieves the specified setting from the project settings file.
 
@@ -107,6 +179,20 @@ def get_setting(name, use_defaults=True):
     raise ImproperlyConfigured(msg)
 
 
+def import_numpy():
+    """Imports NumPy, which the array-based helpers require.
+
+    :raises: :py:exc:`django.core.exceptions.ImproperlyConfigured` if NumPy
+        isn't installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImproperlyConfigured('NumPy is required. Install it with '
+                '"pip install django-healthvault[numpy]".')
+    return numpy
+
+
 def is_integrated(user):
     """
     Returns ``True`` if we have HealthVault authentication data for the
@@ -115,10 +201,98 @@ def is_integrated(user):
     :param user: A Django user.
     """
     if user and user.is_authenticated() and user.is_active:
+        if usercache.get_cache() is not None:
+            return get_healthvault_user(user) is not None
         return HealthVaultUser.objects.filter(user=user).exists()
     return False
 
 
+def get_healthvault_user(user):
+    """
+    Returns the user's :py:class:`~healthvaultapp.models.HealthVaultUser`,
+    or ``None`` if they aren't integrated. If
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_USER_CACHE_SIZE` isn't 0,
+    the row may come from an in-process cache (see
+    :py:func:`healthvaultapp.usercache.get_user`), and must not be modified.
+
+    :param user: A Django user.
+    """
+    return usercache.get_user(user.pk)
+
+
+def is_token_usable(hvuser, now=None):
+    """
+    Returns ``False`` if the token of ``hvuser`` is known to have expired, or
+    has failed
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_TOKEN_MAX_FAILURES` times
+    in a row, so that calling HealthVault with it would be futile.
+
+    :param hvuser: A :py:class:`~healthvaultapp.models.HealthVaultUser`.
+    """
+    now = now or timezone.now()
+    if hvuser.token_expires is not None and hvuser.token_expires <= now:
+        return False
+    max_failures = get_setting('HEALTHVAULT_TOKEN_MAX_FAILURES')
+    return max_failures is None or hvuser.token_failures < max_failures
+
+
+def usable_tokens(queryset, now=None):
+    """
+    Filters a queryset of :py:class:`~healthvaultapp.models.HealthVaultUser`
+    in the database to the rows whose tokens are usable, according to
+    :py:func:`is_token_usable`.
+    """
+    now = now or timezone.now()
+    queryset = queryset.filter(Q(token_expires__isnull=True) |
+            Q(token_expires__gt=now))
+    max_failures = get_setting('HEALTHVAULT_TOKEN_MAX_FAILURES')
+    if max_failures is not None:
+        queryset = queryset.filter(token_failures__lt=max_failures)
+    return queryset
+
+
+def record_token_results(results, now=None, batch_size=500):
+    """
+    Records the outcomes of HealthVault calls made with users' tokens, for
+    :py:func:`is_token_usable`.
+
+    ``results`` is an iterable of ``(hvuser, error)`` tuples, where
+    ``error`` is the exception with which the call failed, or ``None`` if it
+    succeeded. A token which HealthVault says has expired is marked as
+    expired. Errors which don't implicate the token, such as HTTP errors,
+    are ignored. Rows are updated with up to three queries per
+    ``batch_size`` results.
+    """
+    now = now or timezone.now()
+    for chunk in chunks(results, batch_size):
+        succeeded, failed, expired = [], [], []
+        for hvuser, error in chunk:
+            if error is None:
+                succeeded.append(hvuser)
+            elif (not isinstance(error, HealthVaultException) or
+                    isinstance(error, HealthVaultHTTPException)):
+                continue
+            elif error.code == HealthVaultStatus.CREDENTIAL_TOKEN_EXPIRED:
+                expired.append(hvuser)
+            else:
+                failed.append(hvuser)
+        queryset = HealthVaultUser.objects
+        if succeeded:
+            queryset.filter(pk__in=[hvuser.pk for hvuser in succeeded]) \
+                    .update(token_used=now, token_failures=0)
+        if failed:
+            queryset.filter(pk__in=[hvuser.pk for hvuser in failed]) \
+                    .update(token_failures=F('token_failures') + 1)
+        if expired:
+            queryset.filter(pk__in=[hvuser.pk for hvuser in expired]) \
+                    .update(token_expires=now,
+                            token_failures=F('token_failures') + 1)
+        # Queryset updates don't send post_save. Cached rows only need to
+        # be dropped when their tokens may have become unusable.
+        for hvuser in failed + expired:
+            usercache.invalidate(hvuser.user_id)
+
+
 def get_callback_url(request):
     """
     Returns the callback url that HealthVault should use after the user makes
@@ -128,6 +302,228 @@ def get_callback_url(request):
     to the URL defined in the application's ActionURL. Since an error may
     occur if an alternative callback is provided, we return None.
     """
-    if get_setting('HEALTHVAULT_IN_DEVELOPMENT'):
+    in_development = get_setting('HEALTHVAULT_IN_DEVELOPMENT')
+    if in_development is None:
+        in_development = getattr(settings, 'DEBUG', True)
+    if in_development:
         return request.build_absolute_uri(reverse('healthvault-complete'))
     return None
+
+
+def chunks(items, size):
+    """Yields successive lists of up to ``size`` items from ``items``."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def revoke_users(queryset, batch_size=500, workers=4, remote=False,
+        dry_run=False, progress=None):
+    """
+    Deletes the :py:class:`~healthvaultapp.models.HealthVaultUser` rows in
+    ``queryset``, ``batch_size`` rows at a time. ``queryset`` may also be a
+    list of primary keys.
+
+    If ``remote`` is ``True``, HealthVault is also asked to remove our
+    authorization to each record before its row is deleted. Up to ``workers``
+    of these calls are made concurrently. A failed call is logged, and the
+    row is deleted regardless. Rows whose tokens aren't usable, according to
+    :py:func:`is_token_usable`, are deleted without a call.
+
+    If ``dry_run`` is ``True``, nothing is changed. After each batch,
+    ``progress`` (if given) is called with the number of rows revoked so
+    far, the total number of rows, and the elapsed time in seconds.
+
+    Returns a ``(revoked, failed)`` tuple counting the revoked rows and the
+    failed HealthVault calls.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    if isinstance(queryset, (list, tuple)):
+        pks = sorted(queryset)
+    else:
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+    revoked = failed = 0
+    start = time.time()
+    pool = ThreadPool(workers) if remote and not dry_run else None
+    try:
+        for chunk in chunks(pks, batch_size):
+            if not dry_run:
+                if pool is not None:
+                    hvusers = usable_tokens(
+                            HealthVaultUser.objects.filter(pk__in=chunk))
+                    results = pool.map(_remove_authorization, hvusers)
+                    failed += results.count(False)
+                HealthVaultUser.objects.filter(pk__in=chunk).delete()
+            revoked += len(chunk)
+            if progress:
+                progress(revoked, len(pks), time.time() - start)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return revoked, failed
+
+
+def _remove_authorization(hvuser):
+    try:
+        conn = create_user_connection(hvuser)
+        conn.remove_authorization()
+    except CONNECTION_ERRORS:
+        logger.exception('Unable to remove authorization for record {0}: '
+                ''.format(hvuser.record_id))
+        return False
+    return True
+
+
+def resolve_record_ids(queryset, batch_size=500, workers=4):
+    """
+    Asks HealthVault which record each user's token currently grants access
+    to, and updates the ``record_id`` of rows where it has changed.
+
+    Rows are processed ``batch_size`` at a time, with up to ``workers``
+    concurrent HealthVault calls. Rows whose tokens aren't usable, according
+    to :py:func:`is_token_usable`, are left out in the database, and the
+    outcome of each call is recorded with :py:func:`record_token_results`. A
+    row is skipped if its call fails, or if its new record is already
+    associated with another user or is resolved for several users.
+
+    Returns an ``(updated, failed)`` tuple.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    updated = failed = 0
+    queryset = usable_tokens(queryset)
+    pool = ThreadPool(workers)
+    try:
+        for chunk in chunks(queryset.order_by('pk').iterator(), batch_size):
+            results = pool.map(_resolve_record_id, chunk)
+            record_token_results((hvuser, error) for hvuser, (record_id, error)
+                    in zip(chunk, results))
+            record_ids = [record_id for record_id, error in results]
+            changed, targets = {}, {}
+            users = dict((hvuser.pk, hvuser.user_id) for hvuser in chunk)
+            for hvuser, record_id in zip(chunk, record_ids):
+                if record_id is None:
+                    failed += 1
+                elif record_id != hvuser.record_id:
+                    changed[hvuser.pk] = record_id
+                    targets[record_id] = targets.get(record_id, 0) + 1
+            taken = set(HealthVaultUser.objects
+                    .filter(record_id__in=changed.values())
+                    .exclude(pk__in=changed.keys())
+                    .values_list('record_id', flat=True))
+            for pk, record_id in changed.items():
+                if record_id in taken or targets[record_id] > 1:
+                    failed += 1
+                    continue
+                # Rows of the chunk can still swap records, so the update
+                # can clash with a record another row hasn't given up yet.
+                try:
+                    with atomic():
+                        HealthVaultUser.objects.filter(pk=pk).update(
+                                record_id=record_id)
+                except IntegrityError:
+                    failed += 1
+                    continue
+                # Queryset updates don't send post_save.
+                usercache.invalidate(users[pk])
+                updated += 1
+    finally:
+        pool.close()
+        pool.join()
+    return updated, failed
+
+
+def _resolve_record_id(hvuser):
+    try:
+        return create_connection(wctoken=hvuser.token).record_id, None
+    except CONNECTION_ERRORS as e:
+        logger.exception('Unable to resolve the record for user {0}: '
+                ''.format(hvuser.user_id))
+        return None, e
+
+
+def request_sync(queryset, datatypes=None, batch_size=500):
+    """
+    Sends the :py:data:`~healthvaultapp.signals.sync_requested` signal for
+    the users in ``queryset``, ``batch_size`` users at a time.
+
+    Returns the number of users for which a sync was requested.
+    """
+    requested = 0
+    queryset = queryset.select_related('user').order_by('pk')
+    for chunk in chunks(queryset.iterator(), batch_size):
+        sync_requested.send(sender=HealthVaultUser, hvusers=chunk,
+                datatypes=datatypes)
+        requested += len(chunk)
+    return requested
+
+
+HEALTH_PROBE_CACHE_KEY = 'healthvault-health-probe'
+
+
+def get_health(probe=None):
+    """
+    Returns a dictionary describing this process's view of HealthVault
+    connectivity, without making any HealthVault calls of its own.
+
+    It holds ``token_cached``, whether an application session token is cached
+    for new connections, and the entries of
+    :py:func:`~healthvaultapp.connection.connection_status`. ``healthy`` is
+    ``False`` once there have been
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_HEALTH_FAILURE_THRESHOLD`
+    consecutive transport failures.
+
+    If ``probe`` (which defaults to the
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_HEALTH_PROBE` setting) is
+    ``True``, the result of a live handshake with HealthVault is included as
+    ``probe``. Probe results are shared through Django's cache and refreshed
+    at most every
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_HEALTH_PROBE_INTERVAL`
+    seconds, and a failed probe makes the result unhealthy.
+    """
+    from .connection import connection_status
+
+    health = connection_status()
+    health['token_cached'] = bool(sharedsec and auth_token)
+    threshold = get_setting('HEALTHVAULT_HEALTH_FAILURE_THRESHOLD')
+    health['healthy'] = health['consecutive_failures'] < threshold
+
+    if probe is None:
+        probe = get_setting('HEALTHVAULT_HEALTH_PROBE')
+    if probe:
+        health['probe'] = _get_probe()
+        if health['probe'] and not health['probe']['ok']:
+            health['healthy'] = False
+    return health
+
+
+def _get_probe():
+    from . import connection
+
+    interval = get_setting('HEALTHVAULT_HEALTH_PROBE_INTERVAL')
+    result = cache.get(HEALTH_PROBE_CACHE_KEY)
+    # Only one caller probes at a time; the others use the previous result.
+    if result is None and cache.add(HEALTH_PROBE_CACHE_KEY + '-lock', True,
+            interval):
+        start = time.time()
+        try:
+            # Skip the cached session token so that we really talk to the
+            # server.
+            connection.HealthVaultConn(**_get_config())
+        except CONNECTION_ERRORS as e:
+            # Anything a broken or unreachable server can cause is reported,
+            # rather than failing the health check itself.
+            result = {'ok': False, 'error': unicode(e)}
+        else:
+            result = {'ok': True, 'error': None}
+        result['checked'] = time.time()
+        result['seconds'] = result['checked'] - start
+        cache.set(HEALTH_PROBE_CACHE_KEY, result, interval)
+    return result
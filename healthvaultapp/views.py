@@ -1,22 +1,43 @@
+import base64
+import datetime
+import hashlib
+import hmac
+import json
 import logging
 from urllib import urlencode
+import xml.etree.ElementTree as ET
+from xml.parsers.expat import ExpatError
 
 from django.contrib.auth.decorators import login_required
+from django.core import signing
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.http import Http404
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+        HttpResponseForbidden)
 from django.shortcuts import redirect, render
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.http import is_safe_url
+from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 from healthvaultlib.exceptions import HealthVaultException
 from healthvaultlib.targets import ApplicationTarget
 
-from . import utils
+from . import utils, watermarks
 from .models import HealthVaultUser
+from .signals import sync_requested
 
 
 KEEP_GET_PARAM = 'keep'
 NEXT_SESSION_KEY = 'healthvault_next'
 NEXT_GET_PARAM = 'next'
+NEXT_STATE_PARAM = 'actionqs'
+NEXT_STATE_SALT = 'healthvaultapp.views.next'
+SIGNATURE_HEADER = 'HTTP_X_HV_SIGNATURE'
+SYNC_PENDING_KEY = 'healthvault-sync-pending:{0}:{1}'
 
 
 @login_required
@@ -36,16 +57,15 @@ def authorize(request):
     page. If 'next' GET parameter is provided, it is saved in the
     'healthvault_next' session key so the :py:func:`complete
     <healthvaultapp.views.complete>` view can redirect the user to that URL
-    after successful authorization.
+    after successful authorization. If
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_NEXT_IN_STATE` is ``True``,
+    it is instead signed and passed through HealthVault in the ``actionqs``
+    parameter, and the session isn't touched.
 
     :URL name: `healthvault-authorize`
     """
-    # Store redirect URL in the session for after authorization completion.
-    next_url = request.GET.get(NEXT_GET_PARAM, None)
-    if next_url:
-        request.session[NEXT_SESSION_KEY] = next_url
-    else:
-        request.session.pop(NEXT_SESSION_KEY, None)
+    # Store redirect URL for after authorization completion.
+    state = _save_next(request, request.GET.get(NEXT_GET_PARAM, None))
 
     # HealthVault will send a callback to this URL so that we can complete the
     # authorization process.
@@ -56,16 +76,13 @@ def authorize(request):
     keep = request.GET.get(KEEP_GET_PARAM, True)
     record_id = None
     if keep:
-        try:
-            hvuser = HealthVaultUser.objects.get(user=request.user)
-        except HealthVaultUser.DoesNotExist:
-            pass
-        else:
+        hvuser = utils.get_healthvault_user(request.user)
+        if hvuser is not None:
             record_id = hvuser.record_id
 
     # Build the authorization URL to which we redirect the user.
     conn = utils.create_connection(record_id=record_id)
-    authorization_url = conn.authorization_url(callback_url)
+    authorization_url = conn.authorization_url(callback_url, actionqs=state)
 
     return redirect(authorization_url)
 
@@ -83,6 +100,9 @@ def deauthorize(request):
     If 'next' GET parameter is provided, it is saved in the 'healthvault_next'
     session key so  the :py:func:`complete <healthvaultapp.views.complete>`
     view can redirect the user to that URL after successful deauthorization.
+    As with :py:func:`authorize <healthvaultapp.views.authorize>`, it is
+    passed through HealthVault instead if
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_NEXT_IN_STATE` is ``True``.
 
     If we don't have HealthVault credentials for this user, we short-circuit
     and redirect to either the URL defined in the 'next' GET parameter or the
@@ -99,11 +119,8 @@ def deauthorize(request):
             next_url = utils.get_setting('HEALTHVAULT_DEAUTHORIZE_REDIRECT')
         return redirect(next_url)
 
-    # Store redirect URL in the session for after deauthorization completion.
-    if next_url:
-        request.session[NEXT_SESSION_KEY] = next_url
-    else:
-        request.session.pop(NEXT_SESSION_KEY, None)
+    # Store redirect URL for after deauthorization completion.
+    state = _save_next(request, next_url)
 
     # HealthVault will send a callback to this URL so that we can complete the
     # deauthorization process.
@@ -111,7 +128,8 @@ def deauthorize(request):
 
     # Build the deauthorization URL.
     conn = utils.create_connection()
-    deauthorization_url = conn.deauthorization_url(callback_url)
+    deauthorization_url = conn.deauthorization_url(callback_url,
+            actionqs=state)
 
     # Delete our copy of the user's data.
     HealthVaultUser.objects.filter(user=request.user).delete()
@@ -145,7 +163,10 @@ def complete(request):
             access token received in the request, and redirect to the URL
             defined in the 'healthvault_next' session key, or the default URL
             defined in the :py:data:`~healthvaultapp.defaults.HEALTHVAULT_AUTHORIZE_REDIRECT`
-            setting.
+            setting. The things of the
+            :py:data:`~healthvaultapp.defaults.HEALTHVAULT_PREFETCH_DATATYPES`
+            setting are fetched into the cache in the background (see
+            :py:func:`~healthvaultapp.things.prefetch_things`).
 
         :py:data:`ApplicationTarget.SIGN_OUT`
             We no longer have access to the user's HealthVault record. We
@@ -167,7 +188,7 @@ def complete(request):
         HealthVaultUser.objects.filter(user=request.user).delete()
 
         # Redirect the user to the default denial URL.
-        request.session.pop(NEXT_SESSION_KEY, None)  # Clear the session key.
+        _pop_next(request)  # Clear the stored redirect URL.
         return redirect(utils.get_setting('HEALTHVAULT_DENIED_REDIRECT'))
 
     # Complete the authorization process.
@@ -191,7 +212,15 @@ def complete(request):
         hvuser, created = HealthVaultUser.objects.get_or_create(
                 user=request.user)
         hvuser.record_id = conn.record_id
+        hvuser.person_id = conn.person_id or ''
         hvuser.token = token
+        hvuser.token_issued = hvuser.token_used = timezone.now()
+        lifetime = utils.get_setting('HEALTHVAULT_TOKEN_LIFETIME')
+        hvuser.token_expires = None
+        if lifetime is not None:
+            hvuser.token_expires = hvuser.token_issued + \
+                    datetime.timedelta(seconds=lifetime)
+        hvuser.token_failures = 0
         try:
             hvuser.full_clean()
         except ValidationError as e:
@@ -202,8 +231,15 @@ def complete(request):
         else:
             hvuser.save()
 
+        # Warm the cache for the page the user is redirected to.
+        datatypes = utils.get_setting('HEALTHVAULT_PREFETCH_DATATYPES')
+        if datatypes:
+            # The HealthVault client stack is only loaded once it is needed.
+            from . import things
+            things.schedule_prefetch(conn, datatypes)
+
         # Redirect the user to the stored redirect URL or default.
-        next_url = request.session.pop(NEXT_SESSION_KEY, None)
+        next_url = _pop_next(request)
         if not next_url:
             next_url = utils.get_setting('HEALTHVAULT_AUTHORIZE_REDIRECT')
         return redirect(next_url)
@@ -214,17 +250,17 @@ def complete(request):
         HealthVaultUser.objects.filter(user=request.user).delete()
 
         # Redirect the user to the stored redirect URL or default.
-        next_url = request.session.pop(NEXT_SESSION_KEY, None)
+        next_url = _pop_next(request)
         if not next_url:
             next_url = utils.get_setting('HEALTHVAULT_DEAUTHORIZE_REDIRECT')
         return redirect(next_url)
 
     elif target in ApplicationTarget.all_targets():
-        request.session.pop(NEXT_SESSION_KEY, None)
+        _pop_next(request)
         raise Exception('Unhandled target: {0}'.format(target))
 
     else:
-        request.session.pop(NEXT_SESSION_KEY, None)
+        _pop_next(request)
         raise Exception('Unknown target: {0}'.format(target))
 
 
@@ -254,6 +290,145 @@ def error(request, extra_context=None):
 
     :URL name: `healthvault-error`
     """
-    request.session.pop(NEXT_SESSION_KEY, None)
+    _pop_next(request)
     return render(request, utils.get_setting('HEALTHVAULT_ERROR_TEMPLATE'),
             extra_context or {})
+
+
+def _save_next(request, next_url):
+    """
+    Stores the URL to redirect to once HealthVault calls back to
+    :py:func:`complete`. Returns the signed state to pass through HealthVault
+    in ``actionqs`` if :py:data:`~healthvaultapp.defaults.HEALTHVAULT_NEXT_IN_STATE`
+    is ``True``, otherwise the URL is kept in the session and ``None`` is
+    returned.
+    """
+    if not utils.get_setting('HEALTHVAULT_NEXT_IN_STATE'):
+        if next_url:
+            request.session[NEXT_SESSION_KEY] = next_url
+        else:
+            request.session.pop(NEXT_SESSION_KEY, None)
+        return None
+    if not next_url or not _is_allowed_next(request, next_url):
+        return None
+    # The state is timestamped, so that it expires.
+    return signing.dumps(next_url, salt=NEXT_STATE_SALT)
+
+
+def _pop_next(request):
+    """Returns and forgets the URL stored by :py:func:`_save_next`, or
+    ``None`` if there isn't one or its state is invalid or expired."""
+    if not utils.get_setting('HEALTHVAULT_NEXT_IN_STATE'):
+        return request.session.pop(NEXT_SESSION_KEY, None)
+    state = request.GET.get(NEXT_STATE_PARAM, None)
+    if not state:
+        return None
+    try:
+        next_url = signing.loads(state, salt=NEXT_STATE_SALT,
+                max_age=utils.get_setting('HEALTHVAULT_NEXT_MAX_AGE'))
+    except signing.BadSignature as e:
+        logging.getLogger(__name__).warning(
+                'Invalid next URL state: {0}'.format(e))
+        return None
+    return next_url if _is_allowed_next(request, next_url) else None
+
+
+def _is_allowed_next(request, next_url):
+    """Whether ``next_url`` is on this site or one of the hosts in
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_NEXT_ALLOWED_HOSTS`."""
+    hosts = [request.get_host()]
+    hosts.extend(utils.get_setting('HEALTHVAULT_NEXT_ALLOWED_HOSTS'))
+    return any(is_safe_url(next_url, host) for host in hosts)
+
+
+@never_cache
+def health(request):
+    """
+    Reports on HealthVault connectivity as JSON, for load balancers and
+    monitoring. The response is built from state kept in this process (see
+    :py:func:`~healthvaultapp.utils.get_health`), so polling this view
+    doesn't generate HealthVault traffic. The response status is 200 if
+    HealthVault appears reachable, and 503 otherwise.
+
+    If the :py:data:`~healthvaultapp.defaults.HEALTHVAULT_HEALTH_PROBE`
+    setting is ``True``, the result of a live probe is included. Probes are
+    made at most every
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_HEALTH_PROBE_INTERVAL`
+    seconds across all processes sharing Django's cache.
+
+    :URL name: `healthvault-health`
+    """
+    health = utils.get_health()
+    status = 200 if health['healthy'] else 503
+    return HttpResponse(json.dumps(health), status=status,
+            content_type='application/json')
+
+
+@csrf_exempt
+@require_POST
+def notify(request):
+    """
+    Receives HealthVault `eventing <http://msdn.microsoft.com/en-us/library/dn783307.aspx>`_
+    notifications, so that records can be synced when they change rather
+    than polled. Subscribe to record change events with this URL as the
+    notification channel.
+
+    Each notification must be signed with one of the shared keys in the
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_NOTIFICATION_KEYS`
+    setting, or it is rejected with a 403 response.
+
+    For a record we have credentials for, the record's watermarks are
+    updated (see :py:func:`~healthvaultapp.watermarks.touch`) and the
+    :py:data:`~healthvaultapp.signals.sync_requested` signal is sent with
+    the changed data types. Notifications for the same record and data type
+    within :py:data:`~healthvaultapp.defaults.HEALTHVAULT_NOTIFICATION_DEDUPE_SECONDS`
+    seconds of each other request only a single sync.
+
+    :URL name: `healthvault-notify`
+    """
+    logger = logging.getLogger('healthvaultapp.views.notify')
+    if not _verify_notification(request):
+        logger.warning('Rejected a notification with an invalid signature.')
+        return HttpResponseForbidden()
+
+    try:
+        notification = ET.fromstring(request.body)
+    except (SyntaxError, ExpatError):
+        return HttpResponseBadRequest()
+
+    timeout = utils.get_setting('HEALTHVAULT_NOTIFICATION_DEDUPE_SECONDS')
+    for change in notification.findall('record-change-notification'):
+        record_id = change.findtext('record-id')
+        hvusers = list(HealthVaultUser.objects.filter(record_id=record_id))
+        if not hvusers:
+            logger.info('Notification for unknown record {0}'.format(
+                    record_id))
+            continue
+
+        datatypes = set(elt.text
+                for elt in change.findall('things/thing/type-id'))
+        watermarks.touch(record_id, datatypes)
+        # Without thing types, sync (and dedupe) the whole record.
+        pending = []
+        for datatype in sorted(datatypes) or ['all']:
+            if cache.add(SYNC_PENDING_KEY.format(record_id, datatype), True,
+                    timeout):
+                pending.append(datatype)
+        if pending:
+            sync_requested.send(sender=HealthVaultUser, hvusers=hvusers,
+                    datatypes=pending if datatypes else None)
+    return HttpResponse()
+
+
+def _verify_notification(request):
+    """Checks the signature of a HealthVault notification, which is sent as
+    ``HMACSHA256 <key id>:<base64 signature>``.
+    """
+    keys = utils.get_setting('HEALTHVAULT_NOTIFICATION_KEYS')
+    algorithm, _, signature = request.META.get(SIGNATURE_HEADER, '') \
+            .partition(' ')
+    key_id, _, signature = signature.partition(':')
+    if algorithm != 'HMACSHA256' or key_id not in keys:
+        return False
+    digest = hmac.new(str(keys[key_id]), request.body, hashlib.sha256)
+    return constant_time_compare(base64.b64encode(digest.digest()), signature)
@@ -0,0 +1,111 @@
+import datetime
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.utils import timezone
+from django.views.decorators.http import condition
+
+from . import utils
+
+
+# Django cache key of the time at which data of a record last changed.
+WATERMARK_KEY = 'healthvault-watermark:{0}:{1}'
+
+# Watermarks of changes to any data of a record, and of changes to a record
+# which HealthVault didn't say the data types of.
+ANY = 'any'
+ALL = 'all'
+
+
+def touch(record_id, datatypes=None):
+    """
+    Records that the things of ``datatypes`` in the record ``record_id``
+    changed just now, or that any of its things may have changed if
+    ``datatypes`` isn't given. The :py:func:`~healthvaultapp.views.notify`
+    view does this for every change HealthVault notifies us of; call it when
+    your code changes a record too.
+    """
+    names = list(datatypes) if datatypes else [ALL]
+    now = _now()
+    cache.set_many(dict((WATERMARK_KEY.format(record_id, name), now)
+            for name in names + [ANY]),
+            utils.get_setting('HEALTHVAULT_WATERMARK_TIMEOUT'))
+
+
+def get_watermark(record_id, datatypes=None):
+    """
+    Returns the time, in milliseconds since the epoch, at which the things of
+    ``datatypes`` in the record ``record_id``, or any of its things if
+    ``datatypes`` isn't given, last changed, as far as we know.
+
+    Watermarks are kept in Django's cache for
+    :py:data:`~healthvaultapp.defaults.HEALTHVAULT_WATERMARK_TIMEOUT`
+    seconds, so it must be shared by all processes. If one is missing, such
+    as after it expired or was evicted, it is taken to be now, so that it
+    never goes back to an earlier value.
+    """
+    names = list(datatypes) + [ALL] if datatypes else [ANY]
+    keys = [WATERMARK_KEY.format(record_id, name) for name in names]
+    watermarks = cache.get_many(keys)
+    timeout = utils.get_setting('HEALTHVAULT_WATERMARK_TIMEOUT')
+    for key in keys:
+        if key not in watermarks:
+            # Only the first process to notice uses its own time.
+            now = _now()
+            cache.add(key, now, timeout)
+            watermarks[key] = cache.get(key)
+            if watermarks[key] is None:
+                # The cache doesn't store anything, such as DummyCache.
+                watermarks[key] = now
+    return max(watermarks.values())
+
+
+def _now():
+    return int(time.time() * 1000)
+
+
+def watermark_condition(datatypes=None):
+    """
+    Decorates a view of the requesting user's HealthVault data with an
+    ``ETag`` and ``Last-Modified`` header derived from the watermark of
+    ``datatypes`` in their record (see :py:func:`get_watermark`). Requests
+    with a matching ``If-None-Match`` or ``If-Modified-Since`` header are
+    answered with a 304 response without calling the view, and so without
+    loading any things.
+
+    ``Last-Modified`` only has a resolution of seconds, so clients should
+    prefer the ``ETag``. Views of users who aren't integrated are always
+    called.
+    """
+    def etag(request, *args, **kwargs):
+        watermark = _get_request_watermark(request, datatypes)
+        if watermark is None:
+            return None
+        record_id, watermark = watermark
+        return hashlib.sha1('{0}:{1}:{2}'.format(record_id,
+                ','.join(sorted(datatypes or ())), watermark)).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        watermark = _get_request_watermark(request, datatypes)
+        if watermark is None:
+            return None
+        return datetime.datetime.fromtimestamp(watermark[1] / 1000.0,
+                timezone.utc)
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
+
+
+def _get_request_watermark(request, datatypes):
+    """Returns the record ID and watermark of the requesting user, once per
+    request."""
+    if not hasattr(request, '_healthvault_watermark'):
+        watermark = None
+        hvuser = None
+        if request.user.is_authenticated():
+            hvuser = utils.get_healthvault_user(request.user)
+        if hvuser is not None:
+            watermark = (hvuser.record_id,
+                    get_watermark(hvuser.record_id, datatypes))
+        request._healthvault_watermark = watermark
+    return request._healthvault_watermark
@@ -11,6 +11,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=['setuptools'] + required,
+    extras_require={'numpy': ['numpy>=1.7']},
     url='https://github.com/orcasgit/django-healthvault/',
     license='',
     description=u' '.join(__import__('healthvaultapp').__doc__.splitlines()).strip(),